@@ -0,0 +1,51 @@
+"""
+Compare thread and process PDF page extraction on the files in tests/test_files
+
+Usage:
+    python -m benchmarks.bench_pdf_extraction [--workers 4] [--repeat 3] [files ...]
+"""
+
+import argparse
+import glob
+import time
+from pathlib import Path
+
+from loguru import logger
+
+from src.pdf_utils.pdf_parsing import pdf_extract_texts_and_images
+
+DEFAULT_FILES = sorted(glob.glob("tests/test_files/*.pdf"))
+
+
+def run(file_content: bytes, mode: str, workers: int) -> float:
+    start = time.perf_counter()
+    pdf_extract_texts_and_images(file_content, mode=mode, max_workers=workers)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("files", nargs="*", default=DEFAULT_FILES)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    logger.remove()  # Keep the report readable
+
+    print(f"{'file':<30} {'mode':<8} {'best (s)':>10} {'mean (s)':>10}")
+    for file_name in args.files:
+        file_content = Path(file_name).read_bytes()
+        # Warm up: starts the process pool so start-up is not counted
+        run(file_content, "process", args.workers)
+        for mode in ("thread", "process"):
+            timings = [
+                run(file_content, mode, args.workers) for _ in range(args.repeat)
+            ]
+            print(
+                f"{Path(file_name).name:<30} {mode:<8} "
+                f"{min(timings):>10.3f} {sum(timings) / len(timings):>10.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
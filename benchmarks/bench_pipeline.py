@@ -0,0 +1,274 @@
+"""
+End-to-end throughput of `Pipeline.process_file` without Azure resources.
+
+The pipeline is built by `get_pipeline`, as in the app, with its OpenAI,
+Search and Blob clients pointed at local fakes (see fake_azure.py) that add
+latency and answer a share of the OpenAI requests with 429s. Files are
+processed `--concurrency` at a time, like the ingestion workers of one
+gunicorn worker. The report gives files/min, pages/s, peak RSS, the fake
+services traffic, and p50/p95 of each stage from the Prometheus histograms
+(interpolated within buckets, as `histogram_quantile`).
+
+Configuration values can be overridden to compare settings, e.g.
+`--set LLM_CONCURRENCY=32 --set PDF_EXTRACTION_MODE=process`. Caches are
+disabled unless `--cache`, so repeated files cost the same each time.
+
+Usage:
+    python -m benchmarks.bench_pipeline [files or directories ...]
+        [--concurrency 4] [--repeat 3] [--latency 0.05] [--vision-latency 1.0]
+        [--rate-429 0.05] [--set KEY=VALUE ...] [--cache]
+        [--blob-connection-string ...]  (e.g. Azurite instead of the fake)
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from azure.storage.blob import BlobServiceClient
+from loguru import logger
+from openai import AsyncAzureOpenAI
+from prometheus_client import REGISTRY
+
+from benchmarks.fake_azure import FakeAzure, trust_certificate
+from src.azure_container_client import AzureContainerClient
+from src.config import ModelConfig
+from src.file_preflight import SUPPORTED_FILE_TYPES
+from src.get_pipeline import get_pipeline
+from src.models import MyFile
+
+DEFAULT_FILES = ["tests/test_files"]
+
+
+def collect_files(paths: List[str]) -> List[Path]:
+    """Files given, and the supported files under the directories given"""
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(
+                sorted(
+                    p
+                    for p in path.rglob("*")
+                    if p.suffix.lower().lstrip(".") in SUPPORTED_FILE_TYPES
+                )
+            )
+        else:
+            files.append(path)
+    return files
+
+
+def parse_value(value: str):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def make_config(fake: FakeAzure, overrides: Dict, cache: bool) -> ModelConfig:
+    config = ModelConfig()
+    config.AZURE_OPENAI_ENDPOINT = fake.url
+    config.AZURE_OPENAI_API_KEY = "fake"
+    config.MODEL_DEPLOYMENT = "chat"
+    config.AZURE_SEARCH_SERVICE_ENDPOINT = fake.tls_url
+    config.AZURE_SEARCH_ADMIN_KEY = "fake"
+    if cache:
+        cache_dir = tempfile.mkdtemp(prefix="bench_cache_")
+        config.EMBEDDING_CACHE_PATH = f"{cache_dir}/embeddings.sqlite3"
+        config.IMAGE_DESCRIPTION_CACHE_PATH = f"{cache_dir}/descriptions.sqlite3"
+    else:
+        config.EMBEDDING_CACHE_PATH = ""
+        config.EMBEDDING_CACHE_MEMORY_ENTRIES = 0
+        config.IMAGE_DESCRIPTION_CACHE_PATH = ""
+    for key, value in overrides.items():
+        if not hasattr(config, key):
+            raise SystemExit(f"Unknown setting {key}")
+        setattr(config, key, value)
+    return config
+
+
+def histogram_quantiles(
+    metric_name: str, label_names: Tuple[str, ...], quantiles=(0.5, 0.95)
+) -> Dict[Tuple[str, ...], Dict[str, float]]:
+    """Count, mean and quantiles of a histogram, by values of its labels"""
+    buckets = defaultdict(list)
+    sums, counts = {}, {}
+    for metric in REGISTRY.collect():
+        if metric.name != metric_name:
+            continue
+        for sample in metric.samples:
+            key = tuple(sample.labels[name] for name in label_names)
+            if sample.name.endswith("_bucket"):
+                buckets[key].append((float(sample.labels["le"]), sample.value))
+            elif sample.name.endswith("_sum"):
+                sums[key] = sample.value
+            elif sample.name.endswith("_count"):
+                counts[key] = sample.value
+
+    result = {}
+    for key, key_buckets in buckets.items():
+        count = counts.get(key, 0)
+        if not count:
+            continue
+        key_buckets.sort()
+        row = {"count": count, "mean": sums[key] / count}
+        for quantile in quantiles:
+            rank = quantile * count
+            lower_bound, lower_count = 0.0, 0.0
+            for upper_bound, cumulative in key_buckets:
+                if cumulative >= rank:
+                    if upper_bound == float("inf"):
+                        value = lower_bound
+                    else:
+                        share = (rank - lower_count) / (cumulative - lower_count)
+                        value = lower_bound + (upper_bound - lower_bound) * share
+                    break
+                lower_bound, lower_count = upper_bound, cumulative
+            row[f"p{int(quantile * 100)}"] = value
+        result[key] = row
+    return result
+
+
+async def run(args, fake: FakeAzure) -> Dict:
+    config = make_config(fake, dict(args.set), args.cache)
+
+    oai_client = AsyncAzureOpenAI(
+        api_key=config.AZURE_OPENAI_API_KEY,
+        api_version=config.AZURE_OPENAI_API_VERSION,
+        azure_endpoint=config.AZURE_OPENAI_ENDPOINT,
+        timeout=config.timeout,
+        max_retries=config.retry_attempts,
+    )
+    blob_service_client = BlobServiceClient.from_connection_string(
+        args.blob_connection_string or fake.blob_connection_string
+    )
+    image_container_client = AzureContainerClient(
+        client=blob_service_client,
+        container_name=config.IMAGE_CONTAINER_NAME,
+        upload_concurrency=config.BLOB_UPLOAD_CONCURRENCY,
+        upload_retries=config.BLOB_UPLOAD_RETRIES,
+    )
+    pipeline = get_pipeline(
+        config, oai_client, image_container_client, pii_service_endpoint=None
+    )
+
+    files = collect_files(args.files or DEFAULT_FILES)
+    if any(f.suffix.lower() == ".doc" for f in files):
+        pipeline.doc_converter.start()
+    jobs = [
+        (f"{repeat}_{file.name}", file.read_bytes())
+        for repeat in range(args.repeat)
+        for file in files
+    ]
+
+    slots = asyncio.Semaphore(args.concurrency)
+    results = []
+
+    async def process(file_name: str, file_content: bytes):
+        async with slots:
+            results.append(
+                await pipeline.process_file(
+                    MyFile(file_name=file_name, file_content=file_content), False
+                )
+            )
+
+    start = time.perf_counter()
+    await asyncio.gather(*(process(*job) for job in jobs))
+    elapsed = time.perf_counter() - start
+
+    await pipeline.doc_converter.close()
+    for vector_store in (
+        pipeline.text_vector_store,
+        pipeline.image_vector_store,
+        pipeline.summary_vector_store,
+    ):
+        await vector_store.close()
+    await oai_client.close()
+    await asyncio.to_thread(image_container_client.close)
+    blob_service_client.close()
+
+    return {
+        "files": len(jobs),
+        "failed": sum(1 for result in results if result["errors"]),
+        "pages": sum(result["num_pages"] for result in results),
+        "elapsed": elapsed,
+        "errors": sorted({e for result in results for e in result["errors"]})[:5],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--vision-latency", type=float, default=1.0)
+    parser.add_argument("--search-latency", type=float, default=0.02)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        type=lambda item: (item.split("=", 1)[0], parse_value(item.split("=", 1)[1])),
+        metavar="KEY=VALUE",
+    )
+    parser.add_argument("--cache", action="store_true")
+    parser.add_argument("--blob-connection-string")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.remove()  # Keep the report readable
+
+    with FakeAzure(
+        latency=args.latency,
+        vision_latency=args.vision_latency,
+        search_latency=args.search_latency,
+        rate_429=args.rate_429,
+    ) as fake:
+        trust_certificate(fake.ca_file)
+        summary = asyncio.run(run(args, fake))
+        traffic = fake.stats()
+
+    # KiB on Linux; process pool workers are not included
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    minutes = summary["elapsed"] / 60
+    print(
+        f"{summary['files']} files ({summary['failed']} with errors), "
+        f"{summary['pages']} pages in {summary['elapsed']:.1f}s: "
+        f"{summary['files'] / minutes:.1f} files/min, "
+        f"{summary['pages'] / summary['elapsed']:.1f} pages/s, "
+        f"peak RSS {peak_rss:.0f} MiB"
+    )
+    for error in summary["errors"]:
+        print(f"  error: {error[:200]}")
+    traffic.pop("indexed_documents", None)
+    print("fake services:", ", ".join(f"{k}={v}" for k, v in sorted(traffic.items())))
+
+    print(
+        f"\n{'stage':<20} {'file type':<10} {'count':>7} {'mean (s)':>9} "
+        f"{'p50 (s)':>9} {'p95 (s)':>9}"
+    )
+    rows = histogram_quantiles("ingestion_stage_seconds", ("stage", "file_type"))
+    rows.update(
+        ((f"file ({status})", file_type), row)
+        for (file_type, status), row in histogram_quantiles(
+            "ingestion_file_seconds", ("file_type", "status")
+        ).items()
+    )
+    for (stage, file_type), row in sorted(rows.items()):
+        print(
+            f"{stage:<20} {file_type:<10} {row['count']:>7.0f} {row['mean']:>9.3f} "
+            f"{row['p50']:>9.3f} {row['p95']:>9.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
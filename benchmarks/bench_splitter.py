@@ -0,0 +1,87 @@
+"""
+Time SimplePageTextSplitter on single-page texts of growing size, with the
+offset-based engine (`len`) and the string-based one (any other length
+function, same output). Time per MB stays flat when splitting is linear.
+
+Usage:
+    python -m benchmarks.bench_splitter [--sizes-mb 1 2 4 8 16] [--repeat 3]
+"""
+
+import argparse
+import random
+import time
+
+from src.splitters import SimplePageTextSplitter
+
+# Separators of the pipeline splitter, see get_pipeline
+SEPARATORS = [
+    "```Markdown",
+    "```",
+    "\n\n",
+    ".\n",
+    ". ",
+    ", ",
+    "",
+    "。",
+    "、",
+    "！",
+    "？",
+    "「",
+    "」",
+    "『",
+    "』",
+    " ",
+    "\n",
+]
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing"]
+
+
+def make_text(size: int) -> str:
+    """Sentences and paragraphs of random words, about `size` characters"""
+    rng = random.Random(0)
+    parts, length = [], 0
+    while length < size:
+        sentence = " ".join(rng.choices(WORDS, k=rng.randint(5, 20)))
+        sentence += rng.choice([". ", ", ", ".\n", ".\n\n"])
+        parts.append(sentence)
+        length += len(sentence)
+    return "".join(parts)
+
+
+def run(text: str, length_function) -> float:
+    splitter = SimplePageTextSplitter(
+        chunk_size=1000,
+        chunk_overlap=200,
+        length_function=length_function,
+        separators=SEPARATORS,
+    )
+    start = time.perf_counter()
+    splitter.split_text([{"page_no": 0, "text": text}])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes-mb", type=float, nargs="*", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--skip-strings",
+        action="store_true",
+        help="Only time the offset-based engine (the string-based one is slow on large texts)",
+    )
+    args = parser.parse_args()
+
+    engines = {"offsets": len}
+    if not args.skip_strings:
+        engines["strings"] = lambda text: len(text)
+
+    print(f"{'size (MB)':>10} {'engine':<8} {'best (s)':>10} {'s / MB':>10}")
+    for size_mb in args.sizes_mb:
+        text = make_text(int(size_mb * 1024 * 1024))
+        for engine, length_function in engines.items():
+            best = min(run(text, length_function) for _ in range(args.repeat))
+            print(f"{size_mb:>10g} {engine:<8} {best:>10.3f} {best / size_mb:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Time table finding per page with and without the ruling edges pre-filter
+(`may_contain_table`), on generated table-free and table-heavy PDFs and on
+the files given. Both find the same tables: pages the pre-filter rules out
+have too few edges for pdfplumber to build one.
+
+Usage:
+    python -m benchmarks.bench_tables [--pages 50] [--repeat 3] [files ...]
+"""
+
+import argparse
+import io
+import random
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pdfplumber
+
+from src.pdf_utils.page_analysis import PageAnalysis
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing"]
+
+
+def write_pdf(contents: List[bytes]) -> bytes:
+    """Minimal A4 PDF, one page per content stream, Helvetica as font"""
+    objects = [b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    pages_id = 2 * len(contents) + 2
+    kids = []
+    for content in contents:
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)
+        )
+        objects.append(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+            b"/Resources << /Font << /F1 1 0 R >> >> >>" % (pages_id, len(objects))
+        )
+        kids.append(len(objects))
+    refs = b" ".join(b"%d 0 R" % kid for kid in kids)
+    objects.append(b"<< /Type /Pages /Kids [%s] /Count %d >>" % (refs, len(kids)))
+    objects.append(b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id)
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for object_no, obj in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (object_no, obj))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    out.write(b"".join(b"%010d 00000 n \n" % offset for offset in offsets))
+    out.write(
+        b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+        % (len(objects) + 1, len(objects), xref)
+    )
+    return out.getvalue()
+
+
+def text_lines(num_lines: int, top: int, rng: random.Random) -> bytes:
+    return b"".join(
+        b"BT /F1 10 Tf 50 %d Td (%s) Tj ET\n"
+        % (top - i * 14, " ".join(rng.choices(WORDS, k=10)).encode())
+        for i in range(num_lines)
+    )
+
+
+def grid(left: int, top: int, cols: int, rows: int) -> bytes:
+    """Ruled table of cols x rows cells of 80 x 20 points"""
+    content = b"0.5 w\n"
+    for row in range(rows + 1):
+        y = top - row * 20
+        content += b"%d %d m %d %d l S\n" % (left, y, left + cols * 80, y)
+    for col in range(cols + 1):
+        x = left + col * 80
+        content += b"%d %d m %d %d l S\n" % (x, top, x, top - rows * 20)
+    for row in range(rows):
+        for col in range(cols):
+            content += b"BT /F1 8 Tf %d %d Td (r%dc%d) Tj ET\n" % (
+                left + col * 80 + 4,
+                top - row * 20 - 14,
+                row,
+                col,
+            )
+    return content
+
+
+def make_pdfs(num_pages: int) -> Dict[str, bytes]:
+    rng = random.Random(0)
+    # Text pages with drawings that are not tables: underlined lines (e.g.
+    # links), and a highlighted block on every other page. A single block
+    # has the edges of a one cell table, so the finder still runs there.
+    underlines = b"".join(
+        b"50 %d m 300 %d l S\n" % (797 - i * 14, 797 - i * 14) for i in range(0, 50, 2)
+    )
+    table_free = [
+        text_lines(50, 800, rng)
+        + underlines
+        + (b"60 60 200 30 re f\n" if i % 2 else b"")
+        for i in range(num_pages)
+    ]
+    table_heavy = [
+        text_lines(20, 800, rng) + grid(50, 500, 5, 10) + grid(50, 250, 3, 4)
+        for _ in range(num_pages)
+    ]
+    return {"table-free": write_pdf(table_free), "table-heavy": write_pdf(table_heavy)}
+
+
+def run(file_content: bytes, prefilter: bool, table_settings: Optional[Dict]) -> tuple:
+    """Seconds spent finding and extracting tables, and the number found"""
+    elapsed, num_tables = 0.0, 0
+    with pdfplumber.open(io.BytesIO(file_content)) as doc:
+        for page in doc.pages:
+            # Parsing the page and the drawing stats (needed anyway to spot
+            # infographics) are not part of table finding
+            analysis = PageAnalysis(page, table_settings)
+            analysis.drawing_stats
+            start = time.perf_counter()
+            if prefilter:
+                tables = analysis.tables
+            else:
+                tables = page.extract_tables(table_settings)
+            elapsed += time.perf_counter() - start
+            num_tables += len(tables)
+            page.close()
+    return elapsed, num_tables
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    documents = make_pdfs(args.pages)
+    for file_name in args.files:
+        documents[Path(file_name).name] = Path(file_name).read_bytes()
+
+    print(f"{'document':<30} {'pre-filter':<10} {'tables':>6} {'best (s)':>10}")
+    for name, file_content in documents.items():
+        for prefilter in (False, True):
+            timings = [run(file_content, prefilter, None) for _ in range(args.repeat)]
+            best = min(elapsed for elapsed, _ in timings)
+            print(
+                f"{name:<30} {'on' if prefilter else 'off':<10} "
+                f"{timings[0][1]:>6} {best:>10.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
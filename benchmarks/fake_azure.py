@@ -0,0 +1,424 @@
+"""
+Local stand-in for the Azure services the pipeline calls, for offline
+benchmarks: Azure OpenAI (embeddings and structured chat completions), AI
+Search (index creation and document upload, kept in memory) and Blob
+Storage (container check and blob upload, sizes kept in memory).
+
+The real SDK clients talk to it over HTTP, so request packing, retries and
+concurrency limits run as in production. It runs in its own process, so
+its work does not compete with the pipeline for the GIL. The Search SDK
+only sends keys over TLS: the same service is also served over HTTPS with a
+self-signed certificate, that `trust_certificate` adds to the CAs trusted by
+the client process.
+
+Usage:
+    with FakeAzure(latency=0.05, vision_latency=1.0, rate_429=0.05) as fake:
+        trust_certificate(fake.ca_file)
+        fake.url, fake.tls_url, fake.blob_connection_string, fake.stats()
+"""
+
+import asyncio
+import datetime
+import ipaddress
+import json
+import multiprocessing
+import os
+import random
+import re
+import ssl
+import tempfile
+import time
+import urllib.request
+from dataclasses import asdict, dataclass
+from email.utils import formatdate
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from aiohttp import connector, web
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+ACCOUNT_NAME = "devstoreaccount1"
+# Well-known development storage key: requests are signed, never checked
+ACCOUNT_KEY = (
+    "Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsu"
+    "Fq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw=="
+)
+
+SEARCH_INDEX = re.compile(r"^/indexes\('([^']+)'\)$")
+SEARCH_DOCS = re.compile(r"^/indexes\('([^']+)'\)/docs/search\.index$")
+LOREM = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua "
+)
+
+
+@dataclass
+class FakeSettings:
+    # Seconds per request: embeddings, chat completions, search uploads, blobs
+    latency: float = 0.05
+    vision_latency: float = 1.0
+    search_latency: float = 0.02
+    blob_latency: float = 0.01
+    # Share of OpenAI requests answered with a 429, and the delay they ask for
+    rate_429: float = 0.0
+    retry_after_ms: int = 100
+    # Characters of each string field of a chat completion
+    completion_chars: int = 600
+    seed: int = 0
+
+
+def fill_schema(schema: Dict, defs: Dict, num_images: int, chars: int, index=0):
+    """
+    A JSON value matching a response format schema: the last enum value,
+    strings of `chars` characters, one array item per image of the request
+    (integer fields named like "index" numbering them)
+    """
+    if "$ref" in schema:
+        return fill_schema(
+            defs[schema["$ref"].split("/")[-1]], defs, num_images, chars, index
+        )
+    if "anyOf" in schema:
+        options = [s for s in schema["anyOf"] if s.get("type") != "null"]
+        return fill_schema(options[0], defs, num_images, chars, index)
+    if "enum" in schema:
+        return schema["enum"][-1]
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        return {
+            name: (
+                index
+                if prop.get("type") == "integer" and "index" in name
+                else fill_schema(prop, defs, num_images, chars, index)
+            )
+            for name, prop in schema.get("properties", {}).items()
+        }
+    if schema_type == "array":
+        return [
+            fill_schema(schema["items"], defs, num_images, chars, i)
+            for i in range(max(1, num_images))
+        ]
+    if schema_type == "string":
+        return (LOREM * (chars // len(LOREM) + 1))[:chars]
+    if schema_type == "integer":
+        return index
+    if schema_type == "number":
+        return 0.5
+    if schema_type == "boolean":
+        return True
+    return None
+
+
+def make_certificate(directory: str) -> Tuple[str, str]:
+    """Self-signed certificate and key files for 127.0.0.1, valid for a day"""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+            ),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_file = Path(directory) / "fake_azure.crt"
+    key_file = Path(directory) / "fake_azure.key"
+    cert_file.write_bytes(certificate.public_bytes(serialization.Encoding.PEM))
+    key_file.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+    )
+    return str(cert_file), str(key_file)
+
+
+def trust_certificate(ca_file: str) -> None:
+    """Trust the certificate in the HTTP clients of the SDKs: requests, aiohttp"""
+    os.environ["REQUESTS_CA_BUNDLE"] = ca_file
+    # aiohttp verifies with a default context created when it is imported
+    connector._SSL_CONTEXT_VERIFIED.load_verify_locations(ca_file)
+
+
+class _Service:
+    """State and handlers of the fake services, inside the server process"""
+
+    def __init__(self, settings: FakeSettings):
+        self.settings = settings
+        self.random = random.Random(settings.seed)
+        self.indexes: Dict[str, int] = {}
+        self.blobs: Dict[str, int] = {}
+        self.counters: Dict[str, int] = {}
+        self.vectors: Dict[int, str] = {}
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def vector(self, dimensions: int) -> str:
+        """One JSON encoded unit vector per size, shared by all the texts"""
+        if dimensions not in self.vectors:
+            self.vectors[dimensions] = json.dumps([dimensions**-0.5] * dimensions)
+        return self.vectors[dimensions]
+
+    def throttled(self) -> Optional[web.Response]:
+        if self.random.random() >= self.settings.rate_429:
+            return None
+        self.count("openai_429")
+        return web.json_response(
+            {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+            status=429,
+            headers={"retry-after-ms": str(self.settings.retry_after_ms)},
+        )
+
+    async def embeddings(self, request: web.Request, deployment: str):
+        body = await request.json()
+        await asyncio.sleep(self.settings.latency)
+        throttled = self.throttled()
+        if throttled:
+            return throttled
+        texts = body["input"]
+        texts = [texts] if isinstance(texts, str) else texts
+        self.count("embedding_requests")
+        self.count("embedding_inputs", len(texts))
+        vector = self.vector(body.get("dimensions") or 1536)
+        tokens = sum(len(text) // 4 + 1 for text in texts)
+        data = ",".join(
+            '{"object":"embedding","index":%d,"embedding":%s}' % (i, vector)
+            for i in range(len(texts))
+        )
+        return web.Response(
+            text='{"object":"list","model":%s,"data":[%s],'
+            '"usage":{"prompt_tokens":%d,"total_tokens":%d}}'
+            % (json.dumps(deployment), data, tokens, tokens),
+            content_type="application/json",
+        )
+
+    async def chat_completions(self, request: web.Request, deployment: str):
+        body = await request.json()
+        num_images = sum(
+            1
+            for message in body["messages"]
+            if isinstance(message.get("content"), list)
+            for part in message["content"]
+            if part.get("type") == "image_url"
+        )
+        await asyncio.sleep(
+            self.settings.vision_latency if num_images else self.settings.latency
+        )
+        throttled = self.throttled()
+        if throttled:
+            return throttled
+        self.count("chat_requests")
+        self.count("chat_images", num_images)
+
+        response_format = body.get("response_format") or {}
+        schema = response_format.get("json_schema", {}).get("schema")
+        if schema:
+            content = json.dumps(
+                fill_schema(
+                    schema,
+                    schema.get("$defs", {}),
+                    num_images,
+                    self.settings.completion_chars,
+                )
+            )
+        else:
+            content = LOREM
+        return web.json_response(
+            {
+                "id": f"chatcmpl-{self.counters['chat_requests']}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": deployment,
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": content},
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 1000 * max(1, num_images),
+                    "completion_tokens": len(content) // 4,
+                    "total_tokens": 1000 * max(1, num_images) + len(content) // 4,
+                },
+            }
+        )
+
+    async def search(self, request: web.Request):
+        path = request.path
+        match = SEARCH_DOCS.match(path)
+        if match and request.method == "POST":
+            body = await request.json()
+            await asyncio.sleep(self.settings.search_latency)
+            documents = body["value"]
+            self.count("search_requests")
+            self.count("search_documents", len(documents))
+            self.indexes[match.group(1)] = self.indexes.get(match.group(1), 0) + len(
+                documents
+            )
+            return web.json_response(
+                {
+                    "value": [
+                        {
+                            "key": document["chunk_id"],
+                            "status": True,
+                            "errorMessage": None,
+                            "statusCode": 201,
+                        }
+                        for document in documents
+                    ]
+                }
+            )
+        match = SEARCH_INDEX.match(path)
+        if match and request.method == "GET":
+            if match.group(1) not in self.indexes:
+                return web.json_response(
+                    {"error": {"code": "", "message": "Index not found"}}, status=404
+                )
+            return web.json_response({"name": match.group(1), "fields": []})
+        if path == "/indexes" and request.method == "POST":
+            body = await request.json()
+            self.indexes.setdefault(body["name"], 0)
+            return web.json_response(body, status=201)
+        return web.json_response({"error": {"message": "Not found"}}, status=404)
+
+    async def blob(self, request: web.Request):
+        headers = {
+            "ETag": f'"0x{time.time_ns():X}"',
+            "Last-Modified": formatdate(usegmt=True),
+            "x-ms-version": request.headers.get("x-ms-version", "2024-08-04"),
+            "x-ms-request-server-encrypted": "true",
+        }
+        if request.query.get("restype") == "container":
+            # Every container exists
+            return web.Response(
+                status=201 if request.method == "PUT" else 200, headers=headers
+            )
+        if request.method == "PUT":
+            data = await request.read()
+            await asyncio.sleep(self.settings.blob_latency)
+            self.count("blob_uploads")
+            self.count("blob_bytes", len(data))
+            self.blobs[request.path] = len(data)
+            return web.Response(status=201, headers=headers)
+        return web.Response(status=404, headers=headers)
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        path = request.path
+        if path == "/_stats":
+            return web.json_response(
+                dict(self.counters, indexed_documents=self.indexes)
+            )
+        match = re.match(
+            r"^/openai/deployments/([^/]+)/(embeddings|chat/completions)$", path
+        )
+        if match:
+            deployment, operation = match.groups()
+            if operation == "embeddings":
+                return await self.embeddings(request, deployment)
+            return await self.chat_completions(request, deployment)
+        if path.startswith("/indexes"):
+            return await self.search(request)
+        if path.startswith(f"/{ACCOUNT_NAME}/"):
+            return await self.blob(request)
+        return web.json_response({"error": {"message": "Not found"}}, status=404)
+
+
+def _serve(
+    settings: FakeSettings,
+    cert_file: str,
+    key_file: str,
+    port_queue: multiprocessing.Queue,
+) -> None:
+    async def main():
+        service = _Service(settings)
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/{tail:.*}", service.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(cert_file, key_file)
+        ports = []
+        for context in (None, ssl_context):
+            site = web.TCPSite(
+                runner, "127.0.0.1", 0, backlog=1024, ssl_context=context
+            )
+            await site.start()
+            ports.append(site._server.sockets[0].getsockname()[1])
+        port_queue.put(ports)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+class FakeAzure:
+    """Fake services running in a child process, for the time of a `with` block"""
+
+    def __init__(self, **settings):
+        self.settings = FakeSettings(**settings)
+        self.url: Optional[str] = None
+        self.tls_url: Optional[str] = None
+        self.ca_file: Optional[str] = None
+        self._process: Optional[multiprocessing.Process] = None
+        self._directory: Optional[tempfile.TemporaryDirectory] = None
+
+    @property
+    def blob_connection_string(self) -> str:
+        return (
+            f"DefaultEndpointsProtocol=http;AccountName={ACCOUNT_NAME};"
+            f"AccountKey={ACCOUNT_KEY};BlobEndpoint={self.url}/{ACCOUNT_NAME};"
+        )
+
+    def start(self) -> str:
+        self._directory = tempfile.TemporaryDirectory(prefix="fake_azure_")
+        self.ca_file, key_file = make_certificate(self._directory.name)
+        context = multiprocessing.get_context("spawn")
+        port_queue = context.Queue()
+        self._process = context.Process(
+            target=_serve,
+            args=(self.settings, self.ca_file, key_file, port_queue),
+            daemon=True,
+        )
+        self._process.start()
+        port, tls_port = port_queue.get(timeout=30)
+        self.url = f"http://127.0.0.1:{port}"
+        self.tls_url = f"https://127.0.0.1:{tls_port}"
+        return self.url
+
+    def stats(self) -> Dict:
+        """Requests, inputs and 429s served so far, documents per index"""
+        with urllib.request.urlopen(f"{self.url}/_stats") as response:
+            return json.load(response)
+
+    def stop(self) -> None:
+        if self._process:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+        if self._directory:
+            self._directory.cleanup()
+            self._directory = None
+
+    def __enter__(self) -> "FakeAzure":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def __repr__(self) -> str:
+        return f"FakeAzure({self.url}, {asdict(self.settings)})"
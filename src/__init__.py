@@ -1,3 +1,4 @@
+import asyncio
 import contextlib
 import os
 
@@ -12,6 +13,8 @@ from openai import AsyncAzureOpenAI
 from src.azure_container_client import AzureContainerClient
 from src.check_duplicates import DuplicateChecker
 from src.get_pipeline import get_pipeline
+from src.ingestion_queue import IngestionQueue
+from src.ingestion_workers import IngestionWorkerPool
 
 from .globals import clients, configs, objects
 
@@ -20,6 +23,7 @@ from .globals import clients, configs, objects
 async def lifespan(app: fastapi.FastAPI):
 
     from .config import ModelConfig
+    from .main import send_webhook_notification
 
     configs["app_config"] = ModelConfig()
 
@@ -43,6 +47,8 @@ async def lifespan(app: fastapi.FastAPI):
     clients["image_container_client"] = AzureContainerClient(
         client=clients["blob_service_client"],
         container_name=config.IMAGE_CONTAINER_NAME,
+        upload_concurrency=config.BLOB_UPLOAD_CONCURRENCY,
+        upload_retries=config.BLOB_UPLOAD_RETRIES,
     )
     # azure ai search clients
     clients["text-azure-ai-search"] = SearchClient(
@@ -75,13 +81,44 @@ async def lifespan(app: fastapi.FastAPI):
         container_name="known-files-container",
     )
 
+    objects["ingestion-queue"] = IngestionQueue(
+        config.INGESTION_QUEUE_PATH,
+        lease_seconds=config.INGESTION_LEASE_SECONDS,
+        max_attempts=config.INGESTION_MAX_ATTEMPTS,
+    )
+    objects["ingestion-workers"] = IngestionWorkerPool(
+        queue=objects["ingestion-queue"],
+        pipeline=objects["pipeline"],
+        blob_service_client=clients["blob_service_client"],
+        num_workers=config.INGESTION_WORKERS,
+        notify=send_webhook_notification,
+        duplicate_checker=objects["duplicate-checker"],
+        max_file_bytes=config.MAX_FILE_BYTES,
+        max_file_pages=config.MAX_FILE_PAGES,
+        download_options=config.BLOB_DOWNLOAD_OPTIONS,
+    )
+    objects["ingestion-workers"].start()
+    # Create the LibreOffice profiles before the first .doc file
+    objects["pipeline"].doc_converter.start()
+
     yield
 
+    await objects["ingestion-workers"].stop()
+    await objects["pipeline"].doc_converter.close()
+    objects["ingestion-queue"].close()
+    await asyncio.to_thread(clients["image_container_client"].close)
     clients["blob_service_client"].close()
     await clients["chat-completion-model"].close()
     clients["text-azure-ai-search"].close()
     clients["image-azure-ai-search"].close()
     clients["summary-azure-ai-search"].close()
+    pipeline = objects["pipeline"]
+    for vector_store in (
+        pipeline.text_vector_store,
+        pipeline.image_vector_store,
+        pipeline.summary_vector_store,
+    ):
+        await vector_store.close()
 
 
 def create_app():
@@ -4,14 +4,40 @@ Desc: handling I/O tasks with Blob Storage for a specfic container
 
 """
 
-import base64
+import asyncio
+import hashlib
+import tempfile
+import time
 from abc import ABC
-from typing import Dict, Iterable, List, Optional
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
 from urllib.parse import quote
 
+from azure.core import MatchConditions
+from azure.core.exceptions import (HttpResponseError, ResourceNotFoundError,
+                                   ServiceRequestError, ServiceResponseError)
 from azure.storage.blob import BlobClient, BlobServiceClient, ContainerClient
 from loguru import logger
 
+from src.file_preflight import FilePreflight, preflight_file
+from src.metrics import stage_timer
+from src.models import FileImage
+
+# Timeouts and throttling, on top of every 5xx
+RETRYABLE_UPLOAD_STATUS_CODES = (408, 429)
+
+
+def _is_transient(error: Exception) -> bool:
+    """True if the same upload may succeed later"""
+    if isinstance(error, (ServiceRequestError, ServiceResponseError)):
+        return True
+    if isinstance(error, HttpResponseError):
+        status_code = error.status_code or 0
+        return status_code in RETRYABLE_UPLOAD_STATUS_CODES or status_code >= 500
+    return False
+
 
 class BaseAzureContainerClient(ABC):
     """
@@ -35,9 +61,13 @@ class BaseAzureContainerClient(ABC):
         logger.info(f"Making sure container {container_name} exists ...")
         self._ensure_container_exists()
 
-    def list_blob_names(self) -> List[str]:
-        return list(
-            self.client.get_container_client(self.container_name).list_blob_names()
+    def list_blob_names(self, prefix: Optional[str] = None) -> Iterator[str]:
+        """
+        Lazily list the blob names of the container, optionally under a prefix.
+        Names are fetched page by page as the iterator is consumed.
+        """
+        return self.client.get_container_client(self.container_name).list_blob_names(
+            name_starts_with=prefix
         )
 
     def _ensure_container_exists(self) -> None:
@@ -73,6 +103,107 @@ class BaseAzureContainerClient(ABC):
             logger.error(f"Error downloading blob '{blob_name}': {e}")
             return None
 
+    def download_to_file(
+        self,
+        blob_name: str,
+        max_concurrency: int = 4,
+        chunk_bytes: int = 4 * 1024 * 1024,
+        spool_bytes: int = 32 * 1024 * 1024,
+        preflight: Optional[FilePreflight] = None,
+    ) -> Tuple[tempfile.SpooledTemporaryFile, str]:
+        """
+        Download a blob with parallel ranged reads into a temporary file, kept
+        in memory up to `spool_bytes` and on disk beyond. Chunks are written
+        and hashed in order as they arrive, with at most `max_concurrency`
+        of them in flight, so the file is never held twice in memory.
+
+        All the ranges are read from the version of the blob found first, or
+        sniffed by `preflight_file`: if it is overwritten meanwhile, the
+        download fails instead of mixing both versions.
+
+        Args:
+            blob_name (str): The name of the blob to download.
+            max_concurrency (int): Ranged reads running at the same time
+            chunk_bytes (int): Size of each ranged read
+            spool_bytes (int): Size above which the file is written to disk
+            preflight (FilePreflight): Result of `preflight_file` on the blob,
+                so the version downloaded is the one sniffed
+
+        Returns:
+            The file, positioned at its start, and the SHA-256 hex digest of
+            its content. The caller closes the file.
+        """
+        blob_client: BlobClient = self.client.get_blob_client(
+            self.container_name, blob_name
+        )
+        if preflight and preflight.etag:
+            size, etag = preflight.size, preflight.etag
+        else:
+            properties = blob_client.get_blob_properties()
+            size, etag = properties.size, properties.etag
+
+        def read_range(offset: int) -> bytes:
+            return blob_client.download_blob(
+                offset=offset,
+                length=min(chunk_bytes, size - offset),
+                etag=etag,
+                match_condition=MatchConditions.IfNotModified,
+            ).readall()
+
+        file = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+        sha256_hash = hashlib.sha256()
+        offsets = iter(range(0, size, chunk_bytes))
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+                pending: Deque[Future] = deque(
+                    executor.submit(read_range, offset)
+                    for offset in islice(offsets, max(1, max_concurrency))
+                )
+                while pending:
+                    chunk = pending.popleft().result()
+                    offset = next(offsets, None)
+                    if offset is not None:
+                        pending.append(executor.submit(read_range, offset))
+                    sha256_hash.update(chunk)
+                    file.write(chunk)
+        except BaseException:
+            file.close()
+            raise
+
+        file.seek(0)
+        logger.info(f"Successfully downloaded blob {blob_name} ({size} bytes)")
+        return file, sha256_hash.hexdigest()
+
+    def preflight_file(
+        self, blob_name: str, max_bytes: int = 0, max_pages: int = 0
+    ) -> FilePreflight:
+        """
+        Type, size, estimated pages and ETag of a blob from ranged reads of
+        its head (and tail for ZIP files), before downloading it. Pass the
+        result to `download_to_file` to download the same version.
+
+        Raises:
+            PreflightError: The blob is empty, too large or not supported
+        """
+        blob_client: BlobClient = self.client.get_blob_client(
+            self.container_name, blob_name
+        )
+        properties = blob_client.get_blob_properties()
+        size, etag = properties.size, properties.etag
+
+        def read_range(offset: int, length: int) -> bytes:
+            return blob_client.download_blob(
+                offset=offset,
+                length=length,
+                etag=etag,
+                match_condition=MatchConditions.IfNotModified,
+            ).readall()
+
+        preflight = preflight_file(read_range, size, max_bytes, max_pages)
+        preflight.etag = etag
+        logger.info(f"Preflight of blob {blob_name}: {preflight}")
+        return preflight
+
     # Add this method to BaseAzureContainerClient class
     def delete_file(self, blob_name: str) -> bool:
         """
@@ -112,15 +243,23 @@ class AzureContainerClient(BaseAzureContainerClient):
         self,
         client: BlobServiceClient,
         container_name: str = "default_container",
+        upload_concurrency: int = 8,
+        upload_retries: int = 3,
     ):
         """
         Initialize the Azure container client with a specified container name.
 
         Args:
             container_name (str): Name of the container to manage. Defaults to "default_container".
+            upload_concurrency (int): Max number of image uploads in flight.
+            upload_retries (int): Retries of an image upload that failed transiently.
         """
         self.client: BlobServiceClient = client
         self.container_name: str = container_name
+        self.upload_concurrency = upload_concurrency
+        self.upload_retries = upload_retries
+        # Dedicated threads: uploads must not starve asyncio's default executor
+        self._upload_executor: Optional[ThreadPoolExecutor] = None
         logger.info(f"Making sure container {container_name} exists ...")
         self._ensure_container_exists()
 
@@ -135,14 +274,79 @@ class AzureContainerClient(BaseAzureContainerClient):
             if blob.name.endswith(".pdf")
         ]
 
-    async def upload_base64_image_to_blob(
+    def _get_upload_executor(self) -> ThreadPoolExecutor:
+        if self._upload_executor is None:
+            self._upload_executor = ThreadPoolExecutor(
+                max_workers=self.upload_concurrency,
+                thread_name_prefix=f"upload-{self.container_name}",
+            )
+        return self._upload_executor
+
+    def close(self) -> None:
+        """Wait for the uploads in flight and stop the upload threads. Blocking."""
+        if self._upload_executor is not None:
+            self._upload_executor.shutdown(wait=True)
+            self._upload_executor = None
+
+    def _upload_image_with_retry(
+        self,
+        blob_name: str,
+        image: FileImage,
+        metadata: Optional[Dict[str, str]],
+    ) -> int:
+        """
+        Upload one image, retrying transient failures with backoff, on top
+        of the retry policy of the client. Other failures, such as invalid
+        metadata or a denied access, raise at once. Runs on an upload thread.
+
+        Returns:
+            int: Number of attempts used
+        """
+        # Read here if spilled to disk, one image per thread at a time
+        image_data = image.get_bytes()
+        # URL encode the blob name
+        blob_client: BlobClient = self.client.get_blob_client(
+            self.container_name, quote(blob_name)
+        )
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                # Upload with encoded metadata
+                blob_client.upload_blob(
+                    image_data,
+                    overwrite=True,
+                    content_type=image.mime_type,
+                    metadata=metadata,
+                )
+                return attempt
+            except Exception as e:
+                if not _is_transient(e) or attempt > self.upload_retries:
+                    raise
+                delay = min(2 ** (attempt - 1), 30)
+                logger.warning(
+                    f"Upload of blob {blob_name} failed ({e}), retry {attempt}/{self.upload_retries} in {delay}s"
+                )
+                time.sleep(delay)
+
+    async def upload_images_to_blob(
         self,
         blob_names: Iterable[str],
-        base64_images: Iterable[str],
+        images: Iterable[FileImage],
         metadata: Dict[str, str] = dict(),
-    ):
-        container_client = self.client.get_container_client(self.container_name)
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Upload images concurrently without blocking the event loop, each with
+        the content type of its MIME type.
 
+        At most `upload_concurrency` images are read or uploading at a time,
+        and the iterables are consumed as slots free up.
+
+        Returns:
+            Dict with the "uploaded" and "failed" blobs, each entry holding
+            the blob_name, and the attempts or the error
+        """
         if metadata:
             # URL encode both keys and values in metadata
             encoded_metadata = {
@@ -152,38 +356,67 @@ class AzureContainerClient(BaseAzureContainerClient):
         else:
             encoded_metadata = None
 
-        # logger.debug(encoded_metadata)
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.upload_concurrency)
+        uploaded: List[Dict[str, Any]] = []
+        failed: List[Dict[str, Any]] = []
+
+        async def upload_one(blob_name: str, image: FileImage):
+            try:
+                attempts = await loop.run_in_executor(
+                    self._get_upload_executor(),
+                    self._upload_image_with_retry,
+                    blob_name,
+                    image,
+                    encoded_metadata,
+                )
+                uploaded.append({"blob_name": blob_name, "attempts": attempts})
+            except Exception as e:
+                logger.error(f"Upload image {blob_name} error: {str(e)}")
+                failed.append({"blob_name": blob_name, "error": str(e)})
+            finally:
+                slots.release()
+
+        tasks = []
+        with stage_timer("blob_upload"):
+            for blob_name, image in zip(blob_names, images):
+                await slots.acquire()
+                tasks.append(asyncio.create_task(upload_one(blob_name, image)))
+            await asyncio.gather(*tasks)
+
+        logger.debug(f"Uploaded {len(uploaded)} image blobs, {len(failed)} failed")
+        return {"uploaded": uploaded, "failed": failed}
+
+    def _delete_image(self, blob_name: str) -> None:
+        """Delete one image uploaded by `upload_images_to_blob`, if it exists"""
+        blob_client: BlobClient = self.client.get_blob_client(
+            self.container_name, quote(blob_name)
+        )
         try:
-            count = 0
-
-            for blob_name, base64_image in zip(blob_names, base64_images):
+            blob_client.delete_blob()
+        except ResourceNotFoundError:
+            pass
 
-                image_data = base64.b64decode(base64_image)
-                # URL encode the blob name
-                encoded_blob_name = quote(blob_name)
+    async def delete_images_from_blob(
+        self, blob_names: Iterable[str]
+    ) -> List[Dict[str, Any]]:
+        """
+        Delete images uploaded by `upload_images_to_blob`, on its upload threads
 
-                # Get blob client with encoded name
-                blob_client: BlobClient = container_client.get_blob_client(
-                    encoded_blob_name
-                )
+        Returns:
+            List of the blobs that could not be deleted, with the error
+        """
+        loop = asyncio.get_running_loop()
+        failed: List[Dict[str, Any]] = []
 
-                # Upload with encoded metadata
-                blob_client.upload_blob(
-                    image_data,
-                    overwrite=True,
-                    content_type="image/png",
-                    metadata=encoded_metadata,
+        async def delete_one(blob_name: str):
+            try:
+                await loop.run_in_executor(
+                    self._get_upload_executor(), self._delete_image, blob_name
                 )
-                count += 1
-
-                # logger.debug(f"Successfully uploaded blob: {blob_name}")
-
-            logger.debug(
-                f"Successfully uploaded all {count} image blobs, last one is: {encoded_blob_name}"
-            )
-
-        except Exception as e:
-            logger.error(f"Upload images error: {str(e)}")
-            raise
+            except Exception as e:
+                logger.error(f"Delete image {blob_name} error: {str(e)}")
+                failed.append({"blob_name": blob_name, "error": str(e)})
 
-        return
+        await asyncio.gather(*(delete_one(blob_name) for blob_name in blob_names))
+        return failed
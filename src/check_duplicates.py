@@ -3,114 +3,346 @@ Implement duplicating rules.
 If a file is a duplicate, skip processing it
 """
 
+import asyncio
 import json
-from typing import Any, Dict, List
+import threading
+import time
+import zlib
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
 
+from azure.core import MatchConditions
+from azure.core.exceptions import (ResourceExistsError, ResourceModifiedError,
+                                   ResourceNotFoundError)
 from azure.storage.blob import BlobServiceClient
 from loguru import logger
 
 from src.azure_container_client import BaseAzureContainerClient
+from src.models import MyFileMetaData
+
+# (kind, key, value): add `key` to the set `kind`, or for "versions" set
+# `key` to `value` (remove it if value is None)
+Change = Tuple[str, str, Optional[str]]
+
+
+@dataclass
+class _Shard:
+    """Part of the index holding the keys whose hash falls in this shard"""
+
+    titles: Set[str] = field(default_factory=set)
+    title_keys: Set[str] = field(default_factory=set)  # case-folded titles
+    hashes: Set[str] = field(default_factory=set)
+    file_names: Set[str] = field(default_factory=set)
+    # "<dept_name>/<file name>" -> hash of its indexed version
+    versions: Dict[str, str] = field(default_factory=dict)
+    etag: Optional[str] = None
+
+    def apply(self, change: Change) -> None:
+        kind, key, value = change
+        if kind == "versions":
+            if value is None:
+                self.versions.pop(key, None)
+            else:
+                self.versions[key] = value
+        elif kind == "titles":
+            self.titles.add(key)
+            self.title_keys.add(key.casefold())
+        else:
+            getattr(self, kind).add(key)
+
+    def to_bytes(self) -> bytes:
+        return json.dumps(
+            {
+                "titles": sorted(self.titles),
+                "hashes": sorted(self.hashes),
+                "file_names": sorted(self.file_names),
+                "versions": self.versions,
+            }
+        ).encode("utf-8")
+
+    @classmethod
+    def from_bytes(cls, data: bytes, etag: Optional[str] = None) -> "_Shard":
+        loaded = json.loads(data.decode("utf-8"))
+        titles = set(loaded.get("titles", []))
+        return cls(
+            titles=titles,
+            title_keys={title.casefold() for title in titles},
+            hashes=set(loaded.get("hashes", [])),
+            file_names=set(loaded.get("file_names", [])),
+            versions=dict(loaded.get("versions", {})),
+            etag=etag,
+        )
 
 
 class DuplicateChecker(BaseAzureContainerClient):
     """
-    Simple duplicate checks using key pair storage in JSON format
+    Duplicate checks on an index of known titles, hashes, file names and
+    indexed file versions.
+
+    The index is held in memory as sets and dicts (titles also case-folded),
+    so lookups are O(1). On blob storage it is split into JSON shards by key
+    hash: `save` only rewrites the shards changed since the last save, and
+    each write is conditional on the shard ETag, so gunicorn workers merge
+    their changes instead of overwriting each other's.
     """
 
-    def __init__(self, client: BlobServiceClient, container_name: str):
+    LEGACY_BLOB_NAME = "known_files.json"
+    SHARD_PREFIX = "known_files/"
+    MAX_SAVE_ATTEMPTS = 5
+
+    def __init__(
+        self,
+        client: BlobServiceClient,
+        container_name: str,
+        num_shards: int = 16,
+        refresh_interval: float = 30.0,
+    ):
+        """
+        Args:
+            client (BlobServiceClient): Azure Blob Storage service client
+            container_name (str): Container of the index blobs
+            num_shards (int): Number of shard blobs. Do not change it once
+                the index exists: keys would be looked up in the wrong shard.
+            refresh_interval (float): Min seconds between two checks for
+                changes saved by other workers
+        """
         super().__init__(client, container_name)
-        self.blob_name = "known_files.json"
+        self.num_shards = num_shards
+        self.refresh_interval = refresh_interval
 
-        # Initialize default structure
-        self.known_dict: Dict[str, List[str]] = {
-            "known_titles": [],
-            "known_hashes": [],
-            "known_file_names": [],
-        }
+        # Lookups and updates run on the event loop, `save` on a worker thread
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._shards: List[_Shard] = [_Shard() for _ in range(num_shards)]
+        # Changes applied in memory but not saved yet, by shard
+        self._pending: Dict[int, List[Change]] = defaultdict(list)
+        self._last_refresh = 0.0
 
-        # Try to load existing knowledge
         try:
-            if known_files_bytes := self.download_file(self.blob_name):
-                # Decode bytes to string and parse JSON
-                known_files_str = known_files_bytes.decode("utf-8")
-                loaded_knowledge = json.loads(known_files_str)
+            self._load()
+        except Exception as e:
+            logger.error(f"Unexpected error loading duplicate index: {e}")
 
-                # Update with loaded data, maintaining default structure
-                self.known_dict.update(loaded_knowledge)
+    def _shard_blob_name(self, shard_no: int) -> str:
+        return f"{self.SHARD_PREFIX}shard-{shard_no:03d}.json"
 
-                logger.info(f"Successfully loaded blob {self.blob_name}")
-            else:
-                logger.info(f"No existing blob {self.blob_name}")
+    def _shard_no(self, key: str) -> int:
+        # crc32 rather than hash(): stable across processes
+        return zlib.crc32(key.encode("utf-8")) % self.num_shards
 
-        except json.JSONDecodeError as e:
-            logger.error(f"Error decoding JSON from {self.blob_name}: {e}")
-        except UnicodeDecodeError as e:
-            logger.error(f"Error decoding bytes from {self.blob_name}: {e}")
-        except Exception as e:
-            logger.error(f"Unexpected error loading knowledge file: {e}")
+    def _blob_client(self, blob_name: str):
+        return self.client.get_container_client(self.container_name).get_blob_client(
+            blob_name
+        )
+
+    def _download_shard(self, shard_no: int) -> _Shard:
+        """Current version of a shard on blob storage, empty if missing"""
+        try:
+            downloader = self._blob_client(
+                self._shard_blob_name(shard_no)
+            ).download_blob()
+        except ResourceNotFoundError:
+            return _Shard()
+        return _Shard.from_bytes(downloader.readall(), etag=downloader.properties.etag)
+
+    def _load(self) -> None:
+        shard_names = set(self.list_blob_names(prefix=self.SHARD_PREFIX))
+        if shard_names:
+            for shard_no in range(self.num_shards):
+                if self._shard_blob_name(shard_no) in shard_names:
+                    self._shards[shard_no] = self._download_shard(shard_no)
+            self._last_refresh = time.monotonic()
+            logger.info(f"Loaded duplicate index from {len(shard_names)} shards")
+            return
+
+        # First start on this container: migrate the single JSON blob, if any
+        if legacy_bytes := self.download_file(self.LEGACY_BLOB_NAME):
+            legacy = json.loads(legacy_bytes.decode("utf-8"))
+            for title in legacy.get("known_titles", []):
+                self._change("titles", title)
+            for file_hash in legacy.get("known_hashes", []):
+                self._change("hashes", file_hash)
+            for file_name in legacy.get("known_file_names", []):
+                self._change("file_names", file_name)
+            for key, file_hash in legacy.get("known_versions", {}).items():
+                self._change("versions", key, file_hash)
+            logger.info(f"Migrating {self.LEGACY_BLOB_NAME} to the sharded index")
+            self.save()
+        else:
+            logger.info("No existing duplicate index")
+
+    def _change(self, kind: str, key: str, value: Optional[str] = None) -> None:
+        """Apply a change in memory and remember it for the next save"""
+        shard_no = self._shard_no(key.casefold() if kind == "titles" else key)
+        with self._lock:
+            self._shards[shard_no].apply((kind, key, value))
+            self._pending[shard_no].append((kind, key, value))
+
+    def _save_shard(self, shard_no: int, changes: List[Change]) -> None:
+        """
+        Merge changes into the stored shard with a conditional write,
+        reloading the shard and merging again when another worker wrote it
+        in between
+        """
+        blob_client = self._blob_client(self._shard_blob_name(shard_no))
+        for attempt in range(1, self.MAX_SAVE_ATTEMPTS + 1):
+            shard = self._download_shard(shard_no)
+            for change in changes:
+                shard.apply(change)
+            try:
+                if shard.etag:
+                    result = blob_client.upload_blob(
+                        shard.to_bytes(),
+                        overwrite=True,
+                        etag=shard.etag,
+                        match_condition=MatchConditions.IfNotModified,
+                        content_type="application/json",
+                    )
+                else:
+                    result = blob_client.upload_blob(
+                        shard.to_bytes(),
+                        overwrite=False,
+                        content_type="application/json",
+                    )
+            except (ResourceModifiedError, ResourceExistsError):
+                logger.debug(
+                    f"Shard {shard_no} changed concurrently, merging again "
+                    f"({attempt}/{self.MAX_SAVE_ATTEMPTS})"
+                )
+                continue
+
+            shard.etag = result["etag"]
+            with self._lock:
+                # Changes made while saving are not in the stored shard yet
+                for change in self._pending.get(shard_no, []):
+                    shard.apply(change)
+                self._shards[shard_no] = shard
+            return
+
+        raise RuntimeError(
+            f"Shard {shard_no} still changing after {self.MAX_SAVE_ATTEMPTS} attempts"
+        )
 
     def save(self):
         """
-        Save current knowledge to blob storage
+        Save the changes since the last save, one conditional write per
+        changed shard. Blocking: call it off the event loop.
 
         Returns:
             bool: True if save was successful, False otherwise
         """
-        try:
-            # Update knowledge dictionary with current lists
-            self.known_dict.update(
-                {
-                    "known_titles": self.known_dict["known_titles"],
-                    "known_hashes": self.known_dict["known_hashes"],
-                    "known_file_names": self.known_dict["known_file_names"],
-                }
-            )
-
-            # Convert to JSON string and encode to bytes
-            json_data = json.dumps(self.known_dict, indent=2)
-            json_bytes = json_data.encode("utf-8")
-
-            # Upload to blob storage
-
-            container_client = self.client.get_container_client(self.container_name)
-            blob_client = container_client.get_blob_client(self.blob_name)
+        with self._save_lock:
+            with self._lock:
+                pending, self._pending = self._pending, defaultdict(list)
+
+            failed: Dict[int, List[Change]] = {}
+            for shard_no, changes in pending.items():
+                try:
+                    self._save_shard(shard_no, changes)
+                except Exception as e:
+                    logger.error(f"Error saving duplicate index shard {shard_no}: {e}")
+                    failed[shard_no] = changes
+
+            if failed:
+                # Keep them for the next save, before the changes made meanwhile
+                with self._lock:
+                    for shard_no, changes in failed.items():
+                        self._pending[shard_no] = changes + self._pending[shard_no]
+                return False
+
+        if pending:
+            logger.info(f"Saved {len(pending)} duplicate index shards")
+        return True
+
+    def refresh(self) -> None:
+        """
+        Reload the shards other workers changed, detected by their ETag.
+        Blocking: call it off the event loop.
+        """
+        for shard_no in range(self.num_shards):
             try:
-                blob_client.upload_blob(
-                    json_bytes, overwrite=True, content_type="application/json"
+                etag = (
+                    self._blob_client(self._shard_blob_name(shard_no))
+                    .get_blob_properties()
+                    .etag
                 )
+            except ResourceNotFoundError:
+                continue
+            if etag == self._shards[shard_no].etag:
+                continue
 
-                logger.info(f"Successfully saved knowledge to {self.blob_name}")
-            except Exception as e:
-                logger.error(f"Error uploading known file data to {self.blob_name}")
-            finally:
-                container_client.close()
-                blob_client.close()
+            shard = self._download_shard(shard_no)
+            with self._lock:
+                for change in self._pending.get(shard_no, []):
+                    shard.apply(change)
+                self._shards[shard_no] = shard
+        self._last_refresh = time.monotonic()
 
+    async def refresh_if_stale(self) -> None:
+        """Refresh at most every `refresh_interval` seconds"""
+        if time.monotonic() - self._last_refresh < self.refresh_interval:
+            return
+        self._last_refresh = time.monotonic()
+        try:
+            await asyncio.to_thread(self.refresh)
         except Exception as e:
-            logger.error(f"Error saving knowledge file: {e}")
+            logger.error(f"Error refreshing duplicate index: {e}")
 
-    def update(self, file_hash=None, file_name=None, title=None):
+    def update(self, file_hash=None, file_name=None, title=None, dept_name="default"):
         """
-        Add new file_hash or file_name or title to the known files json
+        Add new file_hash or file_name or title to the known files
         """
+        if file_hash:
+            self._change("hashes", file_hash)
+        if file_name:
+            self._change("file_names", file_name)
+        if title:
+            self._change("titles", title)
+        if file_name and file_hash:
+            self._change("versions", f"{dept_name}/{file_name}", file_hash)
 
-        def add_to_known_dict(key, value):
-            if value:
-                self.known_dict[key] = list(set(self.known_dict[key] + [value]))
-
-        add_to_known_dict("known_hashes", file_hash)
-        add_to_known_dict("known_file_names", file_name)
-        add_to_known_dict("known_titles", title)
+    def forget(self, file_name: str, dept_name: str = "default"):
+        """
+        Drop the indexed version of a removed file, so uploading it again
+        indexes it even if its bytes did not change
+        """
+        self._change("versions", f"{dept_name}/{file_name}", None)
 
     def duplicate_by_title(self, title: str, case_sensitive=False):
+        shard = self._shards[self._shard_no(title.casefold())]
         if case_sensitive:
-            return title in self.known_dict["known_titles"]
-        return title.lower() in [
-            known_title.lower() for known_title in self.known_dict["known_titles"]
-        ]
+            return title in shard.titles
+        return title.casefold() in shard.title_keys
 
     def duplicate_by_hash(self, file_hash: str):
-        return file_hash in self.known_dict["known_hashes"]
+        return file_hash in self._shards[self._shard_no(file_hash)].hashes
 
     def duplicate_by_file_name(self, file_name: str):
-        return file_name in self.known_dict["known_file_names"]
+        return file_name in self._shards[self._shard_no(file_name)].file_names
+
+    def is_unchanged(
+        self, file_name: str, file_hash: str, dept_name: str = "default"
+    ) -> bool:
+        """True if this exact version of the file is already indexed"""
+        key = f"{dept_name}/{file_name}"
+        return self._shards[self._shard_no(key)].versions.get(key) == file_hash
+
+    async def record_indexed(self, file_metadata: MyFileMetaData, file_name: str):
+        """Remember the indexed version of a file and persist the knowledge"""
+        self.update(
+            file_hash=file_metadata.file_hash,
+            file_name=file_name,
+            title=file_metadata.title,
+            dept_name=file_metadata.dept_name,
+        )
+        await asyncio.to_thread(self.save)
+
+    async def forget_indexed(self, file_name: str, dept_name: str = "default"):
+        """
+        Drop the indexed version of a file whose indexing failed and persist
+        it: the failed run may have overwritten or deleted some of its chunks,
+        so the next incremental run must index it again
+        """
+        self.forget(file_name, dept_name)
+        await asyncio.to_thread(self.save)
@@ -1,6 +1,18 @@
+import json
 import os
 from dataclasses import dataclass
 
+# Gunicorn workers of the container, exported by gunicorn.conf.py (1 outside
+# gunicorn). Limits on shared quotas are given per container and split evenly
+# between the workers, each getting at least 1: the effective container cap is
+# max(limit, GUNICORN_WORKERS).
+GUNICORN_WORKERS = max(1, int(os.getenv("GUNICORN_WORKERS", 1)))
+
+
+def per_worker(limit: int) -> int:
+    """Share of one gunicorn worker of a per-container limit"""
+    return max(1, limit // GUNICORN_WORKERS)
+
 
 @dataclass
 class ModelConfig:
@@ -23,6 +35,24 @@ class ModelConfig:
         os.getenv("AZURE_OPENAI_EMBEDDING_DIMENSIONS", 1536)
     )
     AZURE_OPENAI_ENDPOINT: str = os.getenv("AZURE_OPENAI_ENDPOINT", "")
+    # Embedding requests: token budget and size of one request, requests in flight
+    EMBEDDING_MAX_TOKENS_PER_REQUEST = int(
+        os.getenv("EMBEDDING_MAX_TOKENS_PER_REQUEST", 64000)
+    )
+    EMBEDDING_MAX_INPUTS_PER_REQUEST = int(
+        os.getenv("EMBEDDING_MAX_INPUTS_PER_REQUEST", 2048)
+    )
+    # Per container, see `per_worker`
+    EMBEDDING_CONCURRENCY = per_worker(int(os.getenv("EMBEDDING_CONCURRENCY", 16)))
+    EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", 6))
+    # Embedding cache: SQLite file of the disk tier (empty: memory only), its
+    # size bound, and the number of vectors kept in memory by each worker
+    # (4 bytes per dimension: about 30 MB at 5000 vectors of 1536 dimensions)
+    EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "cache/embeddings.sqlite3")
+    EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 1 << 30))
+    EMBEDDING_CACHE_MEMORY_ENTRIES = int(
+        os.getenv("EMBEDDING_CACHE_MEMORY_ENTRIES", 5000)
+    )
     AZURE_OPENAI_MODEL_NAME = os.getenv(
         "AZURE_OPENAI_MODEL_NAME", "text-embedding-3-large"
     )
@@ -44,6 +74,111 @@ class ModelConfig:
     IMAGE_INDEX_NAME = os.getenv("IMAGE_INDEX_NAME", "my-image-index")
     SUMMARY_INDEX_NAME = os.getenv("SUMMARY_INDEX_NAME", "my-summary-index")
     IMAGE_CONTAINER_NAME = os.getenv("IMAGE_CONTAINER_NAME", "my-image-container")
+    BLOB_UPLOAD_CONCURRENCY = int(os.getenv("BLOB_UPLOAD_CONCURRENCY", 8))
+    BLOB_UPLOAD_RETRIES = int(os.getenv("BLOB_UPLOAD_RETRIES", 3))
     WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 
     PII_SERVICE_ENDPOINT = os.getenv("PII_SERVICE_ENDPOINT")
+
+    # Image description cache: SQLite file (empty: disabled), size bound, image
+    # types whose descriptions are reused (picture and information ones only
+    # with the same prompt and document summary), and matching of re-encoded
+    # images
+    IMAGE_DESCRIPTION_CACHE_PATH = os.getenv(
+        "IMAGE_DESCRIPTION_CACHE_PATH", "cache/image_descriptions.sqlite3"
+    )
+    IMAGE_DESCRIPTION_CACHE_MAX_BYTES = int(
+        os.getenv("IMAGE_DESCRIPTION_CACHE_MAX_BYTES", 1 << 28)
+    )
+    IMAGE_DESCRIPTION_CACHE_TYPES = os.getenv(
+        "IMAGE_DESCRIPTION_CACHE_TYPES", "icon,shape,logo,picture,information"
+    ).split(",")
+    IMAGE_DESCRIPTION_CACHE_PERCEPTUAL = (
+        os.getenv("IMAGE_DESCRIPTION_CACHE_PERCEPTUAL", "false").lower() == "true"
+    )
+
+    # Text chunking: size and overlap in "characters" or "tokens"
+    CHUNK_LENGTH_UNIT = os.getenv("CHUNK_LENGTH_UNIT", "characters")
+    CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 1000))
+    CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 200))
+    TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+
+    # Image normalization before description and upload, opt-in (by default
+    # images are kept as extracted): max side, encoding and quality of photos,
+    # margin trimming, and vision detail ("size" picks it from the image size)
+    IMAGE_NORMALIZATION = os.getenv("IMAGE_NORMALIZATION", "false").lower() == "true"
+    IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", 2048))
+    IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "JPEG")
+    IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 85))
+    IMAGE_TRIM_MARGINS = os.getenv("IMAGE_TRIM_MARGINS", "true").lower() == "true"
+    IMAGE_DETAIL = os.getenv("IMAGE_DETAIL", "size")
+    # Images larger than this (bytes) wait in temporary files while their file
+    # is processed, 0 keeps them in memory
+    IMAGE_SPILL_BYTES = int(os.getenv("IMAGE_SPILL_BYTES", 0))
+    IMAGE_SPILL_DIR = os.getenv("IMAGE_SPILL_DIR") or None
+    # Images described per chat completion request (1 disables batching), and
+    # the pixels and estimated image tokens of one request
+    IMAGE_BATCH_SIZE = int(os.getenv("IMAGE_BATCH_SIZE", 1))
+    IMAGE_BATCH_MAX_PIXELS = int(os.getenv("IMAGE_BATCH_MAX_PIXELS", 4_000_000))
+    IMAGE_BATCH_MAX_TOKENS = int(os.getenv("IMAGE_BATCH_MAX_TOKENS", 4000))
+
+    # "thread" or "process"
+    PDF_EXTRACTION_MODE = os.getenv("PDF_EXTRACTION_MODE", "thread")
+    PDF_EXTRACTION_WORKERS = int(os.getenv("PDF_EXTRACTION_WORKERS", 4))
+    # PDFs of at least this many pages (estimated before download) use the
+    # process pool, 0 (default) disables
+    PDF_PROCESS_MIN_PAGES = int(os.getenv("PDF_PROCESS_MIN_PAGES", 0))
+    # Files rejected before download: larger than this (bytes), or with more
+    # estimated pages than this, 0 (default) disables
+    MAX_FILE_BYTES = int(os.getenv("MAX_FILE_BYTES", 0))
+    MAX_FILE_PAGES = int(os.getenv("MAX_FILE_PAGES", 0))
+    # Stored files are downloaded with parallel ranged reads: reads in flight,
+    # bytes per read, and size above which the download is spooled to disk
+    BLOB_DOWNLOAD_OPTIONS = dict(
+        max_concurrency=int(os.getenv("BLOB_DOWNLOAD_CONCURRENCY", 4)),
+        chunk_bytes=int(os.getenv("BLOB_DOWNLOAD_CHUNK_BYTES", 4 * 1024 * 1024)),
+        spool_bytes=int(os.getenv("BLOB_DOWNLOAD_SPOOL_BYTES", 32 * 1024 * 1024)),
+    )
+    # Images embedded in PDFs: "render" (rasterized, the default) or "native"
+    # (decoded from their streams)
+    PDF_IMAGE_MODE = os.getenv("PDF_IMAGE_MODE", "render")
+    # pdfplumber table settings as JSON, e.g. {"snap_tolerance": 5}
+    PDF_TABLE_SETTINGS = json.loads(os.getenv("PDF_TABLE_SETTINGS") or "{}")
+    # Streaming: pages parsed ahead of indexing, chunks per indexing batch
+    PAGE_WINDOW = int(os.getenv("PAGE_WINDOW", 8))
+    INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", 100))
+    # Indexing requests: size limits of one request, requests in flight per index
+    SEARCH_UPLOAD_MAX_DOCUMENTS = int(os.getenv("SEARCH_UPLOAD_MAX_DOCUMENTS", 1000))
+    SEARCH_UPLOAD_MAX_BYTES = int(
+        os.getenv("SEARCH_UPLOAD_MAX_BYTES", 12 * 1024 * 1024)
+    )
+    SEARCH_UPLOAD_CONCURRENCY = int(os.getenv("SEARCH_UPLOAD_CONCURRENCY", 4))
+    SEARCH_UPLOAD_RETRIES = int(os.getenv("SEARCH_UPLOAD_RETRIES", 3))
+
+    # Per worker: LibreOffice conversions of .doc files running and waiting,
+    # seconds before a conversion is killed
+    DOC_CONVERSION_WORKERS = int(os.getenv("DOC_CONVERSION_WORKERS", 2))
+    DOC_CONVERSION_MAX_QUEUED = int(os.getenv("DOC_CONVERSION_MAX_QUEUED", 16))
+    DOC_CONVERSION_TIMEOUT = float(os.getenv("DOC_CONVERSION_TIMEOUT", 120))
+    LIBREOFFICE_BINARY = os.getenv("LIBREOFFICE_BINARY", "soffice")
+
+    # Per container, see `per_worker`: files parsed at the same time, chat
+    # completion calls in flight
+    PARSING_CONCURRENCY = per_worker(int(os.getenv("PARSING_CONCURRENCY", 8)))
+    LLM_CONCURRENCY = per_worker(int(os.getenv("LLM_CONCURRENCY", 64)))
+
+    # Bulk ingestion: persistent queue and files processed at the same time per
+    # container (see `per_worker`)
+    INGESTION_QUEUE_PATH = os.getenv(
+        "INGESTION_QUEUE_PATH", "cache/ingestion_queue.sqlite3"
+    )
+    # 0 disables bulk ingestion, and lets gunicorn recycle its workers (see
+    # gunicorn.conf.py)
+    INGESTION_WORKERS = (
+        per_worker(int(os.getenv("INGESTION_WORKERS", 16)))
+        if int(os.getenv("INGESTION_WORKERS", 16))
+        else 0
+    )
+    INGESTION_MAX_ATTEMPTS = int(os.getenv("INGESTION_MAX_ATTEMPTS", 3))
+    # Seconds without heartbeat after which a job being processed is requeued
+    INGESTION_LEASE_SECONDS = float(os.getenv("INGESTION_LEASE_SECONDS", 300))
@@ -0,0 +1,242 @@
+"""
+File: doc_conversion.py
+Desc: pool of headless LibreOffice slots converting legacy .doc files to .docx,
+awaitable from the event loop
+"""
+
+import asyncio
+import os
+import shutil
+import signal
+import tempfile
+from pathlib import Path
+from typing import List, Optional
+
+from loguru import logger
+
+from src.file_utils import FileContent, copy_file_content
+
+
+class DocConversionError(Exception):
+    pass
+
+
+def _write_file(path: Path, file_content: FileContent) -> None:
+    with open(path, "wb") as f:
+        copy_file_content(file_content, f)
+
+
+class LibreOfficeSlot:
+    """
+    One LibreOffice user profile, used by one conversion at a time: profiles
+    cannot be shared by concurrent soffice processes. The profile is created
+    once (the slow part of a LibreOffice cold start) and reused until a
+    conversion crashes or times out, then it is recreated.
+    """
+
+    def __init__(self, slot_no: int, directory: Path):
+        self.slot_no = slot_no
+        self.directory = directory
+        self.profile_dir = directory / "profile"
+        self.io_dir = directory / "io"
+        self.healthy = False
+
+    @property
+    def profile_uri(self) -> str:
+        return self.profile_dir.as_uri()
+
+    def reset(self) -> None:
+        """Drop the profile (and any lock left by a killed process). Blocking."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.io_dir.mkdir(parents=True, exist_ok=True)
+        self.healthy = False
+
+
+class LibreOfficePool:
+    """
+    Fixed number of LibreOffice slots, each with its own profile directory.
+    Conversions wait for a free slot in a bounded queue, run as asyncio
+    subprocesses with a timeout, and a slot whose conversion timed out,
+    was cancelled or crashed is reset and checked again before its next
+    conversion. A document LibreOffice rejects keeps the slot as it is.
+
+    Each gunicorn worker has its own pool, under its own temporary directory.
+    """
+
+    def __init__(
+        self,
+        size: int = 2,
+        max_queued: int = 16,
+        timeout: float = 120.0,
+        binary: str = "soffice",
+        work_dir: Optional[str] = None,
+    ):
+        """
+        Args:
+            size (int): Number of conversions running at the same time
+            max_queued (int): Max number of conversions waiting for a slot,
+                more raise DocConversionError
+            timeout (float): Seconds before a conversion (or the start of
+                a slot) is killed
+            binary (str): LibreOffice executable
+            work_dir (str): Parent of the pool directory, the system default if None
+        """
+        self.size = size
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.binary = binary
+        self.work_dir = work_dir
+        self._directory: Optional[Path] = None
+        self._slots: List[LibreOfficeSlot] = []
+        self._free_slots: Optional[asyncio.Queue] = None
+        self._num_waiting = 0
+        self._warm_up_task: Optional[asyncio.Task] = None
+
+    def _ensure_slots(self) -> None:
+        if self._free_slots is not None:
+            return
+        self._directory = Path(
+            tempfile.mkdtemp(prefix="libreoffice_", dir=self.work_dir)
+        )
+        self._free_slots = asyncio.Queue()
+        for slot_no in range(self.size):
+            slot = LibreOfficeSlot(slot_no, self._directory / f"slot_{slot_no}")
+            slot.io_dir.mkdir(parents=True, exist_ok=True)
+            self._slots.append(slot)
+            self._free_slots.put_nowait(slot)
+
+    def start(self) -> None:
+        """Create the slot profiles in the background, before the first .doc"""
+        self._ensure_slots()
+        self._warm_up_task = asyncio.create_task(self._warm_up_all())
+
+    async def _warm_up_all(self) -> None:
+        for _ in range(self.size):
+            slot = await self._free_slots.get()
+            try:
+                await self._check(slot)
+            except DocConversionError as e:
+                logger.warning(f"LibreOffice slot {slot.slot_no} failed to start: {e}")
+            finally:
+                self._free_slots.put_nowait(slot)
+
+    async def close(self) -> None:
+        if self._warm_up_task:
+            self._warm_up_task.cancel()
+            await asyncio.gather(self._warm_up_task, return_exceptions=True)
+        if self._directory:
+            await asyncio.to_thread(shutil.rmtree, self._directory, True)
+        self._directory = None
+        self._slots = []
+        self._free_slots = None
+
+    async def _run(self, slot: LibreOfficeSlot, *args: str) -> bytes:
+        """
+        Run soffice on the profile of the slot, killed after the timeout.
+        A killed or crashed process may leave the profile corrupted or
+        locked: the slot is then started afresh before its next conversion.
+        """
+        process = await asyncio.create_subprocess_exec(
+            self.binary,
+            "--headless",
+            "--invisible",
+            "--norestore",
+            "--nologo",
+            f"-env:UserInstallation={slot.profile_uri}",
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            # Own process group: soffice runs the office in a child process
+            start_new_session=True,
+        )
+        try:
+            output, _ = await asyncio.wait_for(
+                process.communicate(), timeout=self.timeout
+            )
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            slot.healthy = False
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await process.wait()
+            raise
+        # Killed by a signal, directly or as reported by the soffice script.
+        # Other non-zero exits come from the input and leave the profile intact
+        if process.returncode < 0 or process.returncode > 128:
+            slot.healthy = False
+        if process.returncode != 0:
+            raise DocConversionError(
+                f"{self.binary} exited with code {process.returncode}: "
+                f"{output.decode(errors='replace').strip()}"
+            )
+        return output
+
+    async def _check(self, slot: LibreOfficeSlot) -> None:
+        """Health check: start the office on the profile (creating it) and quit"""
+        if slot.healthy:
+            return
+        await asyncio.to_thread(slot.reset)
+        try:
+            await self._run(slot, "--terminate_after_init")
+        except asyncio.TimeoutError:
+            raise DocConversionError(
+                f"LibreOffice start timed out after {self.timeout}s"
+            )
+        slot.healthy = True
+        logger.debug(f"LibreOffice slot {slot.slot_no} ready")
+
+    async def convert(self, file_content: FileContent, target: str = "docx") -> bytes:
+        """
+        Convert a .doc file (bytes or a seekable binary file), to .docx by default
+
+        Raises:
+            DocConversionError: Queue full, timeout, or LibreOffice failed
+        """
+        self._ensure_slots()
+        if self._num_waiting >= self.max_queued:
+            raise DocConversionError(
+                f"{self._num_waiting} conversions already waiting for LibreOffice"
+            )
+
+        self._num_waiting += 1
+        try:
+            slot = await self._free_slots.get()
+        finally:
+            self._num_waiting -= 1
+
+        try:
+            return await self._convert(slot, file_content, target)
+        finally:
+            self._free_slots.put_nowait(slot)
+
+    async def _convert(
+        self, slot: LibreOfficeSlot, file_content: FileContent, target: str
+    ) -> bytes:
+        await self._check(slot)
+
+        input_path = slot.io_dir / "document.doc"
+        output_path = slot.io_dir / f"document.{target}"
+        await asyncio.to_thread(_write_file, input_path, file_content)
+        try:
+            logger.debug(f"Start conversion to {target} in slot {slot.slot_no}")
+            try:
+                await self._run(
+                    slot,
+                    "--convert-to",
+                    target,
+                    "--outdir",
+                    str(slot.io_dir),
+                    str(input_path),
+                )
+            except asyncio.TimeoutError:
+                raise DocConversionError(
+                    f"Conversion to {target} timed out after {self.timeout}s"
+                )
+            if not output_path.exists():
+                raise DocConversionError(f"LibreOffice produced no {target} file")
+            logger.debug(f"Finish conversion to {target} in slot {slot.slot_no}")
+            return await asyncio.to_thread(output_path.read_bytes)
+        finally:
+            for path in (input_path, output_path):
+                path.unlink(missing_ok=True)
@@ -0,0 +1,298 @@
+"""
+File: docx_stream.py
+Desc: page by page extraction of .docx files, streaming word/document.xml
+with an incremental parser and reading images from the zip when their page
+is done
+"""
+
+import hashlib
+import io
+import posixpath
+import zipfile
+from typing import BinaryIO, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from lxml import etree
+
+from src.models import FileImage, FileText
+
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+R_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+OFFICE_DOCUMENT = R_NS + "/officeDocument"
+IMAGE = R_NS + "/image"
+
+W_BODY = f"{{{W_NS}}}body"
+W_P = f"{{{W_NS}}}p"
+W_TBL = f"{{{W_NS}}}tbl"
+W_TR = f"{{{W_NS}}}tr"
+W_TC = f"{{{W_NS}}}tc"
+W_BR = f"{{{W_NS}}}br"
+W_TYPE = f"{{{W_NS}}}type"
+W_VAL = f"{{{W_NS}}}val"
+W_LAST_RENDERED_PAGE_BREAK = f"{{{W_NS}}}lastRenderedPageBreak"
+
+# Text equivalent of the run content, as python-docx `Run.text`
+RUN_TEXT = {
+    f"{{{W_NS}}}tab": "\t",
+    f"{{{W_NS}}}ptab": "\t",
+    f"{{{W_NS}}}cr": "\n",
+    f"{{{W_NS}}}noBreakHyphen": "-",
+}
+
+NAMESPACES = {
+    "w": W_NS,
+    "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
+    "v": "urn:schemas-microsoft-com:vml",
+    "r": R_NS,
+}
+RUNS = etree.XPath("w:r | w:hyperlink/w:r", namespaces=NAMESPACES)
+IMAGE_IDS = etree.XPath(
+    ".//a:blip/@r:embed | .//v:imagedata/@r:id", namespaces=NAMESPACES
+)
+PAGE_BREAK_BEFORE = etree.XPath("w:pPr/w:pageBreakBefore", namespaces=NAMESPACES)
+SECTION_BREAK = etree.XPath("w:pPr/w:sectPr", namespaces=NAMESPACES)
+GRID_BEFORE = etree.XPath("w:trPr/w:gridBefore/@w:val", namespaces=NAMESPACES)
+GRID_SPAN = etree.XPath("w:tcPr/w:gridSpan/@w:val", namespaces=NAMESPACES)
+V_MERGE = etree.XPath("w:tcPr/w:vMerge", namespaces=NAMESPACES)
+CELL_PARAGRAPHS = etree.XPath("w:p", namespaces=NAMESPACES)
+
+# Splits the text of a paragraph where a page starts
+PAGE_BREAK = object()
+
+
+def _read_rels(docx: zipfile.ZipFile, part_name: str) -> Dict[str, Tuple[str, str]]:
+    """Relationships of a part: id -> (type, part name of the internal target)"""
+    directory, file_name = posixpath.split(part_name)
+    rels_name = posixpath.join(directory, "_rels", file_name + ".rels")
+    if rels_name not in docx.NameToInfo:
+        return {}
+    rels = {}
+    for rel in etree.fromstring(docx.read(rels_name)):
+        if rel.get("TargetMode") == "External":
+            continue
+        target = rel.get("Target", "")
+        if target.startswith("/"):
+            target = target[1:]
+        else:
+            target = posixpath.normpath(posixpath.join(directory, target))
+        rels[rel.get("Id")] = (rel.get("Type"), target)
+    return rels
+
+
+def _main_part_name(docx: zipfile.ZipFile) -> str:
+    for rel_type, part_name in _read_rels(docx, "").values():
+        if rel_type == OFFICE_DOCUMENT:
+            return part_name
+    return "word/document.xml"
+
+
+def _is_on(element: etree._Element) -> bool:
+    return element.get(W_VAL) not in ("0", "false", "off")
+
+
+def paragraph_segments(p: etree._Element) -> List[object]:
+    """
+    Text of a paragraph, as python-docx `Paragraph.text`, with PAGE_BREAK
+    where a page break occurs: explicit, or rendered by Word when it saved
+    the document
+    """
+    segments: List[object] = []
+    for run in RUNS(p):
+        for child in run:
+            if child.tag == f"{{{W_NS}}}t":
+                segments.append(child.text or "")
+            elif child.tag in RUN_TEXT:
+                segments.append(RUN_TEXT[child.tag])
+            elif child.tag == W_BR:
+                br_type = child.get(W_TYPE, "textWrapping")
+                if br_type == "textWrapping":
+                    segments.append("\n")
+                elif br_type == "page":
+                    segments.append(PAGE_BREAK)
+            elif child.tag == W_LAST_RENDERED_PAGE_BREAK:
+                segments.append(PAGE_BREAK)
+    return segments
+
+
+def _paragraph_text(p: etree._Element) -> str:
+    return "".join(s for s in paragraph_segments(p) if s is not PAGE_BREAK)
+
+
+def table_rows(tbl: etree._Element) -> List[List[str]]:
+    """
+    Cell texts row by row, as python-docx `row.cells`: a cell spanning
+    several grid columns is repeated, a vertically merged cell repeats
+    the text of the cell above
+    """
+    rows = []
+    above: Dict[int, str] = {}
+    for tr in tbl.iterchildren(W_TR):
+        row, texts = [], {}
+        grid_offset = int((GRID_BEFORE(tr) or [0])[0])
+        for tc in tr.iterchildren(W_TC):
+            span = int((GRID_SPAN(tc) or [1])[0])
+            v_merge = V_MERGE(tc)
+            if v_merge and v_merge[0].get(W_VAL, "continue") == "continue":
+                text = above.get(grid_offset, "")
+            else:
+                text = "\n".join(_paragraph_text(p) for p in CELL_PARAGRAPHS(tc))
+            texts[grid_offset] = text
+            row.extend([text] * span)
+            grid_offset += span
+        rows.append(row)
+        above = texts
+    return rows
+
+
+def rows_to_markdown(rows: List[List[str]]) -> str:
+    if not rows:
+        return ""
+    max_cols = max(len(row) for row in rows)
+    rows = [[cell.replace("\n", "<br>").strip() for cell in row] for row in rows]
+    lines = ["| " + " | ".join(rows[0]) + " |"]
+    lines.append("| " + " | ".join(["---"] * max_cols) + " |")
+    lines.extend("| " + " | ".join(row) + " |" for row in rows[1:])
+    return "\n".join(lines)
+
+
+class _PageBuilder:
+    """Content of the current page, and the images already emitted"""
+
+    def __init__(self, docx: zipfile.ZipFile, rels: Dict[str, Tuple[str, str]]):
+        self.docx = docx
+        self.image_rels = {
+            rel_id: part_name
+            for rel_id, (rel_type, part_name) in rels.items()
+            if rel_type == IMAGE
+        }
+        self.page_no = 0
+        self.parts: List[str] = []
+        self.tables: List[FileText] = []
+        self.image_ids: List[str] = []
+        self.num_images = 0
+        self.seen_parts: Set[str] = set()
+        self.seen_digests: Set[bytes] = set()
+
+    def _read_images(self) -> List[FileImage]:
+        """Images of the page, each media part (and content) once"""
+        images = []
+        for rel_id in self.image_ids:
+            part_name = self.image_rels.get(rel_id)
+            if part_name is None or part_name in self.seen_parts:
+                continue
+            self.seen_parts.add(part_name)
+            try:
+                image_content = self.docx.read(part_name)
+            except KeyError:
+                continue
+            digest = hashlib.sha1(image_content).digest()
+            if digest in self.seen_digests:
+                continue
+            self.seen_digests.add(digest)
+            images.append(
+                FileImage(
+                    page_no=self.page_no,
+                    image_no=self.num_images,
+                    image_content=image_content,
+                )
+            )
+            self.num_images += 1
+        return images
+
+    def flush(self) -> Optional[Dict]:
+        """Output of the current page (None if empty), then start the next one"""
+        output = None
+        if self.parts or self.image_ids:
+            images = self._read_images()
+            if self.parts or images:
+                texts = [FileText(page_no=self.page_no, text="\n".join(self.parts))]
+                output = {
+                    "page_no": self.page_no,
+                    "num_pages": self.page_no + 1,
+                    "texts": texts if self.parts else [],
+                    "images": images,
+                    "tables": self.tables,
+                }
+            self.page_no += 1
+        self.parts, self.tables, self.image_ids = [], [], []
+        return output
+
+
+def docx_iter_pages(file: Union[bytes, BinaryIO]) -> Iterator[Dict]:
+    """
+    Stream a .docx file page by page. Pages end at explicit page breaks,
+    section breaks, and the page breaks Word rendered when it last saved the
+    file; a break starting an empty page is ignored.
+
+    Only the current element of the document body and the current page are
+    in memory: processed elements are dropped from the parsed tree, and the
+    images of a page are read from the zip when it is yielded. An image used
+    several times, or stored in several media parts, is yielded once.
+
+    Args:
+        file: .docx bytes, or a seekable binary file
+
+    Yields:
+        Dict with page_no, num_pages (so far), texts, images and tables of
+        one non-empty page
+    """
+    if isinstance(file, bytes):
+        file = io.BytesIO(file)
+
+    with zipfile.ZipFile(file) as docx:
+        main_part_name = _main_part_name(docx)
+        rels = _read_rels(docx, main_part_name)
+        page = _PageBuilder(docx, rels)
+
+        def page_break():
+            output = page.flush()
+            if output:
+                yield output
+
+        with docx.open(main_part_name) as stream:
+            for _, element in etree.iterparse(
+                stream, events=("end",), tag=(W_P, W_TBL), huge_tree=True
+            ):
+                parent = element.getparent()
+                if parent is None or parent.tag != W_BODY:
+                    continue
+
+                if element.tag == W_P:
+                    page_break_before = PAGE_BREAK_BEFORE(element)
+                    if page_break_before and _is_on(page_break_before[0]):
+                        yield from page_break()
+
+                    pieces: List[List[str]] = [[]]
+                    for segment in paragraph_segments(element):
+                        if segment is PAGE_BREAK:
+                            pieces.append([])
+                        else:
+                            pieces[-1].append(segment)
+                    for piece_no, piece in enumerate(pieces):
+                        if piece_no:
+                            yield from page_break()
+                        paragraph = "".join(piece).strip()
+                        if paragraph:
+                            page.parts.append(paragraph)
+                    page.image_ids.extend(IMAGE_IDS(element))
+
+                    if SECTION_BREAK(element):
+                        yield from page_break()
+                else:
+                    table_md = rows_to_markdown(table_rows(element))
+                    if table_md:
+                        page.parts.append(table_md)
+                        page.tables.append(
+                            FileText(page_no=page.page_no, text=table_md)
+                        )
+                    page.image_ids.extend(IMAGE_IDS(element))
+
+                # Drop the processed elements from the tree
+                element.clear()
+                while element.getprevious() is not None:
+                    del parent[0]
+
+        # Images of the document not placed in its body
+        page.image_ids.extend(page.image_rels)
+        output = page.flush()
+        if output:
+            yield output
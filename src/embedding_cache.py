@@ -0,0 +1,121 @@
+"""
+File: embedding_cache.py
+Desc: content-addressed cache of embeddings, keyed by
+(model deployment, dimensions, sha256 of the text)
+"""
+
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from src.sqlite_cache import SQLiteCache
+
+
+@dataclass
+class CacheCounters:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / total if total else 0.0
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache: an in-process LRU in front of a size-bounded
+    SQLite file shared by the workers of the container.
+    Vectors are stored as packed float32 in both tiers, which is what the
+    service returns (a list of floats would take 8 times the memory), and
+    converted to lists when looked up.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        dimensions: int,
+        path: Optional[str] = None,
+        max_bytes: int = 1 << 30,
+        memory_entries: int = 5000,
+    ):
+        """
+        Args:
+            model (str): Embedding model deployment, part of the key
+            dimensions (int): Embedding dimensions, part of the key
+            path (str, optional): SQLite file of the disk tier, memory only if None
+            max_bytes (int): Size bound of the disk tier
+            memory_entries (int): Number of vectors kept in the memory tier
+        """
+        self.model = model
+        self.dimensions = int(dimensions)
+        self.memory_entries = memory_entries
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._disk = (
+            SQLiteCache(path, max_bytes=max_bytes, table="embeddings") if path else None
+        )
+        self.counters = CacheCounters()
+        self._lock = threading.Lock()  # Lookups run on worker threads
+
+    def key(self, text: str) -> str:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{self.model}|{self.dimensions}|{text_hash}"
+
+    def _remember(self, key: str, packed: bytes) -> None:
+        self._memory[key] = packed
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys: List[str]) -> Dict[str, list]:
+        """
+        Look keys up in memory then on disk.
+        Blocking on the disk tier: call it off the event loop.
+        """
+        unique_keys = list(dict.fromkeys(keys))
+        found: Dict[str, list] = {}
+        missing = []
+        with self._lock:
+            for key in unique_keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = array("f", self._memory[key]).tolist()
+                    self.counters.memory_hits += 1
+                else:
+                    missing.append(key)
+
+        if missing and self._disk:
+            from_disk = self._disk.get_many(missing)
+            with self._lock:
+                for key, packed in from_disk.items():
+                    found[key] = array("f", packed).tolist()
+                    self._remember(key, packed)
+                    self.counters.disk_hits += 1
+
+        with self._lock:
+            self.counters.misses += len(unique_keys) - len(found)
+        return found
+
+    def set_many(self, items: Dict[str, list]) -> None:
+        """Store embeddings in both tiers. Blocking on the disk tier."""
+        packed = {
+            key: array("f", embedding).tobytes() for key, embedding in items.items()
+        }
+        with self._lock:
+            for key, value in packed.items():
+                self._remember(key, value)
+        if self._disk:
+            self._disk.set_many(packed.items())
+
+    def log_counters(self) -> None:
+        c = self.counters
+        logger.info(
+            f"Embedding cache: {c.memory_hits} memory hits, {c.disk_hits} disk hits, "
+            f"{c.misses} misses (hit rate {c.hit_rate:.1%})"
+        )
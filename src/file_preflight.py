@@ -0,0 +1,198 @@
+"""
+File: file_preflight.py
+Desc: decide whether (and how) to process a stored file from a few ranged
+reads, before downloading it: type, size and estimated number of pages
+"""
+
+import re
+import struct
+import zlib
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from src.file_utils import detect_file_type, zip_file_type
+
+# File types the pipeline extracts
+SUPPORTED_FILE_TYPES = ("pdf", "docx", "doc", "txt", "jpg", "jpeg", "png")
+
+# Bytes read from the start of the file, and from the end of a ZIP file (its
+# central directory usually fits, otherwise it is read with one more request)
+HEAD_BYTES = 64 * 1024
+ZIP_TAIL_BYTES = 64 * 1024 + 22
+# Larger central directories are not read: the file is not a document
+MAX_ZIP_DIRECTORY_BYTES = 8 * 1024 * 1024
+# docx metadata part holding the number of pages when the file was saved
+DOCX_APP_PROPERTIES = "docProps/app.xml"
+
+ZIP_SIGNATURE = b"PK\x03\x04"
+ZIP_END = b"PK\x05\x06"
+ZIP64_END_LOCATOR = b"PK\x06\x07"
+ZIP64_END = b"PK\x06\x06"
+ZIP_DIRECTORY_ENTRY = b"PK\x01\x02"
+
+PDF_LINEARIZED_PAGES = re.compile(rb"/Linearized\b.*?/N\s+(\d+)", re.DOTALL)
+PDF_PAGE_TREE_COUNT = re.compile(
+    rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b"
+)
+DOCX_PAGES = re.compile(rb"<Pages>(\d+)</Pages>")
+
+# read_range(offset, length) -> bytes, e.g. a ranged GET of a blob
+RangeReader = Callable[[int, int], bytes]
+
+
+class PreflightError(ValueError):
+    """The file is rejected before being downloaded, retrying will not help"""
+
+
+@dataclass
+class FilePreflight:
+    file_type: str
+    size: int
+    # Estimated from metadata, None if the file does not tell cheaply
+    num_pages: Optional[int] = None
+    # Version of the stored file sniffed, when the storage tells it
+    etag: Optional[str] = None
+
+
+@dataclass
+class _ZipEntry:
+    name: str
+    method: int
+    compressed_size: int
+    header_offset: int
+
+
+def _zip_directory(read_range: RangeReader, size: int) -> Optional[List[_ZipEntry]]:
+    """Entries of the central directory of a ZIP file, None if unreadable"""
+    tail_offset = max(0, size - ZIP_TAIL_BYTES)
+    tail = read_range(tail_offset, size - tail_offset)
+    end = tail.rfind(ZIP_END)
+    if end < 0 or len(tail) < end + 22:
+        return None
+    directory_size, directory_offset = struct.unpack("<II", tail[end + 12 : end + 20])
+
+    if directory_offset == 0xFFFFFFFF and end >= 20:
+        locator = tail[end - 20 : end]
+        if not locator.startswith(ZIP64_END_LOCATOR):
+            return None
+        (zip64_end_offset,) = struct.unpack("<Q", locator[8:16])
+        zip64_end = read_range(zip64_end_offset, 56)
+        if not zip64_end.startswith(ZIP64_END):
+            return None
+        directory_size, directory_offset = struct.unpack("<QQ", zip64_end[40:56])
+
+    if directory_size > MAX_ZIP_DIRECTORY_BYTES:
+        return None
+    if directory_offset >= tail_offset:
+        start = directory_offset - tail_offset
+        directory = tail[start : start + directory_size]
+    else:
+        directory = read_range(directory_offset, directory_size)
+
+    entries = []
+    position = 0
+    while directory.startswith(ZIP_DIRECTORY_ENTRY, position):
+        method, compressed_size = struct.unpack(
+            "<H8xI", directory[position + 10 : position + 24]
+        )
+        name_length, extra_length, comment_length = struct.unpack(
+            "<HHH", directory[position + 28 : position + 34]
+        )
+        (header_offset,) = struct.unpack("<I", directory[position + 42 : position + 46])
+        name = directory[position + 46 : position + 46 + name_length]
+        entries.append(
+            _ZipEntry(
+                name.decode("utf-8", errors="replace"),
+                method,
+                compressed_size,
+                header_offset,
+            )
+        )
+        position += 46 + name_length + extra_length + comment_length
+    return entries
+
+
+def _read_zip_member(read_range: RangeReader, entry: _ZipEntry) -> Optional[bytes]:
+    """Content of a small stored or deflated member, None if not readable"""
+    if entry.compressed_size == 0xFFFFFFFF or entry.method not in (0, 8):
+        return None
+    # The local header has the name again and its own extra field
+    data = read_range(entry.header_offset, 30 + 1024 + entry.compressed_size)
+    if not data.startswith(ZIP_SIGNATURE):
+        return None
+    name_length, extra_length = struct.unpack("<HH", data[26:30])
+    start = 30 + name_length + extra_length
+    compressed = data[start : start + entry.compressed_size]
+    try:
+        return compressed if entry.method == 0 else zlib.decompress(compressed, -15)
+    except zlib.error:
+        return None
+
+
+def _pdf_num_pages(read_range: RangeReader, head: bytes, size: int) -> Optional[int]:
+    """
+    Page count of a linearized PDF (first bytes), or of the page tree when it
+    is written uncompressed at the end of the file, as most writers do
+    """
+    match = PDF_LINEARIZED_PAGES.search(head[:1024])
+    if match:
+        return int(match.group(1))
+    tail_offset = max(0, size - HEAD_BYTES)
+    tail = (
+        head[tail_offset:]
+        if size <= len(head)
+        else read_range(tail_offset, size - tail_offset)
+    )
+    counts = [int(a or b) for a, b in PDF_PAGE_TREE_COUNT.findall(tail)]
+    return max(counts) if counts else None
+
+
+def preflight_file(
+    read_range: RangeReader,
+    size: int,
+    max_bytes: int = 0,
+    max_pages: int = 0,
+) -> FilePreflight:
+    """
+    Sniff a stored file from its first bytes (and for ZIP files, from the
+    central directory at the end), without downloading it.
+
+    Args:
+        read_range: Reads `length` bytes of the file from `offset`
+        size: Size of the file in bytes
+        max_bytes: Files larger than this are rejected (0: no limit)
+        max_pages: Files with more estimated pages are rejected (0: no limit)
+
+    Raises:
+        PreflightError: Empty, too large, unsupported, or too many pages
+    """
+    if size == 0:
+        raise PreflightError("File is empty")
+    if max_bytes and size > max_bytes:
+        raise PreflightError(f"File of {size} bytes exceeds the limit of {max_bytes}")
+
+    head = read_range(0, min(size, HEAD_BYTES))
+    num_pages = None
+    if head.startswith(ZIP_SIGNATURE):
+        entries = _zip_directory(read_range, size)
+        names = [entry.name for entry in entries or []]
+        file_type = zip_file_type(names)
+        if file_type == "docx":
+            app = next((e for e in entries if e.name == DOCX_APP_PROPERTIES), None)
+            app_xml = _read_zip_member(read_range, app) if app else None
+            match = DOCX_PAGES.search(app_xml or b"")
+            num_pages = int(match.group(1)) if match else None
+    else:
+        file_type = detect_file_type(head)
+        if file_type == "pdf":
+            num_pages = _pdf_num_pages(read_range, head, size)
+        elif file_type in ("jpg", "jpeg", "png"):
+            num_pages = 1
+
+    if file_type not in SUPPORTED_FILE_TYPES:
+        raise PreflightError(f"File type {file_type} not supported")
+    if max_pages and num_pages and num_pages > max_pages:
+        raise PreflightError(
+            f"File of about {num_pages} pages exceeds the limit of {max_pages}"
+        )
+    return FilePreflight(file_type=file_type, size=size, num_pages=num_pages)
@@ -1,10 +1,13 @@
+import asyncio
+import contextlib
 import random
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
 from loguru import logger
 from openai import AsyncAzureOpenAI
 from pydantic import BaseModel
 
+from src.metrics import count_vision_call
 from src.models import FileImage
 
 
@@ -13,10 +16,18 @@ class FileSummaryResponse(BaseModel):
 
 
 class FileSummarizer:
-    def __init__(self, client: AsyncAzureOpenAI, config: Any, prompt: str):
+    def __init__(
+        self,
+        client: AsyncAzureOpenAI,
+        config: Any,
+        prompt: str,
+        concurrency_limit: Optional[asyncio.Semaphore] = None,
+    ):
         self.client = client
         self.config = config
         self.prompt = prompt
+        # Shared with the other model calls of the worker, if given
+        self.concurrency_limit = concurrency_limit or contextlib.nullcontext()
         self.max_samples = 5  # How many text and image items to sample (each)
 
     def _sample_items(self, items: List[str], max_samples: int) -> List[str]:
@@ -31,7 +42,7 @@ class FileSummarizer:
         return [items[0]] + random.sample(items[1:], (max_samples - 1))
 
     def _create_message_content(
-        self, images: List[str], texts: List[str]
+        self, images: List[FileImage], texts: List[str]
     ) -> List[Dict]:
         """
         Create the message content for the API call.
@@ -43,9 +54,7 @@ class FileSummarizer:
             content.append(
                 {
                     "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{image.image_base64}"
-                    },
+                    "image_url": {"url": image.data_url, "detail": image.detail},
                 }
             )
 
@@ -63,7 +72,7 @@ class FileSummarizer:
         Run the summarization process with sampling and validation.
 
         Args:
-            images: List of base64 encoded image strings
+            images: List of images
             texts: List of text strings to summarize
             temperature: Optional temperature parameter for the API call
 
@@ -87,16 +96,19 @@ class FileSummarizer:
             f"Creating summary with {len(sampled_texts)} chunks and {len(sampled_images)} images ..."
         )
 
-        # Create API call content
-        message_content = self._create_message_content(sampled_images, sampled_texts)
-
         # Make API call
-        response = await self.client.beta.chat.completions.parse(
-            model=self.config.MODEL_DEPLOYMENT,
-            temperature=temperature,
-            response_format=FileSummaryResponse,
-            messages=[{"role": "user", "content": message_content}],
-        )
+        async with self.concurrency_limit:
+            # Create API call content, base64 images only exist during the request
+            message_content = await asyncio.to_thread(
+                self._create_message_content, sampled_images, sampled_texts
+            )
+            with count_vision_call("summary"):
+                response = await self.client.beta.chat.completions.parse(
+                    model=self.config.MODEL_DEPLOYMENT,
+                    temperature=temperature,
+                    response_format=FileSummaryResponse,
+                    messages=[{"role": "user", "content": message_content}],
+                )
 
         # Parse response
         data = response.choices[0].message.parsed
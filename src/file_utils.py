@@ -1,20 +1,32 @@
 import hashlib
+import shutil
 from io import BytesIO
+from typing import BinaryIO, Iterable, Optional, Union
 from zipfile import ZipFile
 
 import chardet
 
+# Chunks in which file objects are hashed and copied
+COPY_CHUNK_BYTES = 1024 * 1024
+
+# A file content: bytes, or a seekable binary file (e.g. a spooled download)
+FileContent = Union[bytes, BinaryIO]
+
 
 def create_file_metadata_from_bytes(
-    file_bytes: bytes, file_name: str, title=None
+    file_bytes: FileContent,
+    file_name: str,
+    title=None,
+    file_hash: Optional[str] = None,
 ) -> dict:
     """
     Create metadata for a document file using the file contents in bytes.
 
     Parameters:
-    - file_bytes (bytes): The bytes content of the document file.
+    - file_bytes (bytes): The bytes content of the document file, or a seekable binary file.
     - file_name (str): The file name of the document.
     - title (str, optional): The title of the document. If not provided, it will be inferred from the file_name.
+    - file_hash (str, optional): SHA-256 of the contents if already known, e.g. computed while downloading.
 
     Returns:
     - dict: Metadata dictionary containing the document title, file name, and SHA-256 hash.
@@ -22,23 +34,88 @@ def create_file_metadata_from_bytes(
     title = file_name
 
     # Calculate SHA-256 hash to uniquely identify the file
-    sha256_hash = hashlib.sha256()
-    sha256_hash.update(file_bytes)
-    file_hash = sha256_hash.hexdigest()
+    file_hash = file_hash or file_sha256(file_bytes)
 
     return {"title": title, "file": file_name, "file_hash": file_hash}
 
 
-def detect_file_type(file_bytes: bytes) -> str:
+def file_sha256(file_bytes: FileContent) -> str:
+    """SHA-256 hex digest of the file contents, the `file_hash` of its metadata"""
+    sha256_hash = hashlib.sha256()
+    if isinstance(file_bytes, bytes):
+        sha256_hash.update(file_bytes)
+    else:
+        file_bytes.seek(0)
+        for chunk in iter(lambda: file_bytes.read(COPY_CHUNK_BYTES), b""):
+            sha256_hash.update(chunk)
+    return sha256_hash.hexdigest()
+
+
+def read_file_content(file_content: FileContent) -> bytes:
+    """All the bytes of a file content, for parsers that need them in memory"""
+    if isinstance(file_content, bytes):
+        return file_content
+    file_content.seek(0)
+    return file_content.read()
+
+
+def copy_file_content(file_content: FileContent, destination: BinaryIO) -> None:
+    """Write a file content to a binary file, in chunks for file objects"""
+    if isinstance(file_content, bytes):
+        destination.write(file_content)
+    else:
+        file_content.seek(0)
+        shutil.copyfileobj(file_content, destination, COPY_CHUNK_BYTES)
+
+
+# Leading bytes of the image formats accepted by the vision models
+IMAGE_SIGNATURES = {
+    b"\xff\xd8\xff": "image/jpeg",
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"GIF87a": "image/gif",
+    b"GIF89a": "image/gif",
+}
+
+
+def image_mime_type(image_bytes: bytes, default: str = "image/png") -> str:
+    """MIME type of an image from its first bytes (12 are enough)"""
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, mime_type in IMAGE_SIGNATURES.items():
+        if image_bytes.startswith(signature):
+            return mime_type
+    return default
+
+
+def zip_file_type(names: Iterable[str]) -> str:
+    """Type of a ZIP based file from the names of its members"""
+    names = set(names)
+    if "word/document.xml" in names:
+        return "docx"
+    if "xl/workbook.xml" in names:
+        return "xlsx"
+    return "unknown"
+
+
+def detect_file_type(file_bytes: FileContent) -> str:
     """
     Detect the file type (PDF, DOC, DOCX, JPG/JPEG, PNG, CSV, XLSX, TXT) with enhanced validation.
 
     Args:
-        file_bytes (bytes): File content as bytes.
+        file_bytes (bytes): File content as bytes, or a seekable binary file
+            (only its head is read, and the ZIP directory of ZIP files).
 
     Returns:
         str: 'pdf', 'doc', 'docx', 'jpg', 'png', 'csv', 'xlsx', 'txt', or 'unknown'.
     """
+    if isinstance(file_bytes, bytes):
+        zip_file = BytesIO(file_bytes)
+    else:
+        zip_file = file_bytes
+        zip_file.seek(0)
+        file_bytes = zip_file.read(1024)
+        zip_file.seek(0)
+
     # Basic signature check
     if len(file_bytes) < 4:  # We only need 4 bytes for JPEG
         return "unknown"
@@ -77,12 +154,10 @@ def detect_file_type(file_bytes: bytes) -> str:
     # DOCX/XLSX (ZIP) signature
     if header.startswith(bytes([0x50, 0x4B, 0x03, 0x04])):
         try:
-            with ZipFile(BytesIO(file_bytes)) as zf:
-                filelist = zf.namelist()
-                if "word/document.xml" in filelist:
-                    return "docx"
-                if "xl/workbook.xml" in filelist:
-                    return "xlsx"
+            with ZipFile(zip_file) as zf:
+                file_type = zip_file_type(zf.namelist())
+                if file_type != "unknown":
+                    return file_type
         except:
             pass
 
@@ -1,12 +1,16 @@
+import asyncio
+
 from openai import AsyncAzureOpenAI
 
 from src.azure_container_client import AzureContainerClient
+from src.docx_parsing.doc_conversion import LibreOfficePool
 from src.file_summarizer import FileSummarizer
 from src.get_vector_stores import get_vector_stores
+from src.image_description_cache import ImageDescriptionCache
 from src.image_descriptor import ImageDescriptor
+from src.image_utils.normalization import ImageNormalizer
 from src.pipeline import Pipeline
 from src.splitters import SimplePageTextSplitter
-from src.vector_stores import MyAzureOpenAIEmbeddings
 
 
 def get_pipeline(
@@ -17,6 +21,8 @@ def get_pipeline(
 ) -> Pipeline:
 
     vector_stores = get_vector_stores(config)
+    # One limit for all the model calls of the worker
+    llm_calls = asyncio.Semaphore(config.LLM_CONCURRENCY)
     image_vector_store = vector_stores["image_vector_store"]
     summary_vector_store = vector_stores["summary_vector_store"]
     text_vector_store = vector_stores["text_vector_store"]
@@ -61,6 +67,7 @@ def get_pipeline(
 
         Following is sampled content from a document. Provide a summarization and 10 QA pairs as instructed.
         """,
+        concurrency_limit=llm_calls,
     )
 
     image_descriptor = ImageDescriptor(
@@ -93,19 +100,28 @@ def get_pipeline(
         Submit Your Work: Provide the transcribed text in a clear and organized format.
         By completing this task, you will help capture the detailed content and context of the document.
         """,
+        cache=(
+            ImageDescriptionCache(
+                model=config.MODEL_DEPLOYMENT,
+                path=config.IMAGE_DESCRIPTION_CACHE_PATH,
+                max_bytes=config.IMAGE_DESCRIPTION_CACHE_MAX_BYTES,
+                cache_types=config.IMAGE_DESCRIPTION_CACHE_TYPES,
+                use_perceptual_hash=config.IMAGE_DESCRIPTION_CACHE_PERCEPTUAL,
+            )
+            if config.IMAGE_DESCRIPTION_CACHE_PATH
+            else None
+        ),
+        concurrency_limit=llm_calls,
+        batch_size=config.IMAGE_BATCH_SIZE,
+        batch_max_pixels=config.IMAGE_BATCH_MAX_PIXELS,
+        batch_max_tokens=config.IMAGE_BATCH_MAX_TOKENS,
     )
 
-    my_embedding_function = MyAzureOpenAIEmbeddings(
-        api_key=config.AZURE_OPENAI_API_KEY,
-        api_version=config.AZURE_OPENAI_API_VERSION,
-        azure_endpoint=config.AZURE_OPENAI_ENDPOINT,
-        model=config.AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
-        dimensions=config.AZURE_OPENAI_EMBEDDING_DIMENSIONS,
-    ).embed_query
+    my_embedding_function = vector_stores["embedding_function"]
 
     text_splitter = SimplePageTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
+        chunk_size=config.CHUNK_SIZE,
+        chunk_overlap=config.CHUNK_OVERLAP,
         length_function=len,
         separators=[
             "```Markdown",
@@ -126,6 +142,8 @@ def get_pipeline(
             " ",  # Spaces
             "\n",  # Line breaks
         ],
+        length_unit=config.CHUNK_LENGTH_UNIT,
+        encoding_name=config.TOKENIZER_ENCODING,
     )
 
     pipeline = Pipeline(
@@ -138,5 +156,32 @@ def get_pipeline(
         file_summarizer=file_summarizer,
         image_container_client=image_container_client,
         pii_service_endpoint=pii_service_endpoint,
+        pdf_extraction_mode=config.PDF_EXTRACTION_MODE,
+        pdf_extraction_workers=config.PDF_EXTRACTION_WORKERS,
+        pdf_process_min_pages=config.PDF_PROCESS_MIN_PAGES,
+        pdf_image_mode=config.PDF_IMAGE_MODE,
+        pdf_table_settings=config.PDF_TABLE_SETTINGS or None,
+        page_window=config.PAGE_WINDOW,
+        index_batch_size=config.INDEX_BATCH_SIZE,
+        parsing_concurrency=config.PARSING_CONCURRENCY,
+        image_normalizer=(
+            ImageNormalizer(
+                max_side=config.IMAGE_MAX_SIDE,
+                output_format=config.IMAGE_OUTPUT_FORMAT,
+                quality=config.IMAGE_QUALITY,
+                trim_margins=config.IMAGE_TRIM_MARGINS,
+                detail=config.IMAGE_DETAIL,
+            )
+            if config.IMAGE_NORMALIZATION
+            else None
+        ),
+        image_spill_bytes=config.IMAGE_SPILL_BYTES,
+        image_spill_dir=config.IMAGE_SPILL_DIR,
+        doc_converter=LibreOfficePool(
+            size=config.DOC_CONVERSION_WORKERS,
+            max_queued=config.DOC_CONVERSION_MAX_QUEUED,
+            timeout=config.DOC_CONVERSION_TIMEOUT,
+            binary=config.LIBREOFFICE_BINARY,
+        ),
     )
     return pipeline
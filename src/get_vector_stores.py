@@ -2,9 +2,12 @@
 Create (or get existing) text and image Azure search indexes
 """
 
+import asyncio
+
+from src.embedding_cache import EmbeddingCache
 from src.fields import get_fields
 from src.search_objects import get_semantic_search, get_vector_search
-from src.vector_stores import MyAzureOpenAIEmbeddings, MyAzureSearch
+from src.vector_stores import MyAsyncAzureOpenAIEmbeddings, MyAzureSearch
 
 
 def get_vector_stores(config):
@@ -13,13 +16,25 @@ def get_vector_stores(config):
     """
 
     fields = get_fields(config.AZURE_OPENAI_EMBEDDING_DIMENSIONS)
-    my_embedding_function = MyAzureOpenAIEmbeddings(
+    # One engine for all stores, so the concurrency limit is shared
+    my_embedding_function = MyAsyncAzureOpenAIEmbeddings(
         api_key=config.AZURE_OPENAI_API_KEY,
         api_version=config.AZURE_OPENAI_API_VERSION,
         azure_endpoint=config.AZURE_OPENAI_ENDPOINT,
         model=config.AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
         dimensions=config.AZURE_OPENAI_EMBEDDING_DIMENSIONS,
-    ).embed_query
+        max_tokens_per_request=config.EMBEDDING_MAX_TOKENS_PER_REQUEST,
+        max_inputs_per_request=config.EMBEDDING_MAX_INPUTS_PER_REQUEST,
+        max_concurrency=config.EMBEDDING_CONCURRENCY,
+        max_retries=config.EMBEDDING_MAX_RETRIES,
+        cache=EmbeddingCache(
+            model=config.AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+            dimensions=config.AZURE_OPENAI_EMBEDDING_DIMENSIONS,
+            path=config.EMBEDDING_CACHE_PATH or None,
+            max_bytes=config.EMBEDDING_CACHE_MAX_BYTES,
+            memory_entries=config.EMBEDDING_CACHE_MEMORY_ENTRIES,
+        ),
+    ).embed_documents
 
     vector_search = get_vector_search(
         algorithm_configuration_name=config.ALGORITHM_CONFIGURATION_NAME,
@@ -36,6 +51,14 @@ def get_vector_stores(config):
         field_name="chunk",
     )
 
+    upload_options = dict(
+        max_batch_documents=config.SEARCH_UPLOAD_MAX_DOCUMENTS,
+        max_batch_bytes=config.SEARCH_UPLOAD_MAX_BYTES,
+        upload_retries=config.SEARCH_UPLOAD_RETRIES,
+        # One limit for the three indexes of the worker
+        upload_semaphore=asyncio.Semaphore(config.SEARCH_UPLOAD_CONCURRENCY),
+    )
+
     summary_vector_store = MyAzureSearch(
         azure_search_endpoint=config.AZURE_SEARCH_SERVICE_ENDPOINT,
         azure_search_key=config.AZURE_SEARCH_ADMIN_KEY,
@@ -44,6 +67,7 @@ def get_vector_stores(config):
         fields=fields,
         vector_search=vector_search,
         semantic_search=semantic_search,
+        **upload_options,
     )
 
     text_vector_store = MyAzureSearch(
@@ -54,6 +78,7 @@ def get_vector_stores(config):
         fields=fields,
         vector_search=vector_search,
         semantic_search=semantic_search,
+        **upload_options,
     )
 
     image_vector_store = MyAzureSearch(
@@ -64,10 +89,12 @@ def get_vector_stores(config):
         fields=fields,
         vector_search=vector_search,
         semantic_search=semantic_search,
+        **upload_options,
     )
 
     return {
         "summary_vector_store": summary_vector_store,
         "text_vector_store": text_vector_store,
         "image_vector_store": image_vector_store,
+        "embedding_function": my_embedding_function,
     }
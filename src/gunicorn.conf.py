@@ -1,12 +1,19 @@
 import multiprocessing
 import os
+import shutil
+import tempfile
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-max_requests = 1000
-max_requests_jitter = 50
+# Recycling a worker cancels the files its ingestion workers are processing:
+# they restart from scratch on another worker, and the chunks they already
+# indexed stay until then. Every request counts, /metrics scrapes included,
+# so workers are only recycled when bulk ingestion is disabled.
+if int(os.getenv("INGESTION_WORKERS", 16)) == 0:
+    max_requests = 1000
+    max_requests_jitter = 50
 log_file = "-"
 bind = "0.0.0.0:3100"
 
@@ -14,7 +21,27 @@ if not os.getenv("RUNNING_IN_PRODUCTION"):
     reload = True
 
 num_cpus = multiprocessing.cpu_count()
-workers = (num_cpus * 2) + 1
+workers = int(os.getenv("GUNICORN_WORKERS", (num_cpus * 2) + 1))
+# Read by src.config to split the per-container limits between the workers
+os.environ["GUNICORN_WORKERS"] = str(workers)
 worker_class = "uvicorn.workers.UvicornWorker"
 
 timeout = int(os.getenv("GUNICORN_TIMEOUT", 600))
+
+# Workers write their metrics there, /metrics aggregates them. Set before
+# the workers import prometheus_client, emptied when the server starts.
+prometheus_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR",
+    os.path.join(tempfile.gettempdir(), "prometheus_multiproc"),
+)
+
+
+def on_starting(server):
+    shutil.rmtree(prometheus_dir, ignore_errors=True)
+    os.makedirs(prometheus_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,175 @@
+"""
+File: image_description_cache.py
+Desc: cache of image descriptions keyed by a hash of the image bytes and of
+the prompt, so recurring images (logos, banners, icons) are described once
+"""
+
+import hashlib
+import io
+from typing import Iterable, List, Optional
+
+from loguru import logger
+from PIL import Image
+
+from src.embedding_cache import CacheCounters
+from src.image_descriptor import ImageDescription
+from src.sqlite_cache import SQLiteCache
+
+# Verdicts safe to reuse for images that only look alike
+PERCEPTUAL_HASH_TYPES = ("icon", "shape", "logo")
+# Verdicts with a blank description, reused whatever the document. The others
+# are written with the document summary as context and keyed by it too.
+CONTEXT_FREE_TYPES = ("icon", "shape", "logo")
+
+
+def _short_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def difference_hash(image_bytes: bytes, hash_size: int = 8) -> Optional[str]:
+    """
+    Perceptual difference hash: survives re-encoding and rescaling.
+    Returns None if the bytes cannot be decoded as an image.
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            pixels = list(img.convert("L").resize((hash_size + 1, hash_size)).getdata())
+    except Exception:
+        return None
+
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+class ImageDescriptionCache:
+    """
+    Image descriptions stored in a local SQLite file shared by the workers.
+
+    Lookups match the sha256 of the image bytes and the prompt. Picture and
+    information descriptions also match the document summary they were
+    written with. With `use_perceptual_hash`, images that only look alike
+    (same difference hash) also match, but only for icon, shape and logo
+    verdicts.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        path: str,
+        max_bytes: int = 1 << 28,
+        cache_types: Iterable[str] = (
+            "icon",
+            "shape",
+            "logo",
+            "picture",
+            "information",
+        ),
+        use_perceptual_hash: bool = False,
+    ):
+        """
+        Args:
+            model (str): Chat model deployment, part of the key
+            path (str): SQLite file
+            max_bytes (int): Size bound of the stored descriptions
+            cache_types (Iterable[str]): Image types whose descriptions are stored
+            use_perceptual_hash (bool): Also match re-encoded images
+        """
+        self.model = model
+        self.cache_types = set(cache_types)
+        self.use_perceptual_hash = use_perceptual_hash
+        self._store = SQLiteCache(path, max_bytes=max_bytes, table="image_descriptions")
+        self.counters = CacheCounters()
+
+    def _keys(self, image_bytes: bytes, prompt: str, summary: str) -> dict:
+        return self._keys_of_prompts(image_bytes, [prompt], summary)[0]
+
+    def _keys_of_prompts(
+        self, image_bytes: bytes, prompts: List[str], summary: str
+    ) -> List[dict]:
+        """Keys of the image for each prompt, hashing the image once"""
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        dhash = difference_hash(image_bytes) if self.use_perceptual_hash else None
+        all_keys = []
+        for prompt in prompts:
+            prefix = f"{self.model}|{_short_hash(prompt)}"
+            exact = f"{prefix}|sha256|{image_hash}"
+            keys = {"exact": exact, "in_context": f"{exact}|{_short_hash(summary)}"}
+            if dhash:
+                keys["perceptual"] = f"{prefix}|dhash|{dhash}"
+            all_keys.append(keys)
+        return all_keys
+
+    def get(
+        self,
+        image_bytes: bytes,
+        prompt: str,
+        summary: str,
+        other_prompts: Iterable[str] = (),
+    ) -> Optional[ImageDescription]:
+        """
+        Return the cached description of an image, described with this prompt
+        and document summary. Blocking: call it off the event loop.
+
+        Args:
+            other_prompts: Prompts whose descriptions are accepted too, when
+                none was stored for `prompt`
+        """
+        all_keys = self._keys_of_prompts(image_bytes, [prompt, *other_prompts], summary)
+        found = self._store.get_many(key for keys in all_keys for key in keys.values())
+
+        for keys in all_keys:
+            description = self._match(keys, found)
+            if description:
+                self.counters.disk_hits += 1
+                return description
+
+        self.counters.misses += 1
+        return None
+
+    @staticmethod
+    def _match(keys: dict, found: dict) -> Optional[ImageDescription]:
+        """The description found under the keys of one prompt, if any"""
+        for key in ("exact", "in_context"):
+            if keys[key] in found:
+                return ImageDescription.model_validate_json(found[keys[key]])
+
+        if "perceptual" in keys and keys["perceptual"] in found:
+            description = ImageDescription.model_validate_json(
+                found[keys["perceptual"]]
+            )
+            if description.image_type in PERCEPTUAL_HASH_TYPES:
+                return description
+        return None
+
+    def set(
+        self,
+        image_bytes: bytes,
+        description: ImageDescription,
+        prompt: str,
+        summary: str,
+    ) -> None:
+        """Store the description of an image. Blocking: call it off the event loop."""
+        if description.image_type not in self.cache_types:
+            return
+
+        keys = self._keys(image_bytes, prompt, summary)
+        value = description.model_dump_json().encode("utf-8")
+        if description.image_type in CONTEXT_FREE_TYPES:
+            items = [(keys["exact"], value)]
+        else:
+            items = [(keys["in_context"], value)]
+        if "perceptual" in keys and description.image_type in PERCEPTUAL_HASH_TYPES:
+            items.append((keys["perceptual"], value))
+        self._store.set_many(items)
+
+    def log_counters(self) -> None:
+        c = self.counters
+        logger.info(
+            f"Image description cache: {c.disk_hits} hits, {c.misses} misses "
+            f"(hit rate {c.hit_rate:.1%})"
+        )
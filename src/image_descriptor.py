@@ -1,60 +1,311 @@
-from typing import Any, Literal
+import asyncio
+import contextlib
+from typing import TYPE_CHECKING, Any, Dict, List, Literal, Optional
 
+from loguru import logger
 from openai import AsyncAzureOpenAI
 from pydantic import BaseModel
 
+from src.image_utils.normalization import image_dimensions, vision_tokens
+from src.metrics import VISION_CALLS, count_vision_call
+from src.models import FileImage
+
+if TYPE_CHECKING:
+    from src.image_description_cache import ImageDescriptionCache
+
+CONTEXT = (
+    "For context, {subject} extracted from  a document having description "
+    "as follows: {summary}"
+)
+# Added to the prompt of a batched request
+BATCH_INSTRUCTION = (
+    "There are {num_images} images, numbered from 0. Describe each of them "
+    "separately, with its number as image_index."
+)
+
 
 class ImageDescription(BaseModel):
     image_type: Literal["icon", "shape", "logo", "picture", "information"]
     image_description: str
 
 
+class IndexedImageDescription(BaseModel):
+    image_index: int
+    image_type: Literal["icon", "shape", "logo", "picture", "information"]
+    image_description: str
+
+
+class ImageDescriptions(BaseModel):
+    """Descriptions of the images of a batched request, by their index"""
+
+    descriptions: List[IndexedImageDescription]
+
+
 class ImageDescriptor:
     """
-    Decribe an image
+    Decribe an image, or several images per request when batching is enabled
     """
 
-    def __init__(self, client: AsyncAzureOpenAI, config: Any, prompt: str):
+    def __init__(
+        self,
+        client: AsyncAzureOpenAI,
+        config: Any,
+        prompt: str,
+        cache: Optional["ImageDescriptionCache"] = None,
+        concurrency_limit: Optional[asyncio.Semaphore] = None,
+        batch_size: int = 1,
+        batch_max_pixels: int = 4_000_000,
+        batch_max_tokens: int = 4000,
+    ):
+        """
+        Args:
+            batch_size: Images described per request by `run_batches`, 1
+                sends one request per image
+            batch_max_pixels: Pixels of the images of one batched request
+            batch_max_tokens: Estimated image tokens of one batched request
+        """
         self.client = client
         self.config = config
         self.prompt = prompt
+        self.cache = cache
+        # Shared with the other model calls of the worker, if given
+        self.concurrency_limit = concurrency_limit or contextlib.nullcontext()
+        self.batch_size = batch_size
+        self.batch_max_pixels = batch_max_pixels
+        self.batch_max_tokens = batch_max_tokens
+        # Cache key of the descriptions of batched requests: what is sent
+        # besides the images and the summary, so that editing the batch
+        # instruction invalidates them, and single lookups never get them
+        self.batch_prompt = "\n".join(
+            (prompt, BATCH_INSTRUCTION, self._context("", num_images=2)["text"])
+        )
+
+    async def _cached(
+        self, image: FileImage, summary: str, batched: bool = False
+    ) -> ImageDescription | None:
+        """
+        Cached description of the image. Batched descriptions are only
+        accepted for `batched` lookups, after the single-image ones.
+        """
+        if not self.cache:
+            return None
+        other_prompts = [self.batch_prompt] if batched else []
+        cached = await asyncio.to_thread(
+            lambda: self.cache.get(
+                image.get_bytes(), self.prompt, summary, other_prompts
+            )
+        )
+        if cached:
+            VISION_CALLS.labels("image_description", "cache_hit").inc()
+        return cached
+
+    async def _store(
+        self,
+        image: FileImage,
+        summary: str,
+        data: ImageDescription | None,
+        prompt: Optional[str] = None,
+    ) -> None:
+        """Store a description under the prompt sent, the single-image one by default"""
+        if self.cache and data:
+            await asyncio.to_thread(
+                lambda: self.cache.set(
+                    image.get_bytes(), data, prompt or self.prompt, summary
+                )
+            )
+
+    def _context(self, summary: str, num_images: int = 1) -> Dict:
+        subject = "the image above is" if num_images == 1 else "the images above are"
+        return {
+            "type": "text",
+            "text": CONTEXT.format(subject=subject, summary=summary),
+        }
+
+    def pack_batches(self, images: List[FileImage]) -> List[List[int]]:
+        """
+        Group consecutive images into batches within the size, pixel and
+        token budgets of one request. Images PIL cannot read, or over budget
+        on their own, get a request of their own. Blocking (reads headers).
+
+        Returns:
+            Positions of the images of each batch
+        """
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        pixels = tokens = 0
+        for position, image in enumerate(images):
+            dimensions = image_dimensions(image)
+            if dimensions is None:
+                batches.append([position])
+                continue
+            width, height = dimensions
+            image_pixels = width * height
+            image_tokens = vision_tokens(width, height, image.detail)
+            if batch and (
+                len(batch) >= self.batch_size
+                or pixels + image_pixels > self.batch_max_pixels
+                or tokens + image_tokens > self.batch_max_tokens
+            ):
+                batches.append(batch)
+                batch, pixels, tokens = [], 0, 0
+            batch.append(position)
+            pixels += image_pixels
+            tokens += image_tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def _describe_batch(
+        self, images: List[FileImage], summary: str, temperature
+    ) -> Dict[int, ImageDescription]:
+        """One request for several images, descriptions by image position"""
+        async with self.concurrency_limit:
+            content: List[Dict] = [
+                {"type": "text", "text": self.prompt},
+                {
+                    "type": "text",
+                    "text": BATCH_INSTRUCTION.format(num_images=len(images)),
+                },
+            ]
+            for index, image in enumerate(images):
+                # Base64 is only built while the request is in flight
+                data_url = await asyncio.to_thread(lambda: image.data_url)
+                content.append({"type": "text", "text": f"Image {index}:"})
+                content.append(
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": data_url, "detail": image.detail},
+                    }
+                )
+            content.append(self._context(summary, len(images)))
+            with count_vision_call("image_description_batch"):
+                response = await self.client.beta.chat.completions.parse(
+                    model=self.config.MODEL_DEPLOYMENT,
+                    response_format=ImageDescriptions,
+                    temperature=temperature,
+                    messages=[{"role": "user", "content": content}],
+                )
+
+        data = response.choices[0].message.parsed
+        if not data:
+            return {}
+        return {
+            item.image_index: ImageDescription(
+                image_type=item.image_type,
+                image_description=item.image_description,
+            )
+            for item in data.descriptions
+            if 0 <= item.image_index < len(images)
+        }
+
+    async def run_batches(
+        self, images: List[FileImage], summary: str, temperature=None
+    ) -> List[ImageDescription | None]:
+        """
+        Describe images with up to `batch_size` images per request, in the
+        order given. Images the batched request fails to describe (error,
+        refusal, missing index) are described one per request.
+        """
+        descriptions: List[ImageDescription | None] = list(
+            await asyncio.gather(
+                *(self._cached(image, summary, batched=True) for image in images)
+            )
+        )
+        missing = [i for i, description in enumerate(descriptions) if not description]
+        if not missing:
+            return descriptions
+        if not temperature:
+            temperature = self.config.temperature
+
+        batches = await asyncio.to_thread(
+            self.pack_batches, [images[i] for i in missing]
+        )
+
+        async def describe(batch: List[int]) -> None:
+            positions = [missing[i] for i in batch]
+            if len(positions) == 1:
+                descriptions[positions[0]] = await self.run(
+                    images[positions[0]], summary, temperature, use_cache=False
+                )
+                return
+            try:
+                found = await self._describe_batch(
+                    [images[p] for p in positions], summary, temperature
+                )
+                if len(found) < len(positions):
+                    logger.warning(
+                        f"{len(positions) - len(found)}/{len(positions)} images "
+                        "missing from a batched description, describing them "
+                        "one by one"
+                    )
+            except Exception as e:
+                logger.warning(
+                    f"Batch of {len(positions)} images failed, describing them "
+                    f"one by one: {e}"
+                )
+                found = {}
+
+            async def complete(index: int, position: int) -> None:
+                if index in found:
+                    descriptions[position] = found[index]
+                    await self._store(
+                        images[position], summary, found[index], self.batch_prompt
+                    )
+                else:
+                    descriptions[position] = await self.run(
+                        images[position], summary, temperature, use_cache=False
+                    )
+
+            await asyncio.gather(*(complete(i, p) for i, p in enumerate(positions)))
+
+        await asyncio.gather(*(describe(batch) for batch in batches))
+        return descriptions
 
     async def run(
-        self, base64_data: str, summary: str, temperature=None
+        self, image: FileImage, summary: str, temperature=None, use_cache=True
     ) -> ImageDescription | None:
         """
-        base64_data: base64 str
+        image: the image, sent with its MIME type and detail level
         """
+        if use_cache:
+            cached = await self._cached(image, summary)
+            if cached:
+                return cached
+
         if not temperature:
             temperature = self.config.temperature
 
-        response = await self.client.beta.chat.completions.parse(
-            model=self.config.MODEL_DEPLOYMENT,
-            response_format=ImageDescription,
-            temperature=temperature,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": self.prompt,
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_data}"
-                            },
-                        },
+        async with self.concurrency_limit:
+            # Base64 is only built while the request is in flight
+            data_url = await asyncio.to_thread(lambda: image.data_url)
+            with count_vision_call("image_description"):
+                response = await self.client.beta.chat.completions.parse(
+                    model=self.config.MODEL_DEPLOYMENT,
+                    response_format=ImageDescription,
+                    temperature=temperature,
+                    messages=[
                         {
-                            "type": "text",
-                            "text": f"For context, the image above is extracted from  a document having description as follows: {summary}",
-                        },
+                            "role": "user",
+                            "content": [
+                                {
+                                    "type": "text",
+                                    "text": self.prompt,
+                                },
+                                {
+                                    "type": "image_url",
+                                    "image_url": {
+                                        "url": data_url,
+                                        "detail": image.detail,
+                                    },
+                                },
+                                self._context(summary),
+                            ],
+                        }
                     ],
-                }
-            ],
-        )
+                )
 
         # Parse response
         data = response.choices[0].message.parsed
+
+        await self._store(image, summary, data)
         return data
@@ -0,0 +1,202 @@
+"""
+normalization.py
+Shrink extracted images before they are described, summarized and uploaded:
+trim uniform margins, cap the longest side, re-encode, and pick the vision
+detail level
+"""
+
+import io
+import math
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from loguru import logger
+from PIL import Image, ImageChops
+
+from src.models import FileImage
+
+# Images fitting in one low detail tile gain nothing from "high" detail
+LOW_DETAIL_MAX_SIDE = 512
+
+ENCODINGS = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+# Vision input cost: a base per image, plus per 512px tile at high detail
+# once the image fits in 2048px and its short side in 768px
+VISION_BASE_TOKENS = 85
+VISION_TILE_TOKENS = 170
+
+
+def image_dimensions(image: FileImage) -> Optional[Tuple[int, int]]:
+    """Width and height from the image header, None if PIL cannot read it"""
+    try:
+        source = image.spill_path or io.BytesIO(image.image_content)
+        with Image.open(source) as img:
+            return img.size
+    except Exception:
+        return None
+
+
+def vision_tokens(width: int, height: int, detail: str) -> int:
+    """Estimated prompt tokens of an image ("auto" is counted as "high")"""
+    if detail == "low":
+        return VISION_BASE_TOKENS
+    scale = min(1.0, 2048 / max(width, height))
+    scale *= min(1.0, 768 / (min(width, height) * scale))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return VISION_BASE_TOKENS + VISION_TILE_TOKENS * tiles
+
+
+@dataclass
+class NormalizationReport:
+    num_images: int = 0
+    num_changed: int = 0
+    bytes_before: int = 0
+    bytes_after: int = 0
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_before - self.bytes_after
+
+    def merge(self, other: "NormalizationReport") -> None:
+        self.num_images += other.num_images
+        self.num_changed += other.num_changed
+        self.bytes_before += other.bytes_before
+        self.bytes_after += other.bytes_after
+
+
+class ImageNormalizer:
+    """
+    Images are trimmed and capped, then photos are re-encoded as JPEG or WebP
+    while graphics (few colors: text, diagrams, shapes) stay lossless PNG,
+    which keeps them sharp and is usually smaller for them anyway.
+    An image is only replaced when the result is smaller, or was trimmed or
+    downscaled.
+    """
+
+    def __init__(
+        self,
+        max_side: int = 2048,
+        output_format: str = "JPEG",
+        quality: int = 85,
+        trim_margins: bool = True,
+        trim_threshold: int = 16,
+        detail: str = "size",
+    ):
+        """
+        Args:
+            max_side (int): Max width and height, larger images are downscaled
+            output_format (str): "JPEG" or "WEBP", encoding of the photos
+            quality (int): JPEG or WebP quality
+            trim_margins (bool): Crop the margins of the color of the corners
+            trim_threshold (int): Max difference with the margin color of a
+                pixel still counted as margin
+            detail (str): "size" chooses "low" for images fitting in one low
+                detail tile and "high" otherwise, "auto", "low" or "high"
+                apply to every image
+        """
+        if output_format.upper() not in ENCODINGS:
+            raise ValueError(f"Unknown image output format: {output_format}")
+        if detail not in ("size", "auto", "low", "high"):
+            raise ValueError(f"Unknown image detail: {detail}")
+        self.max_side = max_side
+        self.output_format = output_format.upper()
+        self.quality = quality
+        self.trim_margins = trim_margins
+        self.trim_threshold = trim_threshold
+        self.detail = detail
+
+    def _trim(self, img: Image.Image) -> Image.Image:
+        """Crop the margins of the color found in the four corners"""
+        rgb = img.convert("RGB")
+        width, height = rgb.size
+        corners = {
+            rgb.getpixel(xy)
+            for xy in ((0, 0), (width - 1, 0), (0, height - 1), (width - 1, height - 1))
+        }
+        if len(corners) != 1:
+            return img
+
+        background = Image.new("RGB", rgb.size, corners.pop())
+        diff = ImageChops.difference(rgb, background).convert("L")
+        bbox = diff.point(lambda p: 255 if p > self.trim_threshold else 0).getbbox()
+        if bbox is None or bbox == (0, 0, width, height):
+            return img
+        return img.crop(bbox)
+
+    def _choose_detail(self, img: Image.Image) -> str:
+        if self.detail != "size":
+            return self.detail
+        return "low" if max(img.size) <= LOW_DETAIL_MAX_SIDE else "high"
+
+    def _encode(self, img: Image.Image) -> Tuple[bytes, str]:
+        buffer = io.BytesIO()
+        # Graphics: lossy encoding blurs text and edges
+        if img.getcolors(256) is not None:
+            img.save(buffer, format="PNG", optimize=True)
+            return buffer.getvalue(), "image/png"
+
+        if img.mode in ("RGBA", "LA", "P"):
+            rgba = img.convert("RGBA")
+            if self.output_format == "JPEG":
+                # No transparency in JPEG: flatten on white
+                flat = Image.new("RGB", rgba.size, (255, 255, 255))
+                flat.paste(rgba, mask=rgba.getchannel("A"))
+                img = flat
+            else:
+                img = rgba
+        elif img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(buffer, format=self.output_format, quality=self.quality)
+        return buffer.getvalue(), ENCODINGS[self.output_format]
+
+    def normalize(self, image: FileImage) -> Tuple[FileImage, int, int]:
+        """
+        Returns:
+            The normalized image, and its size in bytes before and after
+        """
+        image_bytes = image.get_bytes()
+        size_before = len(image_bytes)
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as img:
+                img.load()
+                resized = img
+                if self.trim_margins:
+                    resized = self._trim(resized)
+                if max(resized.size) > self.max_side:
+                    resized = resized.copy()
+                    resized.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+                detail = self._choose_detail(resized)
+                new_bytes, mime_type = self._encode(resized)
+                geometry_changed = resized.size != img.size
+        except Exception as e:
+            # Formats PIL cannot read (e.g. some EMF/WMF) are sent as they are
+            logger.debug(f"Cannot normalize image {image.image_no}: {e}")
+            return image, size_before, size_before
+
+        if not geometry_changed and len(new_bytes) >= size_before:
+            return image.model_copy(update={"detail": detail}), size_before, size_before
+
+        normalized = image.model_copy(
+            update={
+                "image_content": new_bytes,
+                "spill_path": None,
+                "mime_type": mime_type,
+                "detail": detail,
+            }
+        )
+        return normalized, size_before, len(new_bytes)
+
+    def normalize_all(
+        self, images: List[FileImage]
+    ) -> Tuple[List[FileImage], NormalizationReport]:
+        """Normalize images. Blocking: call it off the event loop."""
+        report = NormalizationReport()
+        normalized_images = []
+        for image in images:
+            normalized, size_before, size_after = self.normalize(image)
+            normalized_images.append(normalized)
+            report.num_images += 1
+            report.num_changed += size_after != size_before
+            report.bytes_before += size_before
+            report.bytes_after += size_after
+        return normalized_images, report
@@ -0,0 +1,288 @@
+"""
+File: ingestion_queue.py
+Desc: persistent queue of files to index, on a local SQLite file shared by
+the gunicorn workers of a container
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from itertools import islice
+from typing import Dict, Iterable, Optional
+
+from loguru import logger
+
+PENDING = "pending"
+PROCESSING = "processing"
+DONE = "done"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+
+
+@dataclass
+class IngestionJob:
+    job_id: int
+    batch_id: str
+    container_name: str
+    blob_name: str
+    uploader: str
+    dept_name: str
+    pii_scanning: bool
+    incremental: bool
+    attempts: int
+
+
+class IngestionQueue:
+    """
+    Jobs survive restarts: the process running a job renews its lease with
+    `heartbeat`, and a job whose lease expired, because its process died or
+    the container restarted, is handed out again by `requeue_orphans`, until
+    it has been claimed max_attempts times.
+    """
+
+    # Rows inserted per transaction while enumerating a container
+    ENQUEUE_CHUNK_SIZE = 500
+
+    def __init__(self, path: str, lease_seconds: float = 300, max_attempts: int = 3):
+        """
+        Args:
+            path (str): SQLite file, created with its directory if missing
+            lease_seconds (float): Seconds after its last heartbeat a job
+                being processed is considered abandoned
+            max_attempts (int): Claims of a job before it fails, whether its
+                processing raised or its process died
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "batch_id TEXT NOT NULL, container_name TEXT NOT NULL, "
+            "blob_name TEXT NOT NULL, uploader TEXT NOT NULL, "
+            "dept_name TEXT NOT NULL, pii_scanning INTEGER NOT NULL, "
+            "incremental INTEGER NOT NULL DEFAULT 0, "
+            f"status TEXT NOT NULL DEFAULT '{PENDING}', "
+            "attempts INTEGER NOT NULL DEFAULT 0, error TEXT, pid INTEGER, "
+            "updated_at REAL NOT NULL, "
+            "UNIQUE (batch_id, blob_name))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, job_id)"
+        )
+
+    def enqueue(
+        self,
+        batch_id: str,
+        container_name: str,
+        blob_names: Iterable[str],
+        uploader: str = "default",
+        dept_name: str = "default",
+        pii_scanning: bool = False,
+        incremental: bool = False,
+    ) -> int:
+        """
+        Add one job per blob name, committing every ENQUEUE_CHUNK_SIZE names so
+        workers start on the first files while a large container is still
+        being listed. Blocking: call it off the event loop.
+
+        Returns:
+            Number of jobs added
+        """
+        blob_names = iter(blob_names)
+        num_jobs = 0
+        while chunk := list(islice(blob_names, self.ENQUEUE_CHUNK_SIZE)):
+            now = time.time()
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    num_jobs += self._conn.executemany(
+                        "INSERT OR IGNORE INTO jobs (batch_id, container_name, "
+                        "blob_name, uploader, dept_name, pii_scanning, incremental, "
+                        "updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [
+                            (
+                                batch_id,
+                                container_name,
+                                blob_name,
+                                uploader,
+                                dept_name,
+                                int(pii_scanning),
+                                int(incremental),
+                                now,
+                            )
+                            for blob_name in chunk
+                        ],
+                    ).rowcount
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        logger.info(f"Queued {num_jobs} files of {container_name} (batch {batch_id})")
+        return num_jobs
+
+    def claim(self) -> Optional[IngestionJob]:
+        """Hand the oldest pending job to the calling process, None if there is none"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT job_id, batch_id, container_name, blob_name, uploader, "
+                    "dept_name, pii_scanning, incremental, attempts FROM jobs "
+                    "WHERE status = ? ORDER BY job_id LIMIT 1",
+                    (PENDING,),
+                ).fetchone()
+                if row:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = ?, attempts = attempts + 1, "
+                        "pid = ?, updated_at = ? WHERE job_id = ?",
+                        (PROCESSING, os.getpid(), time.time(), row[0]),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        if not row:
+            return None
+        job_id, batch_id, container_name, blob_name, uploader, dept_name = row[:6]
+        return IngestionJob(
+            job_id=job_id,
+            batch_id=batch_id,
+            container_name=container_name,
+            blob_name=blob_name,
+            uploader=uploader,
+            dept_name=dept_name,
+            pii_scanning=bool(row[6]),
+            incremental=bool(row[7]),
+            attempts=row[8] + 1,
+        )
+
+    def finish(self, job_id: int, status: str, error: Optional[str] = None) -> None:
+        """Record the outcome of a job: DONE, UNCHANGED, FAILED, or PENDING to retry it"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, pid = NULL, updated_at = ? "
+                "WHERE job_id = ?",
+                (status, error, time.time(), job_id),
+            )
+
+    def heartbeat(self, job_ids: Iterable[int]) -> None:
+        """Renew the lease of jobs still being processed"""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET updated_at = ? WHERE status = ? AND job_id IN "
+                f"({', '.join('?' * len(job_ids))})",
+                (time.time(), PROCESSING, *job_ids),
+            )
+
+    def release(self, job_ids: Iterable[int]) -> None:
+        """
+        Put back jobs whose processing was interrupted, unless they finished.
+        The interrupted claim does not count as an attempt.
+        """
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, attempts = MAX(attempts - 1, 0), "
+                "pid = NULL, updated_at = ? "
+                f"WHERE status = ? AND job_id IN ({', '.join('?' * len(job_ids))})",
+                (PENDING, time.time(), PROCESSING, *job_ids),
+            )
+
+    def requeue_orphans(self) -> int:
+        """
+        Put back the jobs being processed without a heartbeat for
+        lease_seconds. PIDs are not checked: a restarted container reuses them.
+        A job already claimed max_attempts times fails instead: a file that
+        kills its process (out of memory, crash of a native parser) would
+        otherwise be handed out forever.
+
+        Returns:
+            Number of jobs put back
+        """
+        with self._lock:
+            now = time.time()
+            expired = now - self.lease_seconds
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                failed = self._conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, pid = NULL, "
+                    "updated_at = ? WHERE status = ? AND updated_at < ? "
+                    "AND attempts >= ?",
+                    (
+                        FAILED,
+                        f"Worker died while processing ({self.max_attempts} attempts)",
+                        now,
+                        PROCESSING,
+                        expired,
+                        self.max_attempts,
+                    ),
+                ).rowcount
+                requeued = self._conn.execute(
+                    "UPDATE jobs SET status = ?, pid = NULL, updated_at = ? "
+                    "WHERE status = ? AND updated_at < ?",
+                    (PENDING, now, PROCESSING, expired),
+                ).rowcount
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if failed:
+            logger.error(
+                f"Failed {failed} jobs whose worker died on each of their attempts"
+            )
+        if requeued:
+            logger.warning(f"Requeued {requeued} jobs left over by stopped workers")
+        return requeued
+
+    def batch_status(self, batch_id: str) -> Dict[str, int]:
+        """Number of jobs of a batch by status"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM jobs WHERE batch_id = ? GROUP BY status",
+                (batch_id,),
+            ).fetchall()
+        statuses = (PENDING, PROCESSING, DONE, UNCHANGED, FAILED)
+        return {status: 0 for status in statuses} | dict(rows)
+
+    def status_counts(self) -> Dict[str, int]:
+        """Number of jobs waiting or being processed, all batches together"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM jobs WHERE status IN (?, ?) "
+                "GROUP BY status",
+                (PENDING, PROCESSING),
+            ).fetchall()
+        return {PENDING: 0, PROCESSING: 0} | dict(rows)
+
+    def batch_failures(self, batch_id: str, limit: int = 100) -> Dict[str, str]:
+        """Error of the failed jobs of a batch, by blob name"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT blob_name, error FROM jobs WHERE batch_id = ? AND status = ? "
+                "ORDER BY job_id LIMIT ?",
+                (batch_id, FAILED, limit),
+            ).fetchall()
+        return dict(rows)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,270 @@
+"""
+File: ingestion_workers.py
+Desc: pool of async workers draining the ingestion queue through the pipeline
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from azure.storage.blob import BlobServiceClient
+from loguru import logger
+
+from src.azure_container_client import AzureContainerClient
+from src.check_duplicates import DuplicateChecker
+from src.file_preflight import PreflightError
+from src.ingestion_queue import (DONE, FAILED, PENDING, UNCHANGED,
+                                 IngestionJob, IngestionQueue)
+from src.metrics import count_error, stage_timer
+from src.models import MyFile
+from src.pipeline import Pipeline
+
+# notify(username, file_name, status, result), e.g. the webhook notification
+Notifier = Callable[[str, str, str, Dict], Awaitable[None]]
+
+
+class IngestionWorkerPool:
+    """
+    Fixed number of workers, each processing one file at a time.
+    Every gunicorn worker runs its own pool on the shared queue, with its
+    share of INGESTION_WORKERS as num_workers (see `per_worker` in config.py).
+    The limits on parsing, model calls and uploads are shared by the files of
+    a process, and split the same way.
+    """
+
+    def __init__(
+        self,
+        queue: IngestionQueue,
+        pipeline: Pipeline,
+        blob_service_client: BlobServiceClient,
+        num_workers: int = 4,
+        poll_interval: float = 2.0,
+        notify: Optional[Notifier] = None,
+        duplicate_checker: Optional[DuplicateChecker] = None,
+        max_file_bytes: int = 0,
+        max_file_pages: int = 0,
+        download_options: Optional[Dict] = None,
+    ):
+        """
+        Args:
+            queue: Queue of the files to index
+            pipeline: Pipeline processing the files
+            blob_service_client: Client of the storage account of the files
+            num_workers: Number of files processed at the same time
+            poll_interval: Seconds an idle worker waits before polling the queue
+            notify: Coroutine called with the status of each file
+            duplicate_checker: Record of the indexed file versions, used by
+                incremental jobs to skip unchanged files
+            max_file_bytes: Larger files fail before download (0: no limit)
+            max_file_pages: Files with more estimated pages fail before
+                download (0: no limit)
+            download_options: Keyword arguments of `download_to_file`
+                (concurrency, chunk and spool sizes), its defaults if None
+        """
+        self.queue = queue
+        self.pipeline = pipeline
+        self.blob_service_client = blob_service_client
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        self.notify = notify
+        self.duplicate_checker = duplicate_checker
+        self.max_file_bytes = max_file_bytes
+        self.max_file_pages = max_file_pages
+        self.download_options = download_options or {}
+        self._container_clients: Dict[str, AzureContainerClient] = {}
+        self._workers: List[asyncio.Task] = []
+        self._wake_up = asyncio.Event()
+        # Jobs being processed by this pool, whose lease it renews, and the
+        # stage each one is in, the label of its errors
+        self._running: Dict[int, str] = {}
+
+    def start(self) -> None:
+        self.queue.requeue_orphans()
+        self._workers = [
+            asyncio.create_task(self._work(worker_no))
+            for worker_no in range(self.num_workers)
+        ]
+        self._workers.append(asyncio.create_task(self._keep_leases()))
+        logger.info(f"Started {self.num_workers} ingestion workers")
+
+    async def stop(self) -> None:
+        interrupted = list(self._running)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        # Hand the interrupted jobs back now rather than when their lease expires
+        await asyncio.to_thread(self.queue.release, interrupted)
+        for container_client in self._container_clients.values():
+            await asyncio.to_thread(container_client.close)
+        self._container_clients = {}
+
+    def wake_up(self) -> None:
+        """Let idle workers poll the queue now, e.g. after new jobs were queued"""
+        self._wake_up.set()
+
+    async def _work(self, worker_no: int) -> None:
+        while True:
+            try:
+                job = await asyncio.to_thread(self.queue.claim)
+            except Exception as e:
+                logger.error(f"Ingestion worker {worker_no} cannot poll queue: {e}")
+                job = None
+
+            if job is None:
+                self._wake_up.clear()
+                try:
+                    await asyncio.wait_for(
+                        self._wake_up.wait(), timeout=self.poll_interval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._running[job.job_id] = "download"
+            try:
+                await self._run(job)
+            except Exception as e:
+                # Recording the outcome failed (duplicate index, queue,
+                # notification): keep the worker, and do not leave the job
+                # processing
+                logger.error(
+                    f"Ingestion worker {worker_no} failed on '{job.blob_name}': {e}"
+                )
+                count_error(self._running[job.job_id])
+                try:
+                    await asyncio.to_thread(
+                        self.queue.finish, job.job_id, FAILED, str(e)
+                    )
+                except Exception as e:
+                    logger.error(f"Cannot record failure of job {job.job_id}: {e}")
+            finally:
+                self._running.pop(job.job_id, None)
+
+    async def _keep_leases(self) -> None:
+        """
+        Renew the leases of the running jobs, and requeue the jobs whose lease
+        expired, a few times per lease
+        """
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            try:
+                await asyncio.to_thread(self.queue.heartbeat, list(self._running))
+                if await asyncio.to_thread(self.queue.requeue_orphans):
+                    self.wake_up()
+            except Exception as e:
+                logger.error(f"Cannot renew ingestion leases: {e}")
+
+    async def _get_container_client(self, container_name: str) -> AzureContainerClient:
+        if container_name not in self._container_clients:
+            # The constructor checks the container exists: keep it off the loop
+            self._container_clients[container_name] = await asyncio.to_thread(
+                AzureContainerClient,
+                client=self.blob_service_client,
+                container_name=container_name,
+            )
+        return self._container_clients[container_name]
+
+    async def _notify(self, job: IngestionJob, status: str, result: Dict) -> None:
+        if self.notify:
+            await self.notify(job.uploader, job.blob_name, status, result)
+
+    def _enter(self, job: IngestionJob, stage: str) -> None:
+        """Label the errors of the job from now on with this stage"""
+        self._running[job.job_id] = stage
+
+    async def _run(self, job: IngestionJob) -> None:
+        """Download and process one file, then record the outcome"""
+        try:
+            container_client = await self._get_container_client(job.container_name)
+            self._enter(job, "preflight")
+            preflight = await asyncio.to_thread(
+                container_client.preflight_file,
+                job.blob_name,
+                self.max_file_bytes,
+                self.max_file_pages,
+            )
+            self._enter(job, "download")
+            with stage_timer("download", preflight.file_type):
+                file_content, file_hash = await asyncio.to_thread(
+                    container_client.download_to_file,
+                    job.blob_name,
+                    preflight=preflight,
+                    **self.download_options,
+                )
+            try:
+                if job.incremental and self.duplicate_checker:
+                    self._enter(job, "duplicate_index")
+                    await self.duplicate_checker.refresh_if_stale()
+                    if self.duplicate_checker.is_unchanged(
+                        job.blob_name, file_hash, job.dept_name
+                    ):
+                        logger.info(f"Skipping unchanged file '{job.blob_name}'")
+                        self._enter(job, "queue")
+                        await asyncio.to_thread(
+                            self.queue.finish, job.job_id, UNCHANGED
+                        )
+                        self._enter(job, "notification")
+                        await self._notify(job, "UNCHANGED", {"file_hash": file_hash})
+                        return
+
+                self._enter(job, "notification")
+                await self._notify(job, "PROCESSING", {})
+                self._enter(job, "pipeline")
+                result = await self.pipeline.process_file(
+                    MyFile(
+                        file_name=job.blob_name,
+                        file_content=file_content,
+                        dept_name=job.dept_name,
+                        uploader=job.uploader,
+                        file_type=preflight.file_type,
+                        num_pages=preflight.num_pages,
+                        file_hash=file_hash,
+                    ),
+                    job.pii_scanning,
+                )
+            finally:
+                file_content.close()
+        except PreflightError as e:
+            # Another attempt would download nothing more and fail the same way
+            logger.error(f"Rejected '{job.blob_name}' from '{job.container_name}': {e}")
+            count_error("preflight")
+            self._enter(job, "queue")
+            await asyncio.to_thread(self.queue.finish, job.job_id, FAILED, str(e))
+            await self._notify(job, "ERROR", {"error": str(e)})
+            return
+        except Exception as e:
+            status = PENDING if job.attempts < self.queue.max_attempts else FAILED
+            count_error(self._running[job.job_id])
+            logger.error(
+                f"Error ingesting '{job.blob_name}' from '{job.container_name}' "
+                f"(attempt {job.attempts}/{self.queue.max_attempts}): {e}"
+            )
+            self._enter(job, "queue")
+            await asyncio.to_thread(self.queue.finish, job.job_id, status, str(e))
+            if status == FAILED:
+                await self._notify(job, "ERROR", {"error": str(e)})
+            return
+
+        # The pipeline counted its own errors
+        if result["errors"]:
+            if self.duplicate_checker:
+                self._enter(job, "duplicate_index")
+                await self.duplicate_checker.forget_indexed(
+                    job.blob_name, job.dept_name
+                )
+            self._enter(job, "queue")
+            await asyncio.to_thread(
+                self.queue.finish, job.job_id, FAILED, "\n".join(result["errors"])
+            )
+            self._enter(job, "notification")
+            await self._notify(job, "ERROR", result)
+        else:
+            if self.duplicate_checker:
+                self._enter(job, "duplicate_index")
+                await self.duplicate_checker.record_indexed(
+                    result["metadata"], job.blob_name
+                )
+            self._enter(job, "queue")
+            await asyncio.to_thread(self.queue.finish, job.job_id, DONE)
+            self._enter(job, "notification")
+            await self._notify(job, "INDEXED", result)
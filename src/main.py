@@ -1,13 +1,18 @@
 import asyncio
+import uuid
 from collections.abc import Iterable
 from typing import Dict, Optional
 
 import httpx
-from fastapi import APIRouter, BackgroundTasks, HTTPException
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Response
 from loguru import logger
 
 from src.azure_container_client import AzureContainerClient
-from src.models import FileDeleteRequest, FileIndexingRequest, MyFile
+from src.check_duplicates import DuplicateChecker
+from src.metrics import (BACKGROUND_TASKS, QUEUED_JOBS, count_error,
+                         latest_metrics, stage_timer)
+from src.models import (ContainerIndexingRequest, FileDeleteRequest,
+                        FileIndexingRequest, MyFile)
 from src.pdf_utils.pdf_utils import pdf_blob_to_pdfplumber_doc
 from src.pipeline import Pipeline
 
@@ -55,6 +60,7 @@ async def reindex_file(
     indexing_request: FileIndexingRequest,
     background_tasks: BackgroundTasks,
     pii_scanning: Optional[bool] = False,
+    incremental: Optional[bool] = False,
 ):
     """
     Reindex a single file from a specified Azure Blob Storage container in the background.
@@ -63,6 +69,7 @@ async def reindex_file(
         container_name: The name of the Azure Blob Storage container.
         file_name: The name of the file to reindex.
         background_tasks: FastAPI BackgroundTasks instance.
+        incremental: Skip the file if this exact version is already indexed.
 
     Returns:
         A message indicating the background task has started.
@@ -73,6 +80,7 @@ async def reindex_file(
     )
 
     # Add the reindex task to background tasks
+    BACKGROUND_TASKS.inc()
     background_tasks.add_task(
         reindex_file_background,
         indexing_request.blob_container_name,
@@ -82,6 +90,7 @@ async def reindex_file(
         blob_container_client,
         objects["pipeline"],
         pii_scanning,
+        bool(incremental),
     )
 
     await send_webhook_notification(
@@ -103,6 +112,7 @@ async def reindex_file_background(
     blob_container_client: AzureContainerClient,
     pipeline: Pipeline,
     pii_scanning: bool,
+    incremental: bool = False,
 ):
     """
     Background task to reindex a single file from an Azure Blob Storage container.
@@ -112,44 +122,89 @@ async def reindex_file_background(
         file_name: Name of the file to reindex.
         blob_container_client: Azure container client instance.
         pipeline: The processing pipeline instance.
+        incremental: Skip the file, before any parsing, if its hash matches
+            the indexed version.
     """
+    duplicate_checker: DuplicateChecker = objects["duplicate-checker"]
+    config = configs["app_config"]
+    # Label of the errors, updated as the file progresses
+    stage = "preflight"
     try:
-
-        # Download file content asynchronously
-        file_content = await asyncio.to_thread(
-            blob_container_client.download_file, file_name
+        # Unsupported or oversized files fail before the download
+        preflight = await asyncio.to_thread(
+            blob_container_client.preflight_file,
+            file_name,
+            config.MAX_FILE_BYTES,
+            config.MAX_FILE_PAGES,
         )
 
-        if not isinstance(file_content, bytes):
-            raise ValueError(f"Error downloading file {file_name}")
+        # Download file content asynchronously, hashing it on the way
+        stage = "download"
+        with stage_timer("download", preflight.file_type):
+            file_content, file_hash = await asyncio.to_thread(
+                blob_container_client.download_to_file,
+                file_name,
+                preflight=preflight,
+                **config.BLOB_DOWNLOAD_OPTIONS,
+            )
 
-        # Create a MyFile instance
-        file = MyFile(
-            file_name=file_name,
-            file_content=file_content,
-            dept_name=dept_name,
-            uploader=uploader,
-        )
+        try:
+            if incremental:
+                stage = "duplicate_index"
+                await duplicate_checker.refresh_if_stale()
+                if duplicate_checker.is_unchanged(file_name, file_hash, dept_name):
+                    logger.info(f"Skipping unchanged file '{file_name}'")
+                    stage = "notification"
+                    await send_webhook_notification(
+                        username=uploader,
+                        file_name=file_name,
+                        status="UNCHANGED",
+                        result={"file_hash": file_hash},
+                    )
+                    return
+
+            # Create a MyFile instance
+            stage = "pipeline"
+            file = MyFile(
+                file_name=file_name,
+                file_content=file_content,
+                dept_name=dept_name,
+                uploader=uploader,
+                file_type=preflight.file_type,
+                num_pages=preflight.num_pages,
+                file_hash=file_hash,
+            )
 
-        await send_webhook_notification(
-            username=uploader,
-            file_name=file_name,
-            status="PROCESSING",
-            result={},
-        )
+            stage = "notification"
+            await send_webhook_notification(
+                username=uploader,
+                file_name=file_name,
+                status="PROCESSING",
+                result={},
+            )
 
-        # Process the file
-        result = await pipeline.process_file(file, pii_scanning)
+            # Process the file
+            stage = "pipeline"
+            result = await pipeline.process_file(file, pii_scanning)
+        finally:
+            file_content.close()
 
         # Log success
         logger.info(
             f"Reindexing complete for file '{file_name}' in container '{container_name}': {result}"
         )
+        # The pipeline counted its own errors
         if not result["errors"]:
+            stage = "duplicate_index"
+            await duplicate_checker.record_indexed(result["metadata"], file_name)
+            stage = "notification"
             await send_webhook_notification(
                 username=uploader, file_name=file_name, status="INDEXED", result=result
             )
         else:
+            stage = "duplicate_index"
+            await duplicate_checker.forget_indexed(file_name, dept_name)
+            stage = "notification"
             await send_webhook_notification(
                 username=uploader, file_name=file_name, status="ERROR", result=result
             )
@@ -158,11 +213,105 @@ async def reindex_file_background(
         logger.error(
             f"Error during reindexing of file '{file_name}' in container '{container_name}': {str(e)}"
         )
+        count_error(stage)
 
         await send_webhook_notification(
             username=uploader, file_name=file_name, status="ERROR", result={"error": e}
         )
         raise
+    finally:
+        BACKGROUND_TASKS.dec()
+
+
+@router.post("/api/exec/ingest_container/")
+async def ingest_container(
+    indexing_request: ContainerIndexingRequest,
+    background_tasks: BackgroundTasks,
+    pii_scanning: Optional[bool] = False,
+    incremental: Optional[bool] = False,
+):
+    """
+    Queue every file of a container (optionally under a prefix) for indexing.
+    Files are listed in the background and processed by the ingestion workers.
+    With `incremental`, files whose indexed version is unchanged are skipped.
+
+    Returns:
+        The batch id to follow the progress with `/api/exec/ingest_container/{batch_id}`
+    """
+    if not configs["app_config"].INGESTION_WORKERS:
+        raise HTTPException(
+            status_code=503, detail="Bulk ingestion is disabled (INGESTION_WORKERS=0)"
+        )
+    batch_id = uuid.uuid4().hex
+    BACKGROUND_TASKS.inc()
+    background_tasks.add_task(
+        enqueue_container_background,
+        batch_id,
+        indexing_request,
+        pii_scanning,
+        incremental,
+    )
+    return {
+        "batch_id": batch_id,
+        "message": f"Listing of container '{indexing_request.blob_container_name}' started.",
+    }
+
+
+async def enqueue_container_background(
+    batch_id: str,
+    indexing_request: ContainerIndexingRequest,
+    pii_scanning: bool,
+    incremental: bool,
+):
+    """Stream the blob names of a container into the ingestion queue"""
+    try:
+        blob_container_client = await asyncio.to_thread(
+            AzureContainerClient,
+            client=clients["blob_service_client"],
+            container_name=indexing_request.blob_container_name,
+        )
+        await asyncio.to_thread(
+            objects["ingestion-queue"].enqueue,
+            batch_id,
+            indexing_request.blob_container_name,
+            blob_container_client.list_blob_names(prefix=indexing_request.prefix),
+            uploader=indexing_request.uploader,
+            dept_name=indexing_request.dept_name,
+            pii_scanning=bool(pii_scanning),
+            incremental=bool(incremental),
+        )
+        objects["ingestion-workers"].wake_up()
+    except Exception as e:
+        logger.error(
+            f"Error listing container '{indexing_request.blob_container_name}' "
+            f"for batch {batch_id}: {str(e)}"
+        )
+        count_error("listing")
+    finally:
+        BACKGROUND_TASKS.dec()
+
+
+@router.get("/api/exec/ingest_container/{batch_id}")
+async def get_ingestion_status(batch_id: str):
+    """Number of files of a batch by status, and the errors of the failed ones"""
+    ingestion_queue = objects["ingestion-queue"]
+    return {
+        "batch_id": batch_id,
+        "status": await asyncio.to_thread(ingestion_queue.batch_status, batch_id),
+        "failures": await asyncio.to_thread(ingestion_queue.batch_failures, batch_id),
+    }
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics of all the workers, and the depth of the ingestion queue"""
+    ingestion_queue = objects.get("ingestion-queue")
+    if ingestion_queue:
+        counts = await asyncio.to_thread(ingestion_queue.status_counts)
+        for status, count in counts.items():
+            QUEUED_JOBS.labels(status).set(count)
+    content, content_type = await asyncio.to_thread(latest_metrics)
+    return Response(content=content, media_type=content_type)
 
 
 async def search_client_filter_file(file_name: str, search_client) -> Iterable:
@@ -331,6 +480,9 @@ async def remove_file_endpoint(
                 }
             )
 
+    objects["duplicate-checker"].forget(file_name, dept_name)
+    await asyncio.to_thread(objects["duplicate-checker"].save)
+
     await send_webhook_notification(
         username=username,
         file_name=file_name,
@@ -0,0 +1,126 @@
+"""
+File: metrics.py
+Desc: Prometheus metrics of the ingestion: latency of each pipeline stage per
+file type, volumes (pages, images, chunks, model calls, tokens), errors, and
+the files and background tasks in flight.
+
+Under gunicorn, each worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+(set up by gunicorn.conf.py) and /metrics aggregates the files of all the
+workers. Without it, the metrics of the single process are served.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+# From a few milliseconds (a cached lookup) to the parsing of a large file
+LATENCY_BUCKETS = (
+    0.01,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+    600.0,
+    1800.0,
+)
+
+STAGE_SECONDS = Histogram(
+    "ingestion_stage_seconds",
+    "Seconds per stage occurrence: download, extraction, pii_scan, summary, "
+    "image_description (per file), embedding, search_upload (per request), "
+    "blob_upload (per file)",
+    ["stage", "file_type"],
+    buckets=LATENCY_BUCKETS,
+)
+FILE_SECONDS = Histogram(
+    "ingestion_file_seconds",
+    "Seconds to process a file through the pipeline",
+    ["file_type", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+FILES = Counter(
+    "ingestion_files", "Files processed by the pipeline", ["file_type", "status"]
+)
+PAGES = Counter("ingestion_pages", "Pages extracted", ["file_type"])
+IMAGES = Counter("ingestion_images", "Images extracted", ["file_type"])
+CHUNKS = Counter("ingestion_chunks", "Chunks sent for indexing", ["file_type", "kind"])
+VISION_CALLS = Counter(
+    "ingestion_vision_calls",
+    "Chat completion calls with images, and image descriptions found in cache",
+    ["kind", "outcome"],
+)
+EMBEDDING_TOKENS = Counter(
+    "ingestion_embedding_tokens", "Tokens billed by the embedding requests"
+)
+ERRORS = Counter("ingestion_errors", "Errors by stage", ["stage", "file_type"])
+FILES_IN_FLIGHT = Gauge(
+    "ingestion_files_in_flight",
+    "Files being processed by the pipeline",
+    multiprocess_mode="livesum",
+)
+# The queue is shared by the workers, any of them reports its depth
+QUEUED_JOBS = Gauge(
+    "ingestion_queue_jobs",
+    "Jobs of the ingestion queue pending or processing, read at scrape time",
+    ["status"],
+    multiprocess_mode="mostrecent",
+)
+BACKGROUND_TASKS = Gauge(
+    "ingestion_background_tasks",
+    "Background tasks of the API queued or running",
+    multiprocess_mode="livesum",
+)
+
+# File type of the file being processed, inherited by the tasks it starts
+current_file_type: ContextVar[str] = ContextVar("current_file_type", default="unknown")
+
+
+@contextmanager
+def stage_timer(stage: str, file_type: Optional[str] = None) -> Iterator[None]:
+    """Observe the duration of the block, for the current file type by default"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage, file_type or current_file_type.get()).observe(
+            time.perf_counter() - start
+        )
+
+
+@contextmanager
+def count_vision_call(kind: str) -> Iterator[None]:
+    """Count the chat completion call of the block by outcome"""
+    try:
+        yield
+    except Exception:
+        VISION_CALLS.labels(kind, "error").inc()
+        raise
+    VISION_CALLS.labels(kind, "ok").inc()
+
+
+def count_error(stage: str, file_type: Optional[str] = None) -> None:
+    ERRORS.labels(stage, file_type or current_file_type.get()).inc()
+
+
+def latest_metrics() -> tuple:
+    """Exposition of the metrics of all the workers, and its content type"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
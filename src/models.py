@@ -1,17 +1,31 @@
+import base64
+import io
 import json
-from dataclasses import dataclass
+import os
+import tempfile
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Literal, Optional, Union
 
 from loguru import logger
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, model_validator
+
+from src.file_utils import image_mime_type
 
 
 class MyFile(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     file_name: str
-    file_content: bytes
+    # Bytes, or a seekable binary file such as a spooled blob download
+    file_content: Union[bytes, io.IOBase]
     uploader: str = "default"
     dept_name: str = "default"
+    # From the preflight of the stored file, detected from the content if None
+    file_type: Optional[str] = None
+    num_pages: Optional[int] = None
+    # SHA-256 computed while downloading, hashed from the content if None
+    file_hash: Optional[str] = None
 
 
 class FileText(BaseModel):
@@ -30,6 +44,13 @@ class FileIndexingRequest(BaseModel):
     dept_name: str = "default"
 
 
+class ContainerIndexingRequest(BaseModel):
+    blob_container_name: str
+    prefix: Optional[str] = None
+    uploader: str = "default"
+    dept_name: str = "default"
+
+
 class FileDeleteRequest(BaseModel):
     file_name: str
     blob_container_name: str
@@ -40,11 +61,68 @@ class FileDeleteRequest(BaseModel):
 class FileImage(BaseModel):
     """
     Represent an image
+
+    The encoded image (PNG, JPEG...) is held as bytes, or in a temporary
+    file once spilled. Base64 is only built for the model requests.
     """
 
     page_no: int
     image_no: int
-    image_base64: str
+    image_content: Optional[bytes] = None
+    # Temporary file holding the image content instead, see `spill`
+    spill_path: Optional[str] = None
+    # Found from the image bytes if not given
+    mime_type: Optional[str] = None
+    # Vision model detail level: "auto", "low" or "high"
+    detail: Literal["auto", "low", "high"] = "auto"
+
+    @model_validator(mode="after")
+    def _detect_mime_type(self) -> "FileImage":
+        if self.image_content is None and self.spill_path is None:
+            raise ValueError("FileImage needs image_content or spill_path")
+        if self.mime_type is None:
+            self.mime_type = image_mime_type(self.get_bytes()[:12])
+        return self
+
+    def get_bytes(self) -> bytes:
+        """The encoded image, read back from disk if spilled"""
+        if self.image_content is not None:
+            return self.image_content
+        with open(self.spill_path, "rb") as f:
+            return f.read()
+
+    @property
+    def num_bytes(self) -> int:
+        if self.image_content is not None:
+            return len(self.image_content)
+        return os.path.getsize(self.spill_path)
+
+    def to_base64(self) -> str:
+        return base64.b64encode(self.get_bytes()).decode("utf-8")
+
+    @property
+    def data_url(self) -> str:
+        """Data URL of the image for model requests, encoded on each call"""
+        return f"data:{self.mime_type};base64,{self.to_base64()}"
+
+    def spill(self, directory: Optional[str] = None) -> None:
+        """Move the image content to a temporary file. Blocking."""
+        if self.image_content is None:
+            return
+        fd, path = tempfile.mkstemp(prefix="image_", dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.image_content)
+        self.spill_path = path
+        self.image_content = None
+
+    def discard(self) -> None:
+        """Remove the temporary file of a spilled image"""
+        if self.spill_path is not None:
+            try:
+                os.remove(self.spill_path)
+            except FileNotFoundError:
+                pass
+            self.spill_path = None
 
 
 @dataclass
@@ -58,6 +136,8 @@ class PageStats:
     text_yes_image_no: int = 0
     text_no_image_yes: int = 0
     text_no_image_no: int = 0
+    # Seconds spent per page analysis step, summed over the pages
+    step_seconds: Dict[str, float] = field(default_factory=dict)
 
     def update(self, has_text: bool, has_images: bool) -> None:
         if has_text and has_images:
@@ -69,6 +149,18 @@ class PageStats:
         else:
             self.text_no_image_no += 1
 
+    def add_timings(self, timings: Dict[str, float]) -> None:
+        for step, seconds in timings.items():
+            self.step_seconds[step] = self.step_seconds.get(step, 0.0) + seconds
+
+    def merge(self, other: "PageStats") -> None:
+        """Add the counts of another PageStats, e.g. one computed in a worker process"""
+        self.text_yes_image_yes += other.text_yes_image_yes
+        self.text_yes_image_no += other.text_yes_image_no
+        self.text_no_image_yes += other.text_no_image_yes
+        self.text_no_image_no += other.text_no_image_no
+        self.add_timings(other.step_seconds)
+
     def log_summary(self, doc_metadata: dict) -> None:
         logger.info(f"File metadata: {doc_metadata}")
         logger.info(
@@ -78,6 +170,16 @@ class PageStats:
             f"| **Has Text**       | {self.text_yes_image_yes:>18} | {self.text_yes_image_no:>18} |\n"
             f"| **No Text**        | {self.text_no_image_yes:>18} | {self.text_no_image_no:>18} |"
         )
+        if self.step_seconds:
+            logger.info(
+                "Page analysis time: "
+                + ", ".join(
+                    f"{step} {seconds:.2f}s"
+                    for step, seconds in sorted(
+                        self.step_seconds.items(), key=lambda item: -item[1]
+                    )
+                )
+            )
 
 
 class CustomSkillException(Exception):
@@ -107,6 +209,7 @@ class BaseChunk(BaseModel):
     chunk_no: str
     chunk: str
     page_range: PageRange
+    num_tokens: Optional[int] = None  # Set by token-based splitting
 
 
 class MyFileMetaData(BaseModel):
@@ -0,0 +1,108 @@
+"""
+Everything the parsing of a PDF page decides on, computed once per page
+from the layout objects pdfplumber parses once, with the time of each step
+"""
+
+import time
+from contextlib import contextmanager
+from functools import cached_property
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pdfplumber.page import Page
+from pdfplumber.table import Table, TableSettings
+
+from .pdf_utils import (get_page_drawings_stats, is_infographic_page,
+                        may_contain_table, pdf_page_is_landscape,
+                        significant_images)
+
+
+class PageAnalysis:
+    """
+    Analysis of one page. Each property is computed on first use and kept,
+    so a step needed by several decisions runs once, and a page routed to
+    the image path early never pays for text or table extraction.
+
+    `timings` holds the seconds spent per step: layout (parsing the page
+    objects), drawings, text, images, tables, and whatever the caller times
+    with `timed`.
+    """
+
+    def __init__(self, page: Page, table_settings: Optional[Dict] = None):
+        """
+        Args:
+            page (Page): The page to analyze
+            table_settings (Dict): pdfplumber table settings, the defaults if None
+        """
+        self.page = page
+        self.table_settings = table_settings
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def timed(self, step: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[step] = (
+                self.timings.get(step, 0.0) + time.perf_counter() - start
+            )
+
+    @contextmanager
+    def _step(self, step: str) -> Iterator[None]:
+        """Time a step using the layout objects, parsed (and timed) beforehand"""
+        self.objects
+        with self.timed(step):
+            yield
+
+    @cached_property
+    def objects(self) -> Dict[str, list]:
+        """Layout objects by type, parsed once and shared by all the steps"""
+        with self.timed("layout"):
+            return self.page.objects
+
+    @cached_property
+    def drawing_stats(self) -> Dict[str, int]:
+        with self._step("drawings"):
+            return get_page_drawings_stats(self.page)
+
+    @cached_property
+    def is_infographic(self) -> bool:
+        return is_infographic_page(self.page, self.drawing_stats)
+
+    @cached_property
+    def is_landscape(self) -> bool:
+        return pdf_page_is_landscape(self.page)
+
+    @cached_property
+    def text(self) -> str:
+        with self._step("text"):
+            return self.page.extract_text()
+
+    @cached_property
+    def images(self) -> List[Tuple[Dict, tuple]]:
+        """Significant images with their bbox clipped to the page"""
+        with self._step("images"):
+            return significant_images(self.page)
+
+    @cached_property
+    def may_contain_table(self) -> bool:
+        """False when the page has too few ruling edges to hold a table"""
+        stats = self.drawing_stats
+        with self._step("table_check"):
+            return may_contain_table(self.page, stats, self.table_settings)
+
+    @cached_property
+    def table_candidates(self) -> List[Table]:
+        """Tables found from the ruling lines of the page"""
+        if not self.may_contain_table:
+            return []
+        with self._step("tables"):
+            return self.page.find_tables(self.table_settings)
+
+    @cached_property
+    def tables(self) -> List[List[List[Optional[str]]]]:
+        """Cell texts of the table candidates, as `page.extract_tables()`"""
+        table_candidates = self.table_candidates
+        text_settings = TableSettings.resolve(self.table_settings).text_settings or {}
+        with self.timed("tables"):
+            return [table.extract(**text_settings) for table in table_candidates]
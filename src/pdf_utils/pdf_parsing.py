@@ -3,90 +3,163 @@ Define a pdf parser object that extract texts and images from doc
 while maintaining page information
 """
 
+import asyncio
+import functools
+import multiprocessing
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, List, Union
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import (AsyncIterator, Callable, Deque, Dict, List, Optional,
+                    Sequence, Tuple, Union)
 
+import pdfplumber
 from loguru import logger
 from pdfplumber.page import Page
 from pdfplumber.pdf import PDF as Doc
 
+from src.file_utils import FileContent, copy_file_content
 from src.models import FileImage, FileText, PageStats
 
-from .pdf_utils import (doc_exported_from_ppt, get_images_as_base64,
-                        is_infographic_page, page_extract_tables_md,
-                        page_to_base64, pdf_blob_to_pdfplumber_doc,
-                        pdf_page_is_landscape)
+from .page_analysis import PageAnalysis
+from .pdf_utils import (PageRaster, doc_exported_from_ppt, get_images_as_bytes,
+                        page_extract_tables_md, page_to_bytes,
+                        pdf_blob_to_pdfplumber_doc)
 
 
 def process_page_as_an_image(
-    page: Page, page_no: int, stats: PageStats
+    page: Page, page_no: int, stats: PageStats, raster: Optional[PageRaster] = None
 ) -> Dict[str, Union[List[FileText], List[FileImage]]]:
     """Process a page like the whole page is an image"""
     page_image = FileImage(
-        page_no=page_no, image_no=page_no, image_base64=page_to_base64(page, scale=2)
+        page_no=page_no,
+        image_no=page_no,
+        image_content=page_to_bytes(page, scale=2, raster=raster),
     )
     stats.update(has_text=False, has_images=True)
     return {"texts": [], "images": [page_image]}
 
 
 def process_regular_pdf_page(
-    page: Page, page_no: int, stats: PageStats
+    page: Page,
+    page_no: int,
+    stats: PageStats,
+    image_mode: str = "render",
+    table_settings: Optional[Dict] = None,
 ) -> Dict[str, Union[List[FileText], List[FileImage]]]:
     """Process regular PDF page with text and images"""
-    if is_infographic_page(page):
+    # Every image of the page is cut from a single render, freed with the page
+    with PageRaster(page) as raster:
+        analysis = PageAnalysis(page, table_settings)
+        return _process_regular_pdf_page(analysis, page_no, stats, image_mode, raster)
+
+
+def _process_regular_pdf_page(
+    analysis: PageAnalysis,
+    page_no: int,
+    stats: PageStats,
+    image_mode: str,
+    raster: PageRaster,
+) -> Dict[str, Union[List[FileText], List[FileImage]]]:
+    try:
+        return _process_analyzed_page(analysis, page_no, stats, image_mode, raster)
+    finally:
+        stats.add_timings(analysis.timings)
+        logger.debug(
+            f"Page {page_no} timings: "
+            + ", ".join(f"{k} {v * 1000:.1f}ms" for k, v in analysis.timings.items())
+        )
+
+
+def _process_analyzed_page(
+    analysis: PageAnalysis,
+    page_no: int,
+    stats: PageStats,
+    image_mode: str,
+    raster: PageRaster,
+) -> Dict[str, Union[List[FileText], List[FileImage]]]:
+    page = analysis.page
+
+    def as_an_image():
+        with analysis.timed("render"):
+            return process_page_as_an_image(page, page_no, stats, raster)
+
+    if analysis.is_infographic:
         logger.info(
             f"Page {page_no} contains multiple visual elements and will be treated as an image"
         )
-        return process_page_as_an_image(page, page_no, stats)
+        return as_an_image()
 
-    if pdf_page_is_landscape(page):
+    if analysis.is_landscape:
         logger.info(
             f"Page {page_no} has landscape layout and will be treated as an image"
         )
-        return process_page_as_an_image(page, page_no, stats)
+        return as_an_image()
+
+    text = analysis.text
 
-    text = page.extract_text()
-    images_base64 = get_images_as_base64(page)
+    # Decide on the image bboxes before extracting images: a page without
+    # text is rendered whole, its images alone would be thrown away
+    if not text and analysis.images:
+        logger.info(
+            f"Page {page_no} contains no text elements and will be treated as an image"
+        )
+        return as_an_image()
 
-    tables_str = page_extract_tables_md(page)
+    tables_str = page_extract_tables_md(page, tables=analysis.tables)
     tables: List[FileText] = [FileText(page_no=page_no, text=tab) for tab in tables_str]
 
     if not text:
-        if images_base64:
-            logger.info(
-                f"Page {page_no} contains no text elements and will be treated as an image"
-            )
-            return process_page_as_an_image(page, page_no, stats)
-        else:
-            logger.info(f"Page {page_no} contains no elements and will be skipped")
-            return {"texts": [], "images": [], "tables": tables}
+        logger.info(f"Page {page_no} contains no elements and will be skipped")
+        return {"texts": [], "images": [], "tables": tables}
+
+    with analysis.timed("render"):
+        images_bytes = get_images_as_bytes(
+            page, image_mode=image_mode, raster=raster, images=analysis.images
+        )
 
     # Process text and images
     texts = [FileText(page_no=page_no, text=text)]
     images = [
-        FileImage(page_no=page_no, image_base64=img, image_no=i)
-        for i, img in enumerate(images_base64)
+        FileImage(page_no=page_no, image_content=img, image_no=i)
+        for i, img in enumerate(images_bytes)
     ]
 
     stats.update(has_text=bool(text), has_images=bool(images))
     return {"texts": texts, "images": images, "tables": tables}
 
 
-def pdfplumber_extract_texts_and_images(doc: Doc, report: bool = False) -> Dict:
+def get_page_processor(
+    as_image: bool, image_mode: str = "render", table_settings: Optional[Dict] = None
+) -> Callable:
+    """Function processing (page, page_no, stats), for a whole document"""
+    if as_image:
+        return process_page_as_an_image
+    return functools.partial(
+        process_regular_pdf_page, image_mode=image_mode, table_settings=table_settings
+    )
+
+
+def pdfplumber_extract_texts_and_images(
+    doc: Doc,
+    report: bool = False,
+    max_workers: int = 4,
+    image_mode: str = "render",
+    table_settings: Optional[Dict] = None,
+) -> Dict:
     """Extract texts and images from a PDF document using controlled parallel processing"""
     stats = PageStats()
     all_texts: List[FileText] = []
     all_tables: List[FileText] = []
     all_images: List[FileImage] = []
 
-    process_fn = (
-        process_page_as_an_image
-        if doc_exported_from_ppt(doc)
-        else process_regular_pdf_page
+    process_fn = get_page_processor(
+        doc_exported_from_ppt(doc), image_mode, table_settings
     )
 
-    max_workers = min(4, os.cpu_count() or 1)  # Limit parallelism to avoid OOM
+    # Limit parallelism to avoid OOM
+    max_workers = min(max_workers, os.cpu_count() or 1)
     logger.info(f"Starts ThreadPoolExecutor with {max_workers} workers")
 
     try:
@@ -111,24 +184,390 @@ def pdfplumber_extract_texts_and_images(doc: Doc, report: bool = False) -> Dict:
     return {"texts": all_texts, "images": all_images, "tables": all_tables}
 
 
-def pdf_extract_texts_and_images(file_content: bytes) -> Dict:
+# One pool per worker count, created lazily and reused across files so the
+# interpreter start-up and imports are paid once per gunicorn worker.
+_process_pools: Dict[int, ProcessPoolExecutor] = {}
+
+
+def get_process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """Return the shared process pool with `max_workers` processes"""
+    pool = _process_pools.get(max_workers)
+    if pool is None:
+        logger.info(f"Starts ProcessPoolExecutor with {max_workers} workers")
+        # spawn: forking a process that runs an event loop and threads is unsafe
+        pool = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        _process_pools[max_workers] = pool
+    return pool
+
+
+def split_page_ranges(num_pages: int, num_ranges: int) -> List[range]:
+    """Split [0, num_pages) into at most `num_ranges` contiguous, balanced ranges"""
+    num_ranges = max(1, min(num_ranges, num_pages))
+    size, rest = divmod(num_pages, num_ranges)
+    ranges = []
+    start = 0
+    for i in range(num_ranges):
+        end = start + size + (1 if i < rest else 0)
+        ranges.append(range(start, end))
+        start = end
+    return [r for r in ranges if len(r)]
+
+
+def process_page_range(
+    pdf_path: str,
+    page_numbers: Sequence[int],
+    as_image: bool,
+    image_mode: str = "render",
+    table_settings: Optional[Dict] = None,
+) -> Dict:
+    """
+    Process worker entry point: open the PDF from disk once and process a
+    contiguous range of pages.
+
+    The file is shared with the parent through the OS page cache, so only the
+    page numbers travel to the worker and only the extracted payloads travel back.
+
+    Returns:
+        Dict with the per-page outputs in page order and the PageStats of the range
+    """
+    stats = PageStats()
+    pages = []
+
+    process_fn = get_page_processor(as_image, image_mode, table_settings)
+
+    # pdfplumber numbers pages from 1
+    with pdfplumber.open(pdf_path, pages=[n + 1 for n in page_numbers]) as doc:
+        for page in doc.pages:
+            page_no = page.page_number - 1
+            processing_output = process_fn(page, page_no, stats)
+            pages.append(
+                {
+                    "page_no": page_no,
+                    "texts": processing_output["texts"],
+                    "images": processing_output["images"],
+                    "tables": processing_output.get("tables", []),
+                }
+            )
+            page.close()
+
+    return {"pages": pages, "stats": stats}
+
+
+def pdfplumber_extract_texts_and_images_multiprocess(
+    pdf_path: str,
+    doc: Doc,
+    report: bool = False,
+    max_workers: int = 4,
+    image_mode: str = "render",
+    table_settings: Optional[Dict] = None,
+) -> Dict:
+    """
+    Extract texts and images by distributing page ranges over a process pool.
+
+    Args:
+        pdf_path: Path of the PDF file, opened independently by each worker
+        doc: The same PDF opened in this process, used for metadata and page count
+        report: Log page statistics when done
+        max_workers: Number of worker processes
+        image_mode: "native" or "render", see `get_images_as_bytes`
+        table_settings: pdfplumber table settings, the defaults if None
+
+    Returns:
+        Same structure as `pdfplumber_extract_texts_and_images`
+    """
+    stats = PageStats()
+    all_texts: List[FileText] = []
+    all_tables: List[FileText] = []
+    all_images: List[FileImage] = []
+
+    as_image = doc_exported_from_ppt(doc)
+    # A few ranges per worker keep the pool busy when some pages are much slower
+    page_ranges = split_page_ranges(len(doc.pages), max_workers * 2)
+
+    try:
+        pool = get_process_pool(max_workers)
+        futures = [
+            pool.submit(
+                process_page_range,
+                pdf_path,
+                list(page_range),
+                as_image,
+                image_mode,
+                table_settings,
+            )
+            for page_range in page_ranges
+        ]
+        # Collect in submission order so pages stay in document order
+        for future in futures:
+            range_output = future.result()
+            for processing_output in range_output["pages"]:
+                all_texts.extend(processing_output["texts"])
+                all_images.extend(processing_output["images"])
+                all_tables.extend(processing_output["tables"])
+            stats.merge(range_output["stats"])
+
+    except BrokenProcessPool:
+        # A worker died (most likely OOM-killed); drop the pool so the next file gets a fresh one
+        _process_pools.pop(max_workers, None)
+        logger.error("Process pool broke. Reducing concurrency may be required.")
+        raise
+
+    if report:
+        stats.log_summary(doc.metadata)
+
+    return {"texts": all_texts, "images": all_images, "tables": all_tables}
+
+
+def pdf_extract_texts_and_images(
+    file_content: FileContent,
+    mode: str = "thread",
+    max_workers: int = 4,
+    image_mode: str = "render",
+    table_settings: Optional[Dict] = None,
+) -> Dict:
+    """
+    Extract texts, images and tables from PDF bytes.
+
+    Args:
+        file_content: The PDF file content, bytes or a seekable binary file
+        mode: "thread" processes pages on a thread pool sharing one document,
+            "process" processes page ranges on a process pool
+        max_workers: Number of threads or processes
+        image_mode: "native" decodes embedded images from their streams,
+            "render" rasterizes them, see `get_images_as_bytes`
+        table_settings: pdfplumber table settings (`page.find_tables`),
+            the defaults if None
+
+    Returns:
+        Dict with texts, images, tables and num_pages
+    """
+    if mode not in ("thread", "process"):
+        raise ValueError(f"Unknown PDF extraction mode: {mode}")
+
     texts = []
     images = []
     tables = []
     num_pages = None
-    with pdf_blob_to_pdfplumber_doc(file_content) as doc:
-        # Create file metadata
-        num_pages = len(doc.pages)
-        extraction = pdfplumber_extract_texts_and_images(doc, report=True)
-        texts, images, tables = (
-            extraction["texts"],
-            extraction["images"],
-            extraction["tables"],
-        )
-        logger.info("Extracted raw texts and images")
+
+    if mode == "process":
+        # Workers read the file from disk instead of receiving pickled bytes
+        pdf_path = _write_temp_pdf(file_content)
+        try:
+            with pdfplumber.open(pdf_path) as doc:
+                num_pages = len(doc.pages)
+                extraction = pdfplumber_extract_texts_and_images_multiprocess(
+                    pdf_path,
+                    doc,
+                    report=True,
+                    max_workers=max_workers,
+                    image_mode=image_mode,
+                    table_settings=table_settings,
+                )
+        finally:
+            os.remove(pdf_path)
+    else:
+        with pdf_blob_to_pdfplumber_doc(file_content) as doc:
+            # Create file metadata
+            num_pages = len(doc.pages)
+            extraction = pdfplumber_extract_texts_and_images(
+                doc,
+                report=True,
+                max_workers=max_workers,
+                image_mode=image_mode,
+                table_settings=table_settings,
+            )
+
+    texts, images, tables = (
+        extraction["texts"],
+        extraction["images"],
+        extraction["tables"],
+    )
+    logger.info("Extracted raw texts and images")
     return {
         "texts": texts,
         "images": images,
         "tables": tables,
         "num_pages": num_pages,
     }
+
+
+def _process_and_close_page(process_fn, page: Page, page_no: int, stats: PageStats):
+    """Process a page then drop its cached layout objects"""
+    try:
+        return process_fn(page, page_no, stats)
+    finally:
+        page.close()
+
+
+def _doc_info(doc: Doc) -> Tuple[int, bool, Dict]:
+    """Number of pages, PowerPoint export, metadata. Blocking: parses the page tree"""
+    return len(doc.pages), doc_exported_from_ppt(doc), doc.metadata
+
+
+def _read_doc_info(pdf_path: str) -> Tuple[int, bool, Dict]:
+    with pdfplumber.open(pdf_path) as doc:
+        return _doc_info(doc)
+
+
+def _write_temp_pdf(file_content: FileContent) -> str:
+    """Copy the file content to a temporary PDF file, the caller removes it"""
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        copy_file_content(file_content, tmp)
+        return tmp.name
+
+
+async def pdf_aiter_pages(
+    file_content: FileContent,
+    mode: str = "thread",
+    max_workers: int = 4,
+    window: int = 8,
+    image_mode: str = "render",
+    table_settings: Optional[Dict] = None,
+) -> AsyncIterator[Dict]:
+    """
+    Stream the extraction of a PDF page by page.
+
+    Pages are parsed in the background (thread or process pool, see
+    `pdf_extract_texts_and_images`) and yielded in page order, with at most
+    `window` pages parsed ahead of the consumer. This bounds the memory held
+    by extracted pages and lets the caller index early pages while later
+    pages are still being parsed.
+
+    Yields:
+        Dict with page_no, num_pages, texts, images and tables of one page
+    """
+    if mode not in ("thread", "process"):
+        raise ValueError(f"Unknown PDF extraction mode: {mode}")
+
+    if mode == "process":
+        async for page_output in _pdf_aiter_pages_multiprocess(
+            file_content, max_workers, window, image_mode, table_settings
+        ):
+            yield page_output
+        return
+
+    loop = asyncio.get_running_loop()
+    stats = PageStats()
+    # Limit parallelism to avoid OOM
+    max_workers = min(max_workers, os.cpu_count() or 1)
+
+    # Opening, page tree parsing and teardown run off the event loop too
+    doc = await asyncio.to_thread(pdf_blob_to_pdfplumber_doc, file_content)
+    try:
+        num_pages, as_image, metadata = await asyncio.to_thread(_doc_info, doc)
+        process_fn = get_page_processor(as_image, image_mode, table_settings)
+        pages = enumerate(doc.pages)
+        pending: Deque[Tuple[int, asyncio.Future]] = deque()
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        def submit_next_page():
+            next_page = next(pages, None)
+            if next_page is not None:
+                page_no, page = next_page
+                future = loop.run_in_executor(
+                    executor,
+                    _process_and_close_page,
+                    process_fn,
+                    page,
+                    page_no,
+                    stats,
+                )
+                pending.append((page_no, future))
+
+        try:
+            for _ in range(max(window, 1)):
+                submit_next_page()
+
+            while pending:
+                page_no, future = pending.popleft()
+                processing_output = await future
+                submit_next_page()
+                yield {
+                    "page_no": page_no,
+                    "num_pages": num_pages,
+                    "texts": processing_output["texts"],
+                    "images": processing_output["images"],
+                    "tables": processing_output.get("tables", []),
+                }
+        finally:
+            # Consumer stopped early: do not start the remaining pages, and
+            # wait for the pages being parsed before closing the document
+            for _, future in pending:
+                future.cancel()
+            await asyncio.to_thread(executor.shutdown)
+
+        stats.log_summary(metadata)
+    finally:
+        await asyncio.to_thread(doc.close)
+
+
+async def _pdf_aiter_pages_multiprocess(
+    file_content: FileContent,
+    max_workers: int,
+    window: int,
+    image_mode: str,
+    table_settings: Optional[Dict],
+) -> AsyncIterator[Dict]:
+    """Process-pool flavour of `pdf_aiter_pages`, streaming small page ranges"""
+    stats = PageStats()
+
+    # Copying the file and reading its page tree run off the event loop
+    pdf_path = await asyncio.to_thread(_write_temp_pdf, file_content)
+    try:
+        num_pages, as_image, metadata = await asyncio.to_thread(
+            _read_doc_info, pdf_path
+        )
+
+        # One range per worker within `window` pages, so the whole pool is
+        # busy while `window` still caps the parsed pages waiting for the
+        # consumer. Small ranges also bring the first pages back early.
+        pages_per_range = max(1, window // max_workers)
+        page_ranges = iter(
+            range(start, min(start + pages_per_range, num_pages))
+            for start in range(0, num_pages, pages_per_range)
+        )
+        pool = get_process_pool(max_workers)
+        pending: Deque[asyncio.Future] = deque()
+
+        def submit_next_range():
+            page_range = next(page_ranges, None)
+            if page_range is not None:
+                pending.append(
+                    asyncio.wrap_future(
+                        pool.submit(
+                            process_page_range,
+                            pdf_path,
+                            list(page_range),
+                            as_image,
+                            image_mode,
+                            table_settings,
+                        )
+                    )
+                )
+
+        for _ in range(max(1, min(max_workers, window // pages_per_range))):
+            submit_next_range()
+
+        try:
+            while pending:
+                try:
+                    range_output = await pending.popleft()
+                except BrokenProcessPool:
+                    _process_pools.pop(max_workers, None)
+                    logger.error(
+                        "Process pool broke. Reducing concurrency may be required."
+                    )
+                    raise
+                submit_next_range()
+                stats.merge(range_output["stats"])
+                for processing_output in range_output["pages"]:
+                    yield {"num_pages": num_pages, **processing_output}
+        finally:
+            for future in pending:
+                future.cancel()
+
+        stats.log_summary(metadata)
+    finally:
+        await asyncio.to_thread(os.remove, pdf_path)
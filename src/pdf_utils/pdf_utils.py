@@ -1,30 +1,81 @@
-import base64
 import io
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 import pdfplumber
 from loguru import logger
+from pdfminer.pdftypes import resolve1
 from pdfplumber.page import Page
 from pdfplumber.pdf import PDF as Doc
+from PIL import Image
+
+from src.file_utils import FileContent
+
+# "native": decode embedded image streams, "render": rasterize each image bbox
+IMAGE_MODES = ("native", "render")
+
+# Resolution (DPI) of the images rendered from page areas
+IMAGE_CROP_RESOLUTION = 250
+
+# PIL mode of the color spaces whose samples decode without conversion
+_NATIVE_COLOR_MODES = {"DeviceRGB": "RGB", "DeviceGray": "L"}
+_NATIVE_ICC_MODES = {3: "RGB", 1: "L"}
 
 
 def get_page_drawings_stats(page: Page) -> Dict[str, int]:
-    """Count drawings by type: curve, line, quad, rectangle"""
+    """Count drawings by type: curve, line (all, horizontal, vertical), rectangle"""
 
     lines = page.lines
     hlines = [l for l in lines if l["y0"] == l["y1"]]
     vlines = [l for l in lines if l["x0"] == l["x1"]]
     return {
         "c": len(page.curves),
+        "l": len(lines),
         "hl": len(hlines),
         "vl": len(vlines),
         "re": len(page.rects),
     }
 
 
-def is_infographic_page(page: Page) -> bool:
+# Strategies finding tables from the ruling lines drawn on the page only
+_RULING_STRATEGIES = ("lines", "lines_strict")
+
+
+def may_contain_table(
+    page: Page, stats: Dict[str, int], table_settings: Optional[Dict] = None
+) -> bool:
+    """
+    Cheap check that the page has enough ruling edges for `page_extract_tables_md`
+    to return a table, from the drawing stats: a table of 2 rows or more
+    (single row tables are dropped) needs 3 horizontal and 2 vertical edges.
+
+    It counts every edge pdfplumber could use (each rectangle has 2 of each,
+    and like pdfplumber non-horizontal lines count as vertical), so a page
+    failing it has no table. Always True when the settings find tables
+    from text or explicit lines.
+    """
+    settings = table_settings or {}
+    if any(
+        settings.get(f"{orientation}_strategy", "lines") not in _RULING_STRATEGIES
+        or settings.get(f"explicit_{orientation}_lines")
+        for orientation in ("vertical", "horizontal")
+    ):
+        return True
+
+    num_h = stats["hl"] + 2 * stats["re"]
+    num_v = stats["l"] - stats["hl"] + 2 * stats["re"]
+    if stats["c"] and (num_h < 3 or num_v < 2):
+        for edge in page.curve_edges:
+            if edge["orientation"] == "h":
+                num_h += 1
+            elif edge["orientation"] == "v":
+                num_v += 1
+    return num_h >= 3 and num_v >= 2
+
+
+def is_infographic_page(page: Page, stats: Optional[Dict[str, int]] = None) -> bool:
     """Check if page contains multiple visual components"""
-    stats = get_page_drawings_stats(page)
+    if stats is None:
+        stats = get_page_drawings_stats(page)
     n_elements = sum(v for k, v in stats.items() if k in ("vl", "c"))
     n_elements += len(page.images)
     return n_elements >= 9
@@ -38,16 +89,94 @@ def doc_exported_from_ppt(pdf: Doc) -> bool:
     )
 
 
-def page_to_base64(page: Page, format: str = "PNG", scale: int = 2) -> str:
-    """Convert whole page to base64 image"""
-    # Convert page to image using pdfplumber's native method
-    img = page.to_image(resolution=72 * scale)
+class PageRaster:
+    """
+    Bitmap of a whole page, rendered on first use and shared by every image
+    cut from the page (whole page or image crops), so a page is rendered
+    once instead of once per image. Rendering is the costliest step of
+    image-heavy pages.
+
+    The page is rendered at the highest resolution asked for, lower ones are
+    downscaled from it. Call `close` once the page is done to free the bitmap.
+    """
+
+    def __init__(self, page: Page, resolution: float = 0):
+        """
+        Args:
+            page (Page): The page to render
+            resolution (float): Min resolution of the render (DPI), when the
+                highest resolution needed for the page is known beforehand
+        """
+        self.page = page
+        self.min_resolution = resolution
+        self._image: Optional[Image.Image] = None
+        self._resolution = 0.0
+
+    def render(self, resolution: float) -> Image.Image:
+        """Whole page bitmap at `resolution` DPI or more"""
+        if self._image is None or self._resolution < resolution:
+            self.close()
+            self._resolution = max(resolution, self.min_resolution)
+            self._image = self.page.to_image(resolution=self._resolution).original
+        return self._image
+
+    def _rescale(self, image: Image.Image, resolution: float) -> Image.Image:
+        if resolution == self._resolution:
+            return image
+        ratio = resolution / self._resolution
+        size = (max(1, round(image.width * ratio)), max(1, round(image.height * ratio)))
+        return image.resize(size, Image.LANCZOS)
+
+    def page_image(self, resolution: float) -> Image.Image:
+        """The whole page at `resolution` DPI"""
+        return self._rescale(self.render(resolution), resolution)
+
+    def crop(self, bbox: tuple, resolution: float) -> Image.Image:
+        """The page area `bbox` (page coordinates) at `resolution` DPI"""
+        image = self.render(resolution)
+        # The bitmap covers the page cropbox, like `Page.to_image`
+        x0, top = self.page.cropbox[0], self.page.cropbox[1]
+        scale = image.width / (self.page.cropbox[2] - x0)
+        # Same rounding as `within_bbox(bbox).to_image()`, for the same pixels
+        left, upper = -int((x0 - bbox[0]) * scale), -int((top - bbox[1]) * scale)
+        box = (
+            left,
+            upper,
+            left + int((bbox[2] - bbox[0]) * scale),
+            upper + int((bbox[3] - bbox[1]) * scale),
+        )
+        return self._rescale(image.crop(box), resolution)
+
+    def close(self) -> None:
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+
+    def __enter__(self) -> "PageRaster":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def page_to_bytes(
+    page: Page,
+    format: str = "PNG",
+    scale: int = 2,
+    raster: Optional[PageRaster] = None,
+) -> bytes:
+    """Convert whole page to an encoded image, cut from `raster` if given"""
+    if raster is not None:
+        img = raster.page_image(72 * scale)
+    else:
+        # Convert page to image using pdfplumber's native method
+        img = page.to_image(resolution=72 * scale).original
 
     # Get the image as bytes
     img_buffer = io.BytesIO()
-    img.original.save(img_buffer, format=format)
+    img.save(img_buffer, format=format)
 
-    return base64.b64encode(img_buffer.getvalue()).decode()
+    return img_buffer.getvalue()
 
 
 def pdf_page_is_landscape(page: Page, ratio=1.2) -> bool:
@@ -67,7 +196,11 @@ def pdf_page_is_landscape(page: Page, ratio=1.2) -> bool:
     return width > (height * ratio)
 
 
-def page_extract_tables_md(page: Page, preserve_linebreaks: bool = False) -> list[str]:
+def page_extract_tables_md(
+    page: Page,
+    preserve_linebreaks: bool = False,
+    tables: Optional[List[List[List[Optional[str]]]]] = None,
+) -> list[str]:
     """
     Extract tables from a PDF page and convert them to markdown format.
 
@@ -75,6 +208,7 @@ def page_extract_tables_md(page: Page, preserve_linebreaks: bool = False) -> lis
         page: A pdfplumber Page object
         preserve_linebreaks: If True, converts newlines to HTML <br> tags.
                            If False, replaces newlines with spaces.
+        tables: Tables already extracted from the page, if any
 
     Returns:
         list[str]: List of tables in markdown format
@@ -82,7 +216,8 @@ def page_extract_tables_md(page: Page, preserve_linebreaks: bool = False) -> lis
     markdown_tables = []
 
     # Extract tables from the page
-    tables = page.extract_tables()
+    if tables is None:
+        tables = page.extract_tables()
 
     for table in tables:
         if (not table) or (len(table) == 1):  # Skip empty tables or single row table
@@ -152,17 +287,22 @@ def page_extract_tables_md(page: Page, preserve_linebreaks: bool = False) -> lis
     return markdown_tables
 
 
-def pdf_blob_to_pdfplumber_doc(blob: bytes) -> Doc:
+def pdf_blob_to_pdfplumber_doc(blob: FileContent) -> Doc:
     """
     Converts a PDF byte blob into a pdfplumber PDF object.
 
     Args:
-        blob (bytes): A byte blob representing a PDF file.
+        blob (bytes): A byte blob representing a PDF file, or a seekable
+            binary file, read in place (closing the PDF leaves it open).
 
     Returns:
         pdfplumber.PDF: The pdfplumber PDF object created from the byte blob.
     """
-    return pdfplumber.open(io.BytesIO(blob))
+    if isinstance(blob, bytes):
+        blob = io.BytesIO(blob)
+    else:
+        blob.seek(0)
+    return pdfplumber.open(blob)
 
 
 def insignificant_image(image_bbox: tuple):
@@ -179,38 +319,143 @@ def insignificant_image(image_bbox: tuple):
     return 0
 
 
-def get_images_as_base64(page: Page) -> List[str]:
+def _image_color_mode(image: Dict) -> Optional[str]:
+    """PIL mode of an image XObject, None if its color space needs converting"""
+    colorspace = image.get("colorspace") or []
+    if not colorspace:
+        return None
+    name = getattr(colorspace[0], "name", colorspace[0])
+    if name == "ICCBased" and len(colorspace) > 1:
+        # [/ICCBased stream]: the number of components of the profile decides
+        profile = resolve1(colorspace[1])
+        return _NATIVE_ICC_MODES.get(resolve1(profile.attrs.get("N")))
+    return _NATIVE_COLOR_MODES.get(name)
+
+
+def extract_native_image(image: Dict) -> Optional[bytes]:
     """
-    Converts all images on a given page to base64-encoded strings with high quality.
+    Encoded bytes of an image XObject at its native resolution, without
+    rendering: JPEG (DCTDecode) streams are passed through as-is, 8-bit RGB
+    or grayscale samples (Flate or unfiltered) are encoded as PNG.
 
-    Args:
-        page (pdfplumber.page.Page): A single page of a pdfplumber document.
+    Returns None when the image must be rendered to look like it does on
+    the page: masks, soft masks, Decode arrays, other color spaces (CMYK,
+    Indexed...), bit depths or filters (JBIG2, JPX, CCITT...).
 
-    Returns:
-        List[str]: A list of base64-encoded strings, each representing a high-quality image on the page.
+    Args:
+        image (Dict): An item of `page.images`
+    """
+    stream = image.get("stream")
+    if stream is None or image.get("imagemask"):
+        return None
+    if any(key in stream.attrs for key in ("SMask", "Mask", "Decode")):
+        return None
+    mode = _image_color_mode(image)
+    if mode is None:
+        return None
+
+    filters = [getattr(f, "name", f) for f, _ in stream.get_filters()]
+    if filters and filters[-1] in ("DCTDecode", "DCT"):
+        # pdfminer applies the filters before DCT and leaves the JPEG encoded
+        return stream.get_data()
+
+    if any(f not in ("FlateDecode", "Fl") for f in filters):
+        return None
+    if image.get("bits") != 8:
+        return None
+
+    width, height = image["srcsize"]
+    size = width * height * len(mode)
+    data = stream.get_data()
+    if len(data) < size:
+        return None
+    buffer = io.BytesIO()
+    Image.frombytes(mode, (width, height), data[:size]).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def significant_images(page: Page) -> List[Tuple[Dict, tuple]]:
     """
-    base64_images = []
+    The images of a page worth extracting, with their bbox clipped to the page
+    """
+    x0, top, x1, bottom = page.bbox
+    images = []
     for k, image in enumerate(page.images):
-        # Extract the bounding box of the image
-        bbox = (image["x0"], image["top"], image["x1"], image["bottom"])
-
+        # Extract the bounding box of the image, within the page
+        bbox = (
+            max(image["x0"], x0),
+            max(image["top"], top),
+            min(image["x1"], x1),
+            min(image["bottom"], bottom),
+        )
         if insignificant_image(bbox):
             logger.info(f"Ignoring {k+1}th image in {page} due to insignificant size")
             continue
-        # Crop the image from the page
-        cropped_page = page.within_bbox(bbox)
-        if cropped_page:
-            # Render a high-quality rasterized version of the cropped page
-            pil_image = cropped_page.to_image(
-                resolution=250
-            ).original  # Use high resolution
-
-            # Save as PNG into a BytesIO buffer for lossless compression
-            buffer = io.BytesIO()
-            pil_image.save(buffer, format="PNG")
-
-            # Encode the image to base64
-            base64_image = base64.b64encode(buffer.getvalue()).decode("utf-8")
-            base64_images.append(base64_image)
-
-    return base64_images
+        images.append((image, bbox))
+    return images
+
+
+def render_image_crop(
+    page: Page, bbox: tuple, raster: Optional[PageRaster] = None
+) -> bytes:
+    """PNG of the page area `bbox`, cut from the page rendered at 250 DPI"""
+    if raster is None:
+        with PageRaster(page) as raster:
+            return render_image_crop(page, bbox, raster)
+
+    # Save as PNG into a BytesIO buffer for lossless compression
+    buffer = io.BytesIO()
+    raster.crop(bbox, IMAGE_CROP_RESOLUTION).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def get_images_as_bytes(
+    page: Page,
+    image_mode: str = "render",
+    raster: Optional[PageRaster] = None,
+    images: Optional[List[Tuple[Dict, tuple]]] = None,
+) -> List[bytes]:
+    """
+    Converts all images on a given page to encoded images (PNG, JPEG) with high quality.
+
+    Args:
+        page (pdfplumber.page.Page): A single page of a pdfplumber document.
+        image_mode (str): "native" decodes the embedded image streams and only
+            renders the images it cannot decode as they appear (see
+            `extract_native_image`), "render" renders every image.
+        raster (PageRaster): Render of the page to cut the rendered images
+            from, one is created for this call if None.
+        images (List): `significant_images(page)`, if already known.
+
+    Returns:
+        List[bytes]: A list of encoded images, each representing a high-quality image on the page.
+    """
+    if image_mode not in IMAGE_MODES:
+        raise ValueError(f"Unknown PDF image mode: {image_mode}")
+
+    if raster is None:
+        with PageRaster(page) as raster:
+            return get_images_as_bytes(page, image_mode, raster, images)
+
+    if images is None:
+        images = significant_images(page)
+    images_bytes = []
+    for image, bbox in images:
+        image_bytes = None
+        # An image partly off the page is cropped by the page: render what shows
+        fully_on_page = bbox == (
+            image["x0"],
+            image["top"],
+            image["x1"],
+            image["bottom"],
+        )
+        if image_mode == "native" and fully_on_page:
+            try:
+                image_bytes = extract_native_image(image)
+            except Exception as e:
+                logger.warning(f"Cannot decode image at {bbox} in {page}: {e}")
+        if image_bytes is None:
+            image_bytes = render_image_crop(page, bbox, raster)
+        images_bytes.append(image_bytes)
+
+    return images_bytes
@@ -1,24 +1,32 @@
 import asyncio
-from typing import (Any, Callable, Dict, List, NamedTuple, Optional, TypedDict,
-                    Union)
+import time
+from typing import (Any, AsyncIterator, Callable, Dict, Iterable, Iterator,
+                    List, NamedTuple, Optional, TypedDict, Union)
 
 from loguru import logger
 
 from src.azure_container_client import AzureContainerClient
 from src.docx_parsing import (doc_extract_texts_and_images,
                               docx_extract_texts_and_images)
+from src.docx_parsing.doc_conversion import LibreOfficePool
+from src.docx_parsing.docx_stream import docx_iter_pages
 from src.file_summarizer import FileSummarizer
-from src.file_utils import detect_file_type
+from src.file_utils import detect_file_type, read_file_content
 from src.image_descriptor import ImageDescription, ImageDescriptor
 from src.image_utils import image_file_extract
+from src.image_utils.normalization import ImageNormalizer, NormalizationReport
+from src.metrics import (CHUNKS, FILE_SECONDS, FILES, FILES_IN_FLIGHT, IMAGES,
+                         PAGES, STAGE_SECONDS, count_error, current_file_type,
+                         stage_timer)
 from src.models import (BaseChunk, FileImage, FileText, MyFile, MyFileMetaData,
                         PageRange)
-from src.pdf_utils.pdf_parsing import pdf_extract_texts_and_images
+from src.pdf_utils.pdf_parsing import (pdf_aiter_pages,
+                                       pdf_extract_texts_and_images)
 from src.pii_scanning import check_pii_async, check_sensitive_information
 from src.splitters import SimplePageTextSplitter
 from src.txt_utils import txt_extract_texts
 from src.upload_metadata import create_file_upload_metadata
-from src.vector_stores import MyAzureSearch
+from src.vector_stores import IndexingReport, MyAzureSearch
 
 
 class ProcessingResult(TypedDict):
@@ -28,6 +36,7 @@ class ProcessingResult(TypedDict):
     num_pages: int
     num_texts: int
     num_images: int
+    image_bytes_saved: int
     metadata: Any
     errors: Optional[List[str]]
 
@@ -89,6 +98,19 @@ class Pipeline:
         file_summarizer: FileSummarizer,
         image_container_client: AzureContainerClient,
         pii_service_endpoint: str,
+        pdf_extraction_mode: str = "thread",
+        pdf_extraction_workers: int = 4,
+        pdf_process_min_pages: int = 0,
+        pdf_image_mode: str = "render",
+        pdf_table_settings: Optional[Dict] = None,
+        page_window: int = 8,
+        index_batch_size: int = 100,
+        max_pending_index_batches: int = 2,
+        parsing_concurrency: int = 2,
+        image_normalizer: Optional[ImageNormalizer] = None,
+        image_spill_bytes: int = 0,
+        image_spill_dir: Optional[str] = None,
+        doc_converter: Optional[LibreOfficePool] = None,
     ):
         """Initialize the pipeline with necessary components
 
@@ -99,6 +121,27 @@ class Pipeline:
             text_splitter: Text splitting strategy
             image_descriptor: OpenAI client wrapper for image description
             image_container_client: client wrapper for image storage
+            pdf_extraction_mode: "thread" or "process" pool for PDF pages
+            pdf_extraction_workers: Size of the PDF page pool
+            pdf_process_min_pages: PDFs estimated (by the preflight) to have
+                at least this many pages use the process pool whatever
+                pdf_extraction_mode is (0: never)
+            pdf_image_mode: "render" rasterizes embedded PDF images,
+                "native" decodes them from their streams
+            pdf_table_settings: pdfplumber table settings of PDF pages,
+                the defaults if None
+            page_window: Max number of PDF pages parsed ahead of indexing
+            index_batch_size: Number of chunks (or tables) indexed together
+            max_pending_index_batches: Max number of batches waiting for indexing
+                before parsing pauses
+            parsing_concurrency: Max number of files parsed at the same time
+            image_normalizer: Shrinks the extracted images before they are
+                described and uploaded, images are kept as extracted if None
+            image_spill_bytes: Images larger than this are held in temporary
+                files until the file is processed (0: always in memory)
+            image_spill_dir: Directory of these files, the system default if None
+            doc_converter: LibreOffice pool converting .doc files to .docx,
+                a LibreOffice process is started per file if None
         """
         self.text_vector_store = text_vector_store
         self.image_vector_store = image_vector_store
@@ -109,6 +152,20 @@ class Pipeline:
         self.file_summarizer = file_summarizer
         self.image_container_client = image_container_client
         self.pii_service_endpoint = pii_service_endpoint
+        self.pdf_extraction_mode = pdf_extraction_mode
+        self.pdf_extraction_workers = pdf_extraction_workers
+        self.pdf_process_min_pages = pdf_process_min_pages
+        self.pdf_image_mode = pdf_image_mode
+        self.pdf_table_settings = pdf_table_settings
+        self.page_window = page_window
+        self.index_batch_size = index_batch_size
+        self.max_pending_index_batches = max_pending_index_batches
+        # Shared by all the files processed by this worker
+        self._parsing_slots = asyncio.Semaphore(parsing_concurrency)
+        self.image_normalizer = image_normalizer
+        self.image_spill_bytes = image_spill_bytes
+        self.image_spill_dir = image_spill_dir
+        self.doc_converter = doc_converter
 
     async def _process_images(
         self, images: List[FileImage], summary, max_concurrent_requests: int = 50
@@ -118,19 +175,34 @@ class Pipeline:
 
         async def process_single_image(image):
             async with semaphore:
-                return await self.image_descriptor.run(image.image_base64, summary)
+                return await self.image_descriptor.run(image, summary)
 
-        tasks = [process_single_image(img) for img in images]
-        return await asyncio.gather(*tasks)
+        with stage_timer("image_description"):
+            if self.image_descriptor.batch_size > 1:
+                # Several images per request, within the shared model call limit
+                descriptions = await self.image_descriptor.run_batches(images, summary)
+            else:
+                tasks = [process_single_image(img) for img in images]
+                descriptions = await asyncio.gather(*tasks)
+
+        if self.image_descriptor.cache:
+            self.image_descriptor.cache.log_counters()
+        return descriptions
 
     def _create_text_chunks(
-        self, texts: List[FileText], file_metadata: MyFileMetaData, chunking=True
+        self,
+        texts: List[FileText],
+        file_metadata: MyFileMetaData,
+        chunking=True,
+        start_index: int = 0,
     ) -> Dict[str, List[Any]]:
         """Create text chunks and their metadata
 
         Args:
             texts: List of text objects
             file_metadata: Metadata about the file
+            start_index: Number of the first whole-text chunk, when texts
+                are added in several batches without chunking
 
         Returns:
             Tuple containing lists of texts and their metadata
@@ -142,7 +214,7 @@ class Pipeline:
         else:
             text_chunks = [
                 BaseChunk(
-                    chunk_no=f"whole{i}",  # whole thing as a chunk
+                    chunk_no=f"whole{start_index + i}",  # whole thing as a chunk
                     chunk=text.text,
                     page_range=PageRange(
                         start_page=text.page_no, end_page=text.page_no
@@ -186,25 +258,7 @@ class Pipeline:
         result = await self.text_vector_store.add_entries(
             texts=text_chunking_output["texts"],
             metadatas=text_chunking_output["metadatas"],
-        )
-        return result
-
-    async def _create_and_add_text_chunks(
-        self, texts: List[FileText], file_metadata: MyFileMetaData, chunking=True
-    ):
-        """Combine creation and adding of text chunks"""
-        if not texts:
-            return None
-
-        text_chunking_output = self._create_text_chunks(
-            texts, file_metadata, chunking=chunking
-        )
-        input_texts, input_metadatas = (
-            text_chunking_output["texts"],
-            text_chunking_output["metadatas"],
-        )
-        result = await self.text_vector_store.add_entries(
-            texts=input_texts, metadatas=input_metadatas
+            token_counts=text_chunking_output.get("token_counts"),
         )
         return result
 
@@ -219,7 +273,7 @@ class Pipeline:
         Remove chunk that are not of interest
         """
         if not images:
-            return {"status": "no_images", "image_metadatas": []}
+            return {"status": "no_images", "image_metadatas": [], "images": []}
 
         REMOVE_IMAGES = ["logo", "shape", "icon"]  # This should be declared in a config
         # Filter images and descriptions based on image_type
@@ -234,7 +288,11 @@ class Pipeline:
                 logger.debug(f"removed {description.image_type}")
 
         if not filtered_images:
-            return {"status": "no_relevant_images", "image_metadatas": []}
+            return {
+                "status": "no_relevant_images",
+                "image_metadatas": [],
+                "images": [],
+            }
 
         image_chunking_output = self._create_image_chunks(
             filtered_images, filtered_descriptions, file_metadata
@@ -248,19 +306,23 @@ class Pipeline:
             metadatas=image_metadatas,
             filter_by_min_len=10,
         )
-        return {"result": result, "image_metadatas": image_metadatas}
+        return {
+            "result": result,
+            "image_metadatas": image_metadatas,
+            "images": filtered_images,
+        }
 
     async def _create_summary(self, texts: List[str], images: List[FileImage]) -> str:
         """Just create the summary"""
 
-        return await self.file_summarizer.run(texts, images)
+        with stage_timer("summary"):
+            return await self.file_summarizer.run(texts, images)
 
-    async def _add_file_summary_to_store(
+    def _create_summary_chunk(
         self, summary: str, file_metadata: MyFileMetaData
-    ):
+    ) -> Dict[str, List[Any]]:
         logger.debug(f"file_metadata = {file_metadata}")
-        """Add the summary to vector store"""
-        summary_output = self.summary_vector_store.create_texts_and_metadatas(
+        return self.summary_vector_store.create_texts_and_metadatas(
             [
                 BaseChunk(
                     chunk=summary,
@@ -271,6 +333,9 @@ class Pipeline:
             file_metadata,
             prefix="summary",
         )
+
+    async def _add_file_summary_to_store(self, summary_output: Dict[str, List[Any]]):
+        """Add the summary to vector store"""
         summary_texts, summary_metadatas = (
             summary_output["texts"],
             summary_output["metadatas"],
@@ -280,110 +345,315 @@ class Pipeline:
             texts=summary_texts, metadatas=summary_metadatas
         )
 
-    @staticmethod
+    async def _delete_uploads(
+        self, document_keys: Dict[str, List[str]], blob_names: List[str]
+    ) -> List[str]:
+        """
+        Delete the documents and image blobs uploaded for a file, by index
+        ("text", "image", "summary") and blob name, returns the errors
+        """
+        errors = []
+        vector_stores = {
+            "text": self.text_vector_store,
+            "image": self.image_vector_store,
+            "summary": self.summary_vector_store,
+        }
+        for prefix, keys in document_keys.items():
+            if not keys:
+                continue
+            vector_store = vector_stores[prefix]
+            try:
+                await vector_store.delete_documents(keys)
+            except Exception as e:
+                error_msg = (
+                    f"Could not delete the documents indexed in "
+                    f"{vector_store.index_name}: {str(e)}"
+                )
+                logger.error(error_msg)
+                errors.append(error_msg)
+                count_error("cleanup")
+
+        if blob_names:
+            failed = await self.image_container_client.delete_images_from_blob(
+                blob_names
+            )
+            if failed:
+                error_msg = f"Could not delete {len(failed)} uploaded image blobs: " + (
+                    ", ".join(f"{i['blob_name']} ({i['error']})" for i in failed)
+                )
+                logger.error(error_msg)
+                errors.append(error_msg)
+                count_error("cleanup")
+        return errors
+
+    def _file_type(self, file: MyFile) -> str:
+        """Type found by the preflight, or detected from the content"""
+        return file.file_type or detect_file_type(file.file_content)
+
+    def _pdf_extraction_mode(self, file: MyFile) -> str:
+        """Large PDFs (as estimated by the preflight) go to the process pool"""
+        if (
+            self.pdf_process_min_pages
+            and file.num_pages
+            and file.num_pages >= self.pdf_process_min_pages
+        ):
+            return "process"
+        return self.pdf_extraction_mode
+
     def extract_texts_and_images(
-        file: MyFile,
+        self, file: MyFile, file_type: Optional[str] = None
     ) -> Dict[str, Union[List[FileText], List[FileImage]]]:
         extraction: Dict = {"texts": [], "images": [], "num_pages": None}
 
-        file_type: str = detect_file_type(file.file_content)
+        if file_type is None:
+            file_type = self._file_type(file)
 
         logger.debug(f"File type {file_type} detected")
         if file_type == "pdf":
-            extraction = pdf_extract_texts_and_images(file.file_content)
+            extraction = pdf_extract_texts_and_images(
+                file.file_content,
+                mode=self._pdf_extraction_mode(file),
+                max_workers=self.pdf_extraction_workers,
+                image_mode=self.pdf_image_mode,
+                table_settings=self.pdf_table_settings,
+            )
         elif file_type == "docx":
             extraction = docx_extract_texts_and_images(file.file_content)
         elif file_type == "doc":
             extraction = doc_extract_texts_and_images(file.file_content)
         elif file_type == "txt":
-            extraction = txt_extract_texts(file.file_content)
+            extraction = txt_extract_texts(read_file_content(file.file_content))
         elif file_type in ("jpg", "jpeg", "png"):
-            extraction = image_file_extract(file.file_content)
+            extraction = image_file_extract(read_file_content(file.file_content))
         else:
             raise ValueError(f"File type {file_type} not supported")
 
         return extraction
 
+    async def aiter_extracted_pages(
+        self, file: MyFile, file_type: Optional[str] = None
+    ) -> AsyncIterator[Dict]:
+        """
+        Stream the extraction result as batches of texts, images and tables.
+
+        PDFs are parsed in the background and yielded page by page, .docx
+        (and converted .doc) files are streamed page by page off the event
+        loop. Other file types are extracted in one go, off the event loop,
+        and yielded as a single batch.
+
+        A file holds a parsing slot until it is fully extracted.
+        """
+        if file_type is None:
+            file_type = self._file_type(file)
+
+        if file_type == "pdf":
+            logger.debug(f"File type {file_type} detected")
+            async with self._parsing_slots:
+                async for page in pdf_aiter_pages(
+                    file.file_content,
+                    mode=self._pdf_extraction_mode(file),
+                    max_workers=self.pdf_extraction_workers,
+                    window=self.page_window,
+                    image_mode=self.pdf_image_mode,
+                    table_settings=self.pdf_table_settings,
+                ):
+                    yield page
+            return
+
+        if file_type == "docx" or (file_type == "doc" and self.doc_converter):
+            logger.debug(f"File type {file_type} detected")
+            async with self._parsing_slots:
+                docx_content = file.file_content
+                if file_type == "doc":
+                    # Converted off the event loop and without holding a thread
+                    docx_content = await self.doc_converter.convert(docx_content)
+                async for page in _aiter_in_thread(docx_iter_pages(docx_content)):
+                    yield page
+            return
+
+        async with self._parsing_slots:
+            extraction = await asyncio.to_thread(
+                self.extract_texts_and_images, file, file_type
+            )
+        yield {
+            "num_pages": extraction.get("num_pages") or 0,
+            "texts": extraction.get("texts", []),
+            "images": extraction.get("images", []),
+            "tables": extraction.get("tables", []),
+        }
+
+    def _spill_images(self, images: List[FileImage]) -> None:
+        """Move the large images to temporary files. Blocking."""
+        for image in images:
+            if image.num_bytes > self.image_spill_bytes:
+                image.spill(self.image_spill_dir)
+
+    async def _scan_pii(self, file_name: str, texts: List[FileText]):
+        """Raise if the PII scanning service detects sensitive information"""
+        logger.debug(f"Sending request to PII Scanning service ... ")
+
+        pii_scan_result = await check_pii_async(
+            service_endpoint=self.pii_service_endpoint,
+            documents=[
+                dict(
+                    doc_name=file_name,
+                    doc_file_text=[i.model_dump() for i in texts],
+                    language="ja",  # Japanese
+                )
+            ],
+        )
+        logger.debug(pii_scan_result)
+
+        try:
+            check_sensitive_information(pii_scan_result)
+            logger.debug("PII Scanning completed without issues!")
+        except Exception as e:
+            logger.error(
+                f"PII Scanning found issues. Will not index this file: {file_name}. \n"
+                + str(e)
+            )
+            raise e
+
     async def process_file(self, file: MyFile, pii_scanning: bool) -> ProcessingResult:
-        """Process a single file through the pipeline with optimized concurrent operations"""
+        """
+        Process a single file through the pipeline with optimized concurrent operations
+
+        Text chunks and tables are embedded and indexed in batches while later
+        pages are still being parsed. Images are kept until the file summary,
+        which is the context of their descriptions, is ready.
+        """
 
         errors = []
         file_name = file.file_name
+        indexing_tasks: List[asyncio.Task] = []
+        indexing_reports: List[Optional[IndexingReport]] = []
+        images: List[FileImage] = []
+        file_metadata: Optional[MyFileMetaData] = None
+        # Summary, summary upload and image upload tasks
+        tasks: Dict[str, asyncio.Task] = {}
+        # Keys of the documents sent to each index and names of the image
+        # blobs, recorded before their upload: what a fatal error cleans up
+        document_keys: Dict[str, List[str]] = {"text": [], "image": [], "summary": []}
+        blob_names: List[str] = []
+
+        # Metrics of the stages are labelled with the type of the file, once known
+        file_type = "unknown"
+        file_type_token = current_file_type.set(file_type)
+        FILES_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        status = "failed"
 
         try:
-            texts: List[FileText] = []
-            images: List[FileImage] = []
+            file_type = self._file_type(file)
+            current_file_type.set(file_type)
+            chunk_texts: List[str] = []  # Sampled by the summarizer
+            num_texts: int = 0
+            num_tables: int = 0
             num_pages: int = 0
+            normalization = NormalizationReport()
 
             # Convert PDF to document
-            file_metadata: MyFileMetaData = create_file_upload_metadata(file)
+            file_metadata = create_file_upload_metadata(file)
             logger.info(f"Created file upload metadata: {file_metadata}")
 
-            content_extraction_result = self.extract_texts_and_images(file)
-
-            texts, images, tables, num_pages = (
-                content_extraction_result.get("texts", []),
-                content_extraction_result.get("images", []),
-                content_extraction_result.get("tables", []),
-                content_extraction_result.get("num_pages", 0),
-            )
-            logger.info("Extracted raw texts and images")
-            logger.info(
-                f"no. texts: {len(texts)}\nno. images: {len(images)}\nno. tables: {len(tables)}\nno. pages: {num_pages}"
+            page_batches = _timed_aiter(
+                self.aiter_extracted_pages(file, file_type), "extraction"
             )
 
-            summary = ""
-            # Create tasks dict to track all async operations
-            tasks = {}
-
             if pii_scanning:
+                # Nothing may be indexed before the whole text has been scanned
+                buffered_batches = [batch async for batch in page_batches]
+                with stage_timer("pii_scan"):
+                    await self._scan_pii(
+                        file_name,
+                        [text for batch in buffered_batches for text in batch["texts"]],
+                    )
+                page_batches = _aiter(buffered_batches)
 
-                ###### START SCANNING FOR SENSITIVE INFORMATION
-                logger.debug(f"Sending request to PII Scanning service ... ")
+            # Backpressure: parsing waits while too many batches wait for indexing
+            indexing_slots = asyncio.Semaphore(self.max_pending_index_batches)
 
-                pii_scan_result = await check_pii_async(
-                    service_endpoint=self.pii_service_endpoint,
-                    documents=[
-                        dict(
-                            doc_name=file_name,
-                            doc_file_text=[i.model_dump() for i in texts],
-                            language="ja",  # Japanese
-                        )
-                    ],
+            async def index_in_background(text_chunking_output):
+                await indexing_slots.acquire()
+                document_keys["text"].extend(
+                    metadata.chunk_id for metadata in text_chunking_output["metadatas"]
+                )
+                task = asyncio.create_task(self._add_text_chunks(text_chunking_output))
+                task.add_done_callback(lambda _: indexing_slots.release())
+                indexing_tasks.append(task)
+
+            async def flush_chunks(chunks: List[BaseChunk]):
+                chunk_texts.extend(chunk.chunk for chunk in chunks)
+                CHUNKS.labels(file_type, "text").inc(len(chunks))
+                await index_in_background(
+                    self.text_vector_store.create_texts_and_metadatas(
+                        chunks, file_metadata, prefix="text"
+                    )
                 )
-                logger.debug(pii_scan_result)
 
-                try:
-                    check_sensitive_information(pii_scan_result)
-                    logger.debug("PII Scanning completed without issues!")
-                except Exception as e:
-                    logger.error(
-                        f"PII Scanning found issues. Will not index this file: {file_name}. \n"
-                        + str(e)
+            async def flush_tables(tables: List[FileText]):
+                CHUNKS.labels(file_type, "table").inc(len(tables))
+                await index_in_background(
+                    self._create_text_chunks(
+                        tables, file_metadata, chunking=False, start_index=num_tables
                     )
-                    raise e
+                )
 
-            text_chunking_output = self._create_text_chunks(
-                texts, file_metadata, chunking=True
+            splitter_stream = self.text_splitter.stream()
+            pending_chunks: List[BaseChunk] = []
+            pending_tables: List[FileText] = []
+
+            async for batch in page_batches:
+                num_pages = batch["num_pages"]
+                num_texts += len(batch["texts"])
+                batch_images = batch["images"]
+                if self.image_normalizer and batch_images:
+                    batch_images, report = await asyncio.to_thread(
+                        self.image_normalizer.normalize_all, batch_images
+                    )
+                    normalization.merge(report)
+                if self.image_spill_bytes and batch_images:
+                    await asyncio.to_thread(self._spill_images, batch_images)
+                images.extend(batch_images)
+
+                pending_chunks.extend(
+                    splitter_stream.feed(text.model_dump() for text in batch["texts"])
+                )
+                pending_tables.extend(batch["tables"])
+
+                if len(pending_chunks) >= self.index_batch_size:
+                    await flush_chunks(pending_chunks)
+                    pending_chunks = []
+                if len(pending_tables) >= self.index_batch_size:
+                    await flush_tables(pending_tables)
+                    num_tables += len(pending_tables)
+                    pending_tables = []
+
+            pending_chunks.extend(splitter_stream.close())
+            if pending_chunks:
+                await flush_chunks(pending_chunks)
+            if pending_tables:
+                await flush_tables(pending_tables)
+                num_tables += len(pending_tables)
+
+            logger.info("Extracted raw texts and images")
+            logger.info(
+                f"no. texts: {num_texts}\nno. images: {len(images)}\nno. tables: {num_tables}\nno. pages: {num_pages}"
             )
+            if normalization.num_images:
+                logger.info(
+                    f"Normalized {normalization.num_changed}/{normalization.num_images} "
+                    f"images of {file_name}: {normalization.bytes_before} -> "
+                    f"{normalization.bytes_after} bytes "
+                    f"({normalization.bytes_saved} saved)"
+                )
+
+            summary = ""
 
             # Start summary generation if we have content
-            if texts or images:
+            if num_texts or images:
                 tasks["summary"] = asyncio.create_task(
-                    self._create_summary(
-                        [i for i in text_chunking_output["texts"]], images
-                    )
-                )
-            # Process texts if available
-            if texts:
-                tasks["text"] = asyncio.create_task(
-                    self._add_text_chunks(text_chunking_output)
-                )
-            if tables:
-                tasks["tables"] = asyncio.create_task(
-                    self._create_and_add_text_chunks(
-                        tables, file_metadata, chunking=False
-                    )
+                    self._create_summary(chunk_texts, images)
                 )
 
             # Wait for summary before processing images
@@ -391,13 +661,19 @@ class Pipeline:
                 if "summary" in tasks:
                     summary = await tasks["summary"]
                     logger.info(f"Created and indexed summary for {file_name}")
+                    summary_output = self._create_summary_chunk(summary, file_metadata)
+                    document_keys["summary"].extend(
+                        metadata.chunk_id for metadata in summary_output["metadatas"]
+                    )
                     tasks["summary_upload"] = asyncio.create_task(
-                        self._add_file_summary_to_store(summary, file_metadata)
+                        self._add_file_summary_to_store(summary_output)
                     )
+                    CHUNKS.labels(file_type, "summary").inc()
             except Exception as e:
                 error_msg = f"Summary generation failed: {str(e)}"
                 logger.error(error_msg)
                 errors.append(error_msg)
+                count_error("summary")
 
             # Process images if available
             if images:
@@ -414,13 +690,20 @@ class Pipeline:
                     )
 
                     image_metadatas = image_chunk_result["image_metadatas"]
+                    CHUNKS.labels(file_type, "image").inc(len(image_metadatas))
+                    indexing_reports.append(image_chunk_result.get("result"))
+                    # Metadatas only cover the images kept after filtering
+                    indexed_images = image_chunk_result["images"]
 
                     logger.info(f"Created image index for {file_name}")
 
+                    image_keys = [i.chunk_id for i in image_metadatas]
+                    document_keys["image"].extend(image_keys)
+                    blob_names.extend(image_keys)
                     tasks["image_upload"] = asyncio.create_task(
-                        self.image_container_client.upload_base64_image_to_blob(
-                            (i.chunk_id for i in image_metadatas),
-                            (image.image_base64 for image in images),
+                        self.image_container_client.upload_images_to_blob(
+                            image_keys,
+                            indexed_images,
                             metadata=file_metadata.model_dump(),
                         )
                     )
@@ -429,34 +712,150 @@ class Pipeline:
                     error_msg = f"Image Processing failed: {str(e)}"
                     logger.error(error_msg)
                     errors.append(error_msg)
+                    count_error("image_description")
+
+            # Wait for every remaining task, including when one of them fails:
+            # the image upload still reads the images discarded below
+            store_tasks = [*indexing_tasks]
+            if "summary_upload" in tasks:
+                store_tasks.append(tasks["summary_upload"])
+            upload_task = tasks.get("image_upload")
+            results = await asyncio.gather(
+                *store_tasks, *filter(None, [upload_task]), return_exceptions=True
+            )
 
-            # Wait for all remaining tasks to complete
-            try:
-                await asyncio.gather(*tasks.values())
-            except Exception as e:
-                error_msg = f"Task completion error: {str(e)}"
+            for result in results[: len(store_tasks)]:
+                if isinstance(result, BaseException):
+                    error_msg = f"Task completion error: {str(result)}"
+                    logger.error(error_msg)
+                    errors.append(error_msg)
+                    count_error("indexing")
+                else:
+                    indexing_reports.append(result)
+            for report in indexing_reports:
+                # add_entries returns None when nothing was left to index
+                if report and report["failed"]:
+                    error_msg = (
+                        f"Indexing failed for {len(report['failed'])} documents "
+                        f"in {report['index_name']}: "
+                        + ", ".join(
+                            f"{i['key']} ({i['status_code']}: {i['error']})"
+                            for i in report["failed"]
+                        )
+                    )
+                    logger.error(error_msg)
+                    errors.append(error_msg)
+                    count_error("search_upload")
+
+            for result in results[len(store_tasks) :]:
+                if isinstance(result, BaseException):
+                    error_msg = f"Image upload failed: {str(result)}"
+                elif result["failed"]:
+                    error_msg = (
+                        f"Image upload failed for {len(result['failed'])} blobs: "
+                        + ", ".join(
+                            f"{i['blob_name']} ({i['error']})" for i in result["failed"]
+                        )
+                    )
+                else:
+                    continue
                 logger.error(error_msg)
                 errors.append(error_msg)
+                count_error("blob_upload")
 
             logger.info(f"Processed file {file_name}")
+            PAGES.labels(file_type).inc(num_pages)
+            IMAGES.labels(file_type).inc(len(images))
+            status = "error" if errors else "indexed"
 
             return ProcessingResult(
                 file_name=file_name,
                 num_pages=num_pages,
-                num_texts=len(texts),
+                num_texts=num_texts,
                 num_images=len(images),
+                image_bytes_saved=normalization.bytes_saved,
                 metadata=file_metadata,  # dict
                 errors=errors if errors else [],  # list[str]
             )
         except Exception as e:
             logger.error(f"Fatal error processing {file_name}: {str(e)}")
-            # raise
+            count_error("pipeline")
+            errors = [f"Fatal error: {str(e)}"]
+            background_tasks = [*indexing_tasks, *tasks.values()]
+            for task in background_tasks:
+                # Blob uploads run on threads, which cancelling would not stop:
+                # let them finish before their blobs are deleted
+                if task is not tasks.get("image_upload"):
+                    task.cancel()
+            # Batches of the earlier pages may already be in the indexes: once
+            # no upload is left running, remove what this run uploaded so the
+            # file is not half indexed. Documents of an earlier run are kept,
+            # except those with the same keys, which this run overwrote
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+            errors.extend(await self._delete_uploads(document_keys, blob_names))
 
             return ProcessingResult(
                 file_name=file_name,
                 num_pages=0,
                 num_texts=0,
                 num_images=0,
+                image_bytes_saved=0,
                 metadata={},
-                errors=[f"Fatal error: {str(e)}"],
+                errors=errors,
             )
+        finally:
+            for image in images:
+                image.discard()
+            FILES.labels(file_type, status).inc()
+            FILE_SECONDS.labels(file_type, status).observe(time.perf_counter() - start)
+            FILES_IN_FLIGHT.dec()
+            current_file_type.reset(file_type_token)
+
+
+async def _aiter(items: Iterable[Any]) -> AsyncIterator[Any]:
+    """Async iterator over an already materialized iterable"""
+    for item in items:
+        yield item
+
+
+async def _timed_aiter(items: AsyncIterator[Any], stage: str) -> AsyncIterator[Any]:
+    """Async iterator observing the time spent producing all its items as a stage"""
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = await items.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        STAGE_SECONDS.labels(stage, current_file_type.get()).observe(elapsed)
+
+
+async def _aiter_in_thread(iterator: Iterator[Any]) -> AsyncIterator[Any]:
+    """Async iterator over a blocking iterator, each item computed in a thread"""
+    done = object()
+    pending: Optional[asyncio.Task] = None
+    try:
+        while True:
+            pending = asyncio.create_task(asyncio.to_thread(next, iterator, done))
+            # Shielded: cancelling would not stop the thread anyway
+            item = await asyncio.shield(pending)
+            pending = None
+            if item is done:
+                return
+            yield item
+    finally:
+        if pending is not None:
+            # A generator cannot be closed while its next() is running
+            await asyncio.gather(pending, return_exceptions=True)
+        close = getattr(iterator, "close", None)
+        if close:
+            try:
+                close()
+            except ValueError as e:
+                # Still executing: the wait above was cancelled too
+                logger.warning(f"Could not close {iterator}: {e}")
@@ -5,10 +5,16 @@ Description : Simplified splitter function that work with list of texts
 where position information must be preserved
 """
 
+import re
 from abc import ABC, abstractmethod
-from typing import Callable, List, Optional
+from bisect import bisect_left
+from typing import Callable, Iterable, List, Optional, Tuple
 
 from .models import BaseChunk, PageRange
+from .tokenizer import DEFAULT_ENCODING, count_tokens, token_offsets
+
+# Matches what str.lstrip() strips
+_LEADING_WHITESPACE = re.compile(r"\s*")
 
 
 class BaseTextSplitter(ABC):
@@ -32,7 +38,10 @@ class BaseTextSplitter(ABC):
 
     @staticmethod
     def _create_chunk(
-        chunk: str, chunk_no: str, page_range: tuple[int, int]
+        chunk: str,
+        chunk_no: str,
+        page_range: tuple[int, int],
+        num_tokens: Optional[int] = None,
     ) -> BaseChunk:
         """
         Create a new chunk object with metadata.
@@ -41,6 +50,7 @@ class BaseTextSplitter(ABC):
             current_chunk: Text content for the chunk.
             chunk_no: Index number for this chunk.
             page_range: Tuple of (start_page, end_page) for this chunk.
+            num_tokens: Token count of the chunk, if known.
 
         Returns:
             New BaseChunk object with the provided data.
@@ -49,6 +59,7 @@ class BaseTextSplitter(ABC):
             chunk_no=chunk_no,
             page_range=PageRange(start_page=page_range[0], end_page=page_range[1]),
             chunk=chunk,
+            num_tokens=num_tokens,
         )
 
 
@@ -56,6 +67,9 @@ class SimplePageTextSplitter(BaseTextSplitter):
     """
     A text splitter that chunks text from pages while maintaining page number.
     Probably doesn't work with other length function other than len
+
+    With length_unit="tokens", chunk_size and chunk_overlap count tokens of
+    a tiktoken encoding instead, and chunks carry their token count.
     """
 
     DEFAULT_SEPARATORS = ["\n\n", ".\n", ". ", "\n", " ", ""]
@@ -66,6 +80,8 @@ class SimplePageTextSplitter(BaseTextSplitter):
         chunk_overlap: int = 0,
         length_function: Callable[[str], int] = len,
         separators: Optional[List[str]] = None,
+        length_unit: str = "characters",
+        encoding_name: str = DEFAULT_ENCODING,
     ):
         """
         Initialize the text splitter with configurable parameters.
@@ -75,6 +91,8 @@ class SimplePageTextSplitter(BaseTextSplitter):
             chunk_overlap: Overlap size between consecutive chunks.
             length_function: Function to calculate text length.
             separators: List of separators to use for splitting.
+            length_unit: "characters" (measured by length_function) or "tokens".
+            encoding_name: tiktoken encoding counting the tokens.
 
         Raises:
             ValueError: If chunk_size or chunk_overlap are invalid.
@@ -85,11 +103,15 @@ class SimplePageTextSplitter(BaseTextSplitter):
             raise ValueError("chunk_overlap must be non-negative")
         if chunk_overlap >= chunk_size:
             raise ValueError("chunk_overlap must be less than chunk_size")
+        if length_unit not in ("characters", "tokens"):
+            raise ValueError(f"Unknown length unit: {length_unit}")
 
         self._chunk_size = chunk_size
         self._chunk_overlap = chunk_overlap
         self._length_function = length_function
         self._separators = separators or self.DEFAULT_SEPARATORS
+        self._length_unit = length_unit
+        self._encoding_name = encoding_name
 
     def split_text(self, pages: List[dict]) -> List[BaseChunk]:
         """
@@ -108,64 +130,18 @@ class SimplePageTextSplitter(BaseTextSplitter):
         if not pages:
             raise ValueError("Input pages list cannot be empty")
 
-        chunks: List[BaseChunk] = []
-        current_chunk = ""
-        overlap_text = ""
-        current_page_range = (0, 0)
-
-        for page in pages:
-            page_no, page_text = page["page_no"], page["text"]
-            remaining_text = page_text
-
-            if not remaining_text:
-                continue
-
-            while remaining_text:
-                # Update page range
-                current_page_range = (
-                    max(current_page_range[0] - 1, 0) if current_chunk else page_no,
-                    page_no,
-                )
-
-                # Check if remaining text fits in current chunk
-                if (
-                    self._length_function(current_chunk + remaining_text)
-                    <= self._chunk_size
-                ):
-                    current_chunk += remaining_text
-                    remaining_text = ""
-                else:
-                    split_point = self._find_split_point(remaining_text)
-                    current_chunk += remaining_text[:split_point]
-                    remaining_text = remaining_text[split_point:].lstrip()
-
-                # Check if chunk is ready to be added
-                current_length = self._length_function(current_chunk)
-                overlap_length = self._length_function(overlap_text)
-
-                if current_length + overlap_length >= self._chunk_size:
-                    current_chunk = overlap_text + current_chunk
-                    chunk = self._create_chunk(
-                        chunk=current_chunk,
-                        chunk_no=str(len(chunks)),
-                        page_range=current_page_range,
-                    )
-                    chunks.append(chunk)
-
-                    overlap_text = self._create_overlap_text(current_chunk)
-                    current_chunk = ""
-
-        # Handle remaining text
-        if current_chunk:
-            chunk = self._create_chunk(
-                chunk=overlap_text + current_chunk,
-                chunk_no=str(len(chunks)),
-                page_range=current_page_range,
-            )
-            chunks.append(chunk)
-
+        stream = self.stream()
+        chunks = stream.feed(pages)
+        chunks.extend(stream.close())
         return chunks
 
+    def stream(self) -> "PageTextSplitterStream":
+        """
+        Start an incremental splitting session, for pages that arrive one by one.
+        Feeding all pages then closing yields the same chunks as `split_text`.
+        """
+        return PageTextSplitterStream(self)
+
     def _find_split_point(self, text: str) -> int:
         """
         Find the optimal split point in the text using separators.
@@ -183,6 +159,30 @@ class SimplePageTextSplitter(BaseTextSplitter):
 
         return min(self._chunk_size, len(text))
 
+    def _find_split_point_in(
+        self, text: str, start: int, window_end: Optional[int] = None
+    ) -> int:
+        """
+        `_find_split_point` on `text[start:]`, searched in place.
+
+        Args:
+            text: Page text.
+            start: Offset of the remaining text in the page text.
+            window_end: Offset the split point cannot exceed, chunk_size
+                characters after start by default.
+
+        Returns:
+            Offset in the page text where the remaining text should be split.
+        """
+        if window_end is None:
+            window_end = start + self._chunk_size
+        for separator in self._separators:
+            split_idx = text.rfind(separator, start, window_end)
+            if split_idx != -1:
+                return split_idx + len(separator)
+
+        return min(window_end, len(text))
+
     def _create_overlap_text(self, chunk: str) -> str:
         """
         Create overlap text for the next chunk based on separators.
@@ -206,3 +206,269 @@ class SimplePageTextSplitter(BaseTextSplitter):
 
         # If no separator found, use exact overlap size
         return chunk[min_overlap_start:]
+
+    def _create_token_overlap(self, chunk: str, offsets: List[int]) -> str:
+        """
+        Overlap text for the next chunk in token mode: the last chunk_overlap
+        tokens, shortened to start after a separator when one is found in them.
+
+        Args:
+            chunk: Current chunk to create overlap from.
+            offsets: Character offsets of the tokens of the chunk.
+
+        Returns:
+            Text to be used as overlap in the next chunk.
+        """
+        if self._chunk_overlap == 0:
+            return ""
+        if len(offsets) <= self._chunk_overlap:
+            return chunk
+
+        min_overlap_start = offsets[len(offsets) - self._chunk_overlap]
+        for separator in self._separators:
+            if not separator:
+                break
+            split_idx = chunk.find(separator, min_overlap_start)
+            if split_idx != -1 and split_idx + len(separator) < len(chunk):
+                return chunk[split_idx + len(separator) :]
+
+        return chunk[min_overlap_start:]
+
+
+class PageTextSplitterStream:
+    """
+    Incremental state of a SimplePageTextSplitter: the pending chunk, the
+    overlap carried to the next chunk and the running chunk number.
+
+    With the default `len` length function, the pending chunk is kept as
+    (page text, start, end) spans and split points are searched in place in
+    the page text, so splitting a page is linear in its length. Strings are
+    only built for the emitted chunks.
+    """
+
+    def __init__(self, splitter: SimplePageTextSplitter):
+        self._splitter = splitter
+        self._current_chunk = ""
+        self._overlap_text = ""
+        self._current_page_range = (0, 0)
+        self._num_chunks = 0
+        # Offset-based state, used when the length function is `len`
+        self._spans: List[Tuple[str, int, int]] = []
+        self._current_length = 0
+        # Token mode: approximate tokens of the spans, tokens of the overlap
+        self._current_tokens = 0
+        self._overlap_tokens = 0
+
+    def _emit(self, chunk: str, num_tokens: Optional[int] = None) -> BaseChunk:
+        base_chunk = self._splitter._create_chunk(
+            chunk=chunk,
+            chunk_no=str(self._num_chunks),
+            page_range=self._current_page_range,
+            num_tokens=num_tokens,
+        )
+        self._num_chunks += 1
+        return base_chunk
+
+    def feed(self, pages: Iterable[dict]) -> List[BaseChunk]:
+        """
+        Split the next pages, in document order.
+
+        Args:
+            pages: Pages, where each page contains page_no and text fields.
+
+        Returns:
+            Chunks completed by these pages. The tail of the last page is
+            kept until more pages are fed or the stream is closed.
+        """
+        if self._splitter._length_unit == "tokens":
+            return self._feed_tokens(pages)
+        if self._splitter._length_function is len:
+            return self._feed_spans(pages)
+        return self._feed_strings(pages)
+
+    def _feed_spans(self, pages: Iterable[dict]) -> List[BaseChunk]:
+        """`feed` on offsets into the page texts, for the `len` length function"""
+        splitter = self._splitter
+        chunk_size = splitter._chunk_size
+        chunks: List[BaseChunk] = []
+
+        for page in pages:
+            page_no, page_text = page["page_no"], page["text"]
+            position, page_end = 0, len(page_text)
+
+            while position < page_end:
+                # Update page range
+                self._current_page_range = (
+                    (
+                        max(self._current_page_range[0] - 1, 0)
+                        if self._current_length
+                        else page_no
+                    ),
+                    page_no,
+                )
+
+                # Check if remaining text fits in current chunk
+                if self._current_length + page_end - position <= chunk_size:
+                    split_point = page_end
+                    next_position = page_end
+                else:
+                    split_point = splitter._find_split_point_in(page_text, position)
+                    # Same as str.lstrip on the remaining text
+                    next_position = _LEADING_WHITESPACE.match(
+                        page_text, split_point
+                    ).end()
+
+                self._spans.append((page_text, position, split_point))
+                self._current_length += split_point - position
+                position = next_position
+
+                # Check if chunk is ready to be added
+                if self._current_length + len(self._overlap_text) >= chunk_size:
+                    current_chunk = self._overlap_text + self._join_spans()
+                    chunks.append(self._emit(current_chunk))
+
+                    self._overlap_text = splitter._create_overlap_text(current_chunk)
+
+        return chunks
+
+    def _join_spans(self) -> str:
+        """Materialize the pending chunk and reset it"""
+        text = "".join(page_text[start:end] for page_text, start, end in self._spans)
+        self._spans = []
+        self._current_length = 0
+        self._current_tokens = 0
+        return text
+
+    def _feed_tokens(self, pages: Iterable[dict]) -> List[BaseChunk]:
+        """
+        `feed` with chunk_size counted in tokens. Each page is encoded once;
+        the tokens of a span are counted from the token offsets of the page.
+        A chunk is emitted as soon as the next piece of text does not fit.
+        """
+        splitter = self._splitter
+        chunk_size = splitter._chunk_size
+        chunks: List[BaseChunk] = []
+
+        for page in pages:
+            page_no, page_text = page["page_no"], page["text"]
+            if not page_text:
+                continue
+
+            offsets = token_offsets(page_text, splitter._encoding_name)
+            position, page_end = 0, len(page_text)
+
+            while position < page_end:
+                self._current_page_range = (
+                    (
+                        max(self._current_page_range[0] - 1, 0)
+                        if self._spans
+                        else page_no
+                    ),
+                    page_no,
+                )
+
+                first_token = bisect_left(offsets, position)
+                budget = max(
+                    chunk_size - self._overlap_tokens - self._current_tokens, 1
+                )
+                if len(offsets) - first_token <= budget:
+                    split_point = next_position = page_end
+                    chunk_full = False
+                else:
+                    # Split before the first token over budget
+                    window_end = max(offsets[first_token + budget], position + 1)
+                    split_point = splitter._find_split_point_in(
+                        page_text, position, window_end
+                    )
+                    next_position = _LEADING_WHITESPACE.match(
+                        page_text, split_point
+                    ).end()
+                    chunk_full = True
+
+                self._spans.append((page_text, position, split_point))
+                self._current_tokens += bisect_left(offsets, split_point) - first_token
+                position = next_position
+
+                if (
+                    chunk_full
+                    or self._current_tokens + self._overlap_tokens >= chunk_size
+                ):
+                    chunks.append(self._emit_token_chunk())
+
+        return chunks
+
+    def _emit_token_chunk(self) -> BaseChunk:
+        """Emit the pending chunk with its exact token count, then set the overlap"""
+        chunk = self._overlap_text + self._join_spans()
+        offsets = token_offsets(chunk, self._splitter._encoding_name)
+        base_chunk = self._emit(chunk, num_tokens=len(offsets))
+
+        self._overlap_text = self._splitter._create_token_overlap(chunk, offsets)
+        self._overlap_tokens = len(offsets) - bisect_left(
+            offsets, len(chunk) - len(self._overlap_text)
+        )
+        return base_chunk
+
+    def _feed_strings(self, pages: Iterable[dict]) -> List[BaseChunk]:
+        """`feed` on strings, for custom length functions"""
+        splitter = self._splitter
+        chunks: List[BaseChunk] = []
+
+        for page in pages:
+            page_no, page_text = page["page_no"], page["text"]
+            remaining_text = page_text
+
+            if not remaining_text:
+                continue
+
+            while remaining_text:
+                # Update page range
+                self._current_page_range = (
+                    (
+                        max(self._current_page_range[0] - 1, 0)
+                        if self._current_chunk
+                        else page_no
+                    ),
+                    page_no,
+                )
+
+                # Check if remaining text fits in current chunk
+                if (
+                    splitter._length_function(self._current_chunk + remaining_text)
+                    <= splitter._chunk_size
+                ):
+                    self._current_chunk += remaining_text
+                    remaining_text = ""
+                else:
+                    split_point = splitter._find_split_point(remaining_text)
+                    self._current_chunk += remaining_text[:split_point]
+                    remaining_text = remaining_text[split_point:].lstrip()
+
+                # Check if chunk is ready to be added
+                current_length = splitter._length_function(self._current_chunk)
+                overlap_length = splitter._length_function(self._overlap_text)
+
+                if current_length + overlap_length >= splitter._chunk_size:
+                    current_chunk = self._overlap_text + self._current_chunk
+                    chunks.append(self._emit(current_chunk))
+
+                    self._overlap_text = splitter._create_overlap_text(current_chunk)
+                    self._current_chunk = ""
+
+        return chunks
+
+    def close(self) -> List[BaseChunk]:
+        """Flush the remaining text as a last chunk"""
+        if self._spans:
+            self._current_chunk = self._join_spans()
+        if not self._current_chunk:
+            return []
+
+        chunk = self._overlap_text + self._current_chunk
+        num_tokens = (
+            count_tokens(chunk, self._splitter._encoding_name)
+            if self._splitter._length_unit == "tokens"
+            else None
+        )
+        self._current_chunk = ""
+        return [self._emit(chunk, num_tokens=num_tokens)]
@@ -0,0 +1,179 @@
+"""
+File: sqlite_cache.py
+Desc: size-bounded key/value store on a local SQLite file, shared by the
+threads of a worker and by the gunicorn workers of a container
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from loguru import logger
+
+
+class SQLiteCache:
+    """
+    Key/value store with least-recently-used eviction once the stored values
+    exceed `max_bytes`
+    """
+
+    # Evict down to this fraction of max_bytes, so eviction does not run on every write
+    EVICTION_TARGET = 0.9
+    # SQLite caps the number of host parameters of a statement
+    MAX_PARAMS = 500
+
+    def __init__(self, path: str, max_bytes: int, table: str = "cache"):
+        """
+        Args:
+            path (str): SQLite file, created with its directory if missing
+            max_bytes (int): Size bound of the stored values
+            table (str): Table name, so several caches can share a file
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.table = table
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        # WAL lets readers in other processes proceed while one process writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+            "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_last_access ON {table}(last_access)"
+        )
+        # Total size of the stored values, shared by every process writing the
+        # file and updated in the transactions that change it
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table}_size (total INTEGER NOT NULL)"
+        )
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    f"INSERT INTO {table}_size (total) "
+                    f"SELECT COALESCE(SUM(size), 0) FROM {table} "
+                    f"WHERE NOT EXISTS (SELECT 1 FROM {table}_size)"
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        logger.info(f"Opened cache {path}:{table} holding {self._total_bytes()} bytes")
+
+    def _total_bytes(self) -> int:
+        """Size of the stored values, as of the current transaction"""
+        return self._conn.execute(
+            f"SELECT total FROM {self.table}_size"
+        ).fetchone()[0]
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, bytes]:
+        """Return the stored values of the keys found, refreshing their access time"""
+        keys = list(dict.fromkeys(keys))
+        found: Dict[str, bytes] = {}
+        now = time.time()
+
+        with self._lock:
+            for i in range(0, len(keys), self.MAX_PARAMS):
+                batch = keys[i : i + self.MAX_PARAMS]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM {self.table} WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                found.update(rows)
+                if rows:
+                    hit_keys = [key for key, _ in rows]
+                    self._conn.execute(
+                        f"UPDATE {self.table} SET last_access = ? "
+                        f"WHERE key IN ({','.join('?' * len(hit_keys))})",
+                        [now, *hit_keys],
+                    )
+        return found
+
+    def set_many(self, items: Iterable[Tuple[str, bytes]]) -> None:
+        """Store values, then evict the least recently used ones if over budget"""
+        now = time.time()
+        rows: List[Tuple[str, bytes, int, float]] = [
+            (key, value, len(value), now) for key, value in dict(items).items()
+        ]
+        if not rows:
+            return
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Sizes of the values being replaced, to keep the total exact
+                replaced = 0
+                for i in range(0, len(rows), self.MAX_PARAMS):
+                    batch = [row[0] for row in rows[i : i + self.MAX_PARAMS]]
+                    replaced += self._conn.execute(
+                        f"SELECT COALESCE(SUM(size), 0) FROM {self.table} "
+                        f"WHERE key IN ({','.join('?' * len(batch))})",
+                        batch,
+                    ).fetchone()[0]
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, size, last_access) "
+                    "VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                self._conn.execute(
+                    f"UPDATE {self.table}_size SET total = total + ?",
+                    (sum(row[2] for row in rows) - replaced,),
+                )
+                # Read in the transaction: the total includes every worker's writes
+                if self._total_bytes() > self.max_bytes:
+                    self._evict()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _evict(self) -> None:
+        """
+        Delete least recently used entries down to EVICTION_TARGET * max_bytes.
+        Called inside the write transaction of `set_many`.
+        """
+        excess = self._total_bytes() - int(self.max_bytes * self.EVICTION_TARGET)
+        if excess <= 0:
+            return
+
+        # Find the access time up to which the oldest entries cover the excess
+        freed = 0
+        cutoff = None
+        for last_access, size in self._conn.execute(
+            f"SELECT last_access, size FROM {self.table} ORDER BY last_access"
+        ):
+            freed += size
+            cutoff = last_access
+            if freed >= excess:
+                break
+
+        deleted, freed = self._conn.execute(
+            f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table} "
+            "WHERE last_access <= ?",
+            (cutoff,),
+        ).fetchone()
+        self._conn.execute(
+            f"DELETE FROM {self.table} WHERE last_access <= ?", (cutoff,)
+        )
+        self._conn.execute(f"UPDATE {self.table}_size SET total = total - ?", (freed,))
+        logger.info(
+            f"Evicted {deleted} entries from cache {self.path}:{self.table}, "
+            f"{self._total_bytes()} bytes left"
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
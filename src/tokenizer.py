@@ -0,0 +1,34 @@
+"""
+File: tokenizer.py
+Desc: tiktoken encodings loaded once per process, and token counting helpers
+"""
+
+import functools
+from typing import List
+
+import tiktoken
+
+# Encoding of the text-embedding-3 models and the gpt-4 era chat models.
+# gpt-4o uses o200k_base: do not budget its prompts with this one
+DEFAULT_ENCODING = "cl100k_base"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = DEFAULT_ENCODING) -> tiktoken.Encoding:
+    """Load an encoding once per process: loading parses a large BPE file"""
+    return tiktoken.get_encoding(encoding_name)
+
+
+def count_tokens(text: str, encoding_name: str = DEFAULT_ENCODING) -> int:
+    return len(get_encoding(encoding_name).encode_ordinary(text))
+
+
+def token_offsets(text: str, encoding_name: str = DEFAULT_ENCODING) -> List[int]:
+    """
+    Character offset of the start of each token of `text`, in one encoding
+    pass. The number of tokens of text[a:b] is about the number of offsets
+    in [a, b), without encoding the substring again.
+    """
+    encoding = get_encoding(encoding_name)
+    _, offsets = encoding.decode_with_offsets(encoding.encode_ordinary(text))
+    return offsets
@@ -14,6 +14,7 @@ def create_file_upload_metadata(file: MyFile) -> MyFileMetaData:
     file_metadata = create_file_metadata_from_bytes(
         file_bytes=file.file_content,
         file_name=file.file_name,
+        file_hash=file.file_hash,
     )
     file_metadata.update(
         dict(
@@ -1,16 +1,38 @@
-from typing import List
+import asyncio
+import json
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, List, Mapping, Optional, TypedDict
 
 from azure.core.credentials import AzureKeyCredential
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core.exceptions import (HttpResponseError, ResourceNotFoundError,
+                                   ServiceRequestError, ServiceResponseError)
 from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (SearchIndex, SemanticSearch,
                                                    VectorSearch)
 from loguru import logger
-from openai import AzureOpenAI
+from openai import (APIConnectionError, APITimeoutError, AsyncAzureOpenAI,
+                    InternalServerError, RateLimitError)
 
+from src.embedding_cache import EmbeddingCache
+from src.metrics import EMBEDDING_TOKENS, stage_timer
 from src.models import AzureSearchDocMetaData, BaseChunk, MyFileMetaData
 
+KEY_FIELD = "chunk_id"
+# Throttling, version conflicts and service-side unavailability
+RETRYABLE_INDEXING_STATUS_CODES = (409, 422, 429, 500, 503)
+
+
+class IndexingReport(TypedDict):
+    """Outcome of indexing the documents of one add_entries call"""
+
+    index_name: str
+    succeeded: int
+    failed: List[Dict[str, Any]]
+
 
 class MyAzureSearch:
     def __init__(
@@ -22,11 +44,32 @@ class MyAzureSearch:
         fields: List,
         vector_search: VectorSearch,
         semantic_search: SemanticSearch,
+        max_batch_documents: int = 1000,
+        max_batch_bytes: int = 12 * 1024 * 1024,
+        upload_concurrency: int = 4,
+        upload_retries: int = 3,
+        upload_semaphore: Optional[asyncio.Semaphore] = None,
     ):
+        """
+        Args:
+            max_batch_documents: Max number of documents of one indexing request
+            max_batch_bytes: Max JSON payload of one indexing request
+                (the service rejects requests above 16 MB)
+            upload_concurrency: Max number of indexing requests in flight
+            upload_retries: Retries of the documents the service failed to index
+            upload_semaphore: Limit shared with other indexes, replaces
+                upload_concurrency if given
+        """
         self.endpoint = azure_search_endpoint
         self.index_name = index_name
         self.fields = fields
         self.embedding_function = embedding_function
+        self.max_batch_documents = max_batch_documents
+        self.max_batch_bytes = max_batch_bytes
+        self.upload_retries = upload_retries
+        self._upload_semaphore = upload_semaphore or asyncio.Semaphore(
+            upload_concurrency
+        )
 
         # Create clients for interacting with the search service and index
         self.search_client = SearchClient(
@@ -35,6 +78,12 @@ class MyAzureSearch:
             credential=AzureKeyCredential(azure_search_key),
         )
 
+        self.async_search_client = AsyncSearchClient(
+            endpoint=self.endpoint,
+            index_name=self.index_name,
+            credential=AzureKeyCredential(azure_search_key),
+        )
+
         self.index_client = SearchIndexClient(
             endpoint=self.endpoint, credential=AzureKeyCredential(azure_search_key)
         )
@@ -62,9 +111,164 @@ class MyAzureSearch:
             self.index_client.create_index(index)
             logger.info(f"Index '{self.index_name}' has been created.")
 
-    async def upload_documents(self, documents):
-        """Uploads documents to the Azure Search index."""
-        self.search_client.upload_documents(documents=documents)
+    def split_documents(self, documents: List[Dict]) -> List[List[Dict]]:
+        """
+        Split documents into consecutive sub-batches within the document count
+        and JSON payload limits of one indexing request.
+        """
+        batches: List[List[Dict]] = []
+        batch: List[Dict] = []
+        batch_bytes = 0
+        for document in documents:
+            document_bytes = len(json.dumps(document))
+            if batch and (
+                len(batch) >= self.max_batch_documents
+                or batch_bytes + document_bytes > self.max_batch_bytes
+            ):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(document)
+            batch_bytes += document_bytes
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def _upload_batch(self, documents: List[Dict]) -> List[Dict[str, Any]]:
+        """
+        Upload one sub-batch, retrying only the documents that failed with a
+        transient status. A request rejected as too large (413) is split in
+        two halves uploaded on their own.
+
+        Returns:
+            List of the documents that could not be indexed, with their key,
+            status code and error message
+        """
+        failed: List[Dict[str, Any]] = []
+        pending = documents
+        attempt = 0
+        while pending:
+            try:
+                async with self._upload_semaphore:
+                    with stage_timer("search_upload"):
+                        results = await self.async_search_client.upload_documents(
+                            documents=pending
+                        )
+            except (
+                HttpResponseError,
+                ServiceRequestError,
+                ServiceResponseError,
+            ) as e:
+                status_code = getattr(e, "status_code", None)
+                if status_code == 413 and len(pending) > 1:
+                    half = len(pending) // 2
+                    for half_failed in await asyncio.gather(
+                        self._upload_batch(pending[:half]),
+                        self._upload_batch(pending[half:]),
+                    ):
+                        failed.extend(half_failed)
+                    break
+                # The whole request failed: retry all of its documents, if the
+                # service or the connection may do better next time
+                if (
+                    not isinstance(e, (ServiceRequestError, ServiceResponseError))
+                    and status_code not in RETRYABLE_INDEXING_STATUS_CODES
+                ) or attempt >= self.upload_retries:
+                    failed.extend(
+                        {
+                            "key": document[KEY_FIELD],
+                            "status_code": status_code,
+                            "error": str(e),
+                        }
+                        for document in pending
+                    )
+                    break
+                retryable = list(pending)
+            else:
+                retryable = []
+                results_by_key = {result.key: result for result in results}
+                for document in pending:
+                    result = results_by_key.get(document[KEY_FIELD])
+                    if result is None:
+                        failed.append(
+                            {
+                                "key": document[KEY_FIELD],
+                                "status_code": None,
+                                "error": "No indexing result for this document",
+                            }
+                        )
+                    elif result.succeeded:
+                        continue
+                    elif (
+                        result.status_code in RETRYABLE_INDEXING_STATUS_CODES
+                        and attempt < self.upload_retries
+                    ):
+                        retryable.append(document)
+                    else:
+                        failed.append(
+                            {
+                                "key": result.key,
+                                "status_code": result.status_code,
+                                "error": result.error_message,
+                            }
+                        )
+
+            if retryable:
+                attempt += 1
+                delay = min(2**attempt, 30) * (0.5 + random.random() / 2)
+                logger.warning(
+                    f"{len(retryable)} documents not indexed in '{self.index_name}', "
+                    f"retry {attempt}/{self.upload_retries} in {delay:.2f}s"
+                )
+                await asyncio.sleep(delay)
+            pending = retryable
+
+        return failed
+
+    async def upload_documents(self, documents: List[Dict]) -> IndexingReport:
+        """
+        Uploads documents to the Azure Search index, as sub-batches uploaded
+        concurrently.
+        """
+        batches = self.split_documents(documents)
+        logger.debug(
+            f"Uploading {len(documents)} documents to '{self.index_name}' "
+            f"in {len(batches)} requests"
+        )
+        failures = await asyncio.gather(
+            *(self._upload_batch(batch) for batch in batches)
+        )
+        failed = [failure for batch_failures in failures for failure in batch_failures]
+        if failed:
+            logger.error(
+                f"{len(failed)}/{len(documents)} documents not indexed in '{self.index_name}'"
+            )
+        return IndexingReport(
+            index_name=self.index_name,
+            succeeded=len(documents) - len(failed),
+            failed=failed,
+        )
+
+    async def delete_documents(self, keys: List[str]) -> int:
+        """
+        Delete documents by key, in requests of at most max_batch_documents.
+        Missing keys are not an error.
+
+        Returns:
+            Number of keys deleted
+        """
+        for start in range(0, len(keys), self.max_batch_documents):
+            await self.async_search_client.delete_documents(
+                documents=[
+                    {KEY_FIELD: key}
+                    for key in keys[start : start + self.max_batch_documents]
+                ]
+            )
+        if keys:
+            logger.info(f"Deleted {len(keys)} documents from '{self.index_name}'")
+        return len(keys)
+
+    async def close(self):
+        await self.async_search_client.close()
 
     @staticmethod
     def filtered_texts_and_metadatas_by_min_length(
@@ -99,49 +303,53 @@ class MyAzureSearch:
         self,
         texts: List[str],
         metadatas: List[AzureSearchDocMetaData],
-        batch_size: int = 500,
         filter_by_min_len: int = 0,
+        token_counts: Optional[List[Optional[int]]] = None,
     ):
-        """Adds texts and their associated metadata to the Azure Search index."""
+        """
+        Adds texts and their associated metadata to the Azure Search index.
+        Known token counts of the texts let the embedding requests be packed
+        by tokens without estimating them.
+        """
         documents = []
         n_texts = len(texts)
 
-        for i in range(0, len(texts), batch_size):
-            logger.debug(f"working on {i}/{n_texts}")
-            batch_texts = texts[i : i + batch_size]
-            batch_metadatas = metadatas[i : i + batch_size]
-
-            if filter_by_min_len:
-                filtered_texts, filtered_metadatas = (
-                    self.filtered_texts_and_metadatas_by_min_length(
-                        batch_texts, batch_metadatas, min_len=filter_by_min_len
-                    )
+        if filter_by_min_len:
+            filtered_texts, filtered_metadatas = (
+                self.filtered_texts_and_metadatas_by_min_length(
+                    texts, metadatas, min_len=filter_by_min_len
                 )
-            else:
-                filtered_texts, filtered_metadatas = batch_texts, batch_metadatas
+            )
+        else:
+            filtered_texts, filtered_metadatas = texts, metadatas
+        if filter_by_min_len or not token_counts or None in token_counts:
+            token_counts = None
 
-            if not bool(filtered_texts):
-                continue
+        if not bool(filtered_texts):
+            return
 
-            try:
-                # Batch embedding request
-                embeddings = self.embedding_function(filtered_texts)
-            except Exception as e:
-                logger.error(f" Error during text embedding for batch {i}: {str(e)}")
-                logger.error(
-                    "Showing batch \n" + "<end>\n---\n<start>".join(filtered_texts)
-                )
-                raise
-
-            for text, embedding, metadata in zip(
-                filtered_texts, embeddings, filtered_metadatas
-            ):
-                doc = {
-                    "chunk": text or "no description",
-                    "vector": embedding,
-                }
-                doc.update(metadata.model_dump())
-                documents.append(doc)
+        logger.debug(f"Embedding {len(filtered_texts)}/{n_texts} texts")
+        try:
+            # The embedding function packs the texts into requests itself
+            embeddings = await self.embedding_function(
+                list(filtered_texts), token_counts
+            )
+        except Exception as e:
+            logger.error(f" Error during text embedding: {str(e)}")
+            logger.error(
+                "Showing batch \n" + "<end>\n---\n<start>".join(filtered_texts)
+            )
+            raise
+
+        for text, embedding, metadata in zip(
+            filtered_texts, embeddings, filtered_metadatas
+        ):
+            doc = {
+                "chunk": text or "no description",
+                "vector": embedding,
+            }
+            doc.update(metadata.model_dump())
+            documents.append(doc)
 
         if documents:
             # Upload prepared documents to the index
@@ -158,6 +366,7 @@ class MyAzureSearch:
         """
         # Extract texts and metadata
         texts = [chunk.chunk for chunk in chunks]
+        token_counts = [chunk.num_tokens for chunk in chunks]
         metadatas = [
             AzureSearchDocMetaData.from_chunk(
                 chunk, prefix=prefix, file_metadata=metadata
@@ -165,10 +374,50 @@ class MyAzureSearch:
             for chunk in chunks
         ]
 
-        return {"texts": texts, "metadatas": metadatas}
+        return {"texts": texts, "metadatas": metadatas, "token_counts": token_counts}
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap upper-bound estimate of the number of tokens of a text:
+    about 4 ASCII characters per token, one token per other character (CJK)
+    """
+    n_ascii = sum(1 for c in text if c.isascii())
+    return n_ascii // 4 + (len(text) - n_ascii) + 1
 
 
-class MyAzureOpenAIEmbeddings:
+def retry_after_seconds(headers: Mapping[str, str]) -> Optional[float]:
+    """Read the server's requested delay from retry-after-ms or Retry-After headers"""
+    if retry_after_ms := headers.get("retry-after-ms"):
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    if retry_after := headers.get("retry-after"):
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            # HTTP-date form
+            delay = parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)
+            return max(delay.total_seconds(), 0)
+        except (TypeError, ValueError):
+            pass
+
+    return None
+
+
+class MyAsyncAzureOpenAIEmbeddings:
+    """
+    Async embedding engine.
+
+    Texts are packed into requests by estimated token count, the requests run
+    concurrently under a limit, 429s and transient errors are retried with
+    backoff (honoring Retry-After), and vectors come back in input order.
+    """
+
     def __init__(
         self,
         api_key: str,
@@ -176,33 +425,173 @@ class MyAzureOpenAIEmbeddings:
         azure_endpoint: str,
         model: str,
         dimensions: str,
+        max_tokens_per_request: int = 64000,
+        max_inputs_per_request: int = 2048,
+        max_concurrency: int = 4,
+        max_retries: int = 6,
+        client: Optional[AsyncAzureOpenAI] = None,
+        cache: Optional[EmbeddingCache] = None,
     ):
         """
-        Initializes the MyAzureOpenAIEmbeddings instance.
+        Initializes the MyAsyncAzureOpenAIEmbeddings instance.
 
         Args:
             api_key (str): Azure OpenAI API key.
             api_version (str): Azure OpenAI API version.
             azure_endpoint (str): Azure OpenAI endpoint.
             model (str): The embedding model deployment name.
+            dimensions (str): Embedding dimensions.
+            max_tokens_per_request (int): Token budget of one request.
+            max_inputs_per_request (int): Max number of texts in one request.
+            max_concurrency (int): Max number of requests in flight.
+            max_retries (int): Retries of a request on 429 and transient errors.
+            client (AsyncAzureOpenAI): Optional preconfigured client, e.g. pointing
+                to a local fake server. Its own retries should be disabled.
+            cache (EmbeddingCache): Optional cache consulted before any request.
         """
-        self.client = AzureOpenAI(
-            api_key=api_key, api_version=api_version, azure_endpoint=azure_endpoint
+        self.client = client or AsyncAzureOpenAI(
+            api_key=api_key,
+            api_version=api_version,
+            azure_endpoint=azure_endpoint,
+            max_retries=0,  # Retries are handled here, honoring Retry-After
         )
         self.model = model
         self.dimensions = int(dimensions)
+        self.max_tokens_per_request = max_tokens_per_request
+        self.max_inputs_per_request = max_inputs_per_request
+        self.max_retries = max_retries
+        self.cache = cache
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def pack_batches(
+        self, texts: List[str], token_counts: Optional[List[int]] = None
+    ) -> List[List[int]]:
+        """
+        Group text indices into consecutive batches within the request budgets.
 
-    def embed_query(self, texts: List[str]) -> List[list]:
+        Args:
+            texts: Input texts
+            token_counts: Known token counts of the texts, estimated if missing
+
+        Returns:
+            List of batches, each a list of indices into texts
         """
-        Generates embeddings for a batch of texts.
+        if token_counts is None:
+            token_counts = [estimate_tokens(text) for text in texts]
+
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        batch_tokens = 0
+        for i, n_tokens in enumerate(token_counts):
+            if batch and (
+                batch_tokens + n_tokens > self.max_tokens_per_request
+                or len(batch) >= self.max_inputs_per_request
+            ):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += n_tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def _embed_batch(self, texts: List[str]) -> List[list]:
+        """Embed one request worth of texts, retrying on 429 and transient errors"""
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    with stage_timer("embedding"):
+                        response = await self.client.embeddings.create(
+                            input=texts, model=self.model, dimensions=self.dimensions
+                        )
+                if response.usage:
+                    EMBEDDING_TOKENS.inc(response.usage.prompt_tokens)
+                # The service may reorder items; each carries its input index
+                return [
+                    item.embedding
+                    for item in sorted(response.data, key=lambda item: item.index)
+                ]
+            except (
+                RateLimitError,
+                APITimeoutError,
+                APIConnectionError,
+                InternalServerError,
+            ) as e:
+                if attempt >= self.max_retries:
+                    raise
+
+                delay = None
+                if isinstance(e, RateLimitError):
+                    delay = retry_after_seconds(e.response.headers)
+                if delay is None:
+                    # Exponential backoff with jitter
+                    delay = min(2**attempt, 60) * (0.5 + random.random() / 2)
+
+                logger.warning(
+                    f"Embedding request failed ({type(e).__name__}), "
+                    f"retry {attempt + 1}/{self.max_retries} in {delay:.2f}s"
+                )
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _embed_uncached(
+        self, texts: List[str], token_counts: Optional[List[int]] = None
+    ) -> List[list]:
+        """Embed texts through the service, in input order"""
+        batches = self.pack_batches(texts, token_counts)
+        results = await asyncio.gather(
+            *(self._embed_batch([texts[i] for i in batch]) for batch in batches)
+        )
+
+        embeddings: List[Optional[list]] = [None] * len(texts)
+        for batch, batch_embeddings in zip(batches, results):
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
+        return embeddings
+
+    async def embed_documents(
+        self, texts: List[str], token_counts: Optional[List[int]] = None
+    ) -> List[list]:
+        """
+        Generates embeddings for texts, in input order.
+        Cached texts and repeated texts are not sent to the service.
 
         Args:
             texts (List[str]): List of input texts to generate embeddings for.
+            token_counts (List[int], optional): Token counts of the texts.
 
         Returns:
             List[list]: List of embedding vectors.
         """
-        response = self.client.embeddings.create(
-            input=texts, model=self.model, dimensions=self.dimensions
-        )
-        return [item.embedding for item in response.data]
+        if not texts:
+            return []
+
+        if self.cache is None:
+            return await self._embed_uncached(texts, token_counts)
+
+        keys = [self.cache.key(text) for text in texts]
+        embeddings_by_key = await asyncio.to_thread(self.cache.get_many, keys)
+
+        # Index of the first text of each key missing from the cache
+        missing: Dict[str, int] = {}
+        for i, key in enumerate(keys):
+            if key not in embeddings_by_key and key not in missing:
+                missing[key] = i
+
+        if missing:
+            missing_indices = list(missing.values())
+            new_embeddings = await self._embed_uncached(
+                [texts[i] for i in missing_indices],
+                [token_counts[i] for i in missing_indices] if token_counts else None,
+            )
+            new_embeddings_by_key = dict(zip(missing.keys(), new_embeddings))
+            await asyncio.to_thread(self.cache.set_many, new_embeddings_by_key)
+            embeddings_by_key.update(new_embeddings_by_key)
+
+        logger.debug(f"Embedded {len(texts)} texts with {len(missing)} service lookups")
+        self.cache.log_counters()
+        return [embeddings_by_key[key] for key in keys]
+
+    async def close(self):
+        await self.client.close()
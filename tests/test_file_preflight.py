@@ -0,0 +1,254 @@
+"""
+preflight_file on in-memory files read through a bytes-slicing range reader:
+the sample PDFs, generated ZIP based files, and rejected inputs.
+"""
+
+import io
+import struct
+import zipfile
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import pytest
+
+from src.file_preflight import (HEAD_BYTES, ZIP_TAIL_BYTES, PreflightError,
+                                preflight_file)
+
+TEST_FILES = Path(__file__).parent / "test_files"
+
+CONTENT_TYPES = b'<?xml version="1.0"?><Types/>'
+DOCUMENT_XML = b'<?xml version="1.0"?><w:document/>'
+APP_XML = (
+    b'<?xml version="1.0"?><Properties><Template>Normal.dotm</Template>'
+    b"<Pages>7</Pages><Words>1200</Words></Properties>"
+)
+
+
+class BytesReader:
+    """read_range over bytes, recording the ranges read"""
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.reads: List[Tuple[int, int]] = []
+
+    def __call__(self, offset: int, length: int) -> bytes:
+        self.reads.append((offset, length))
+        return self.data[offset : offset + length]
+
+    @property
+    def bytes_read(self) -> int:
+        return sum(
+            len(self.data[offset : offset + length]) for offset, length in self.reads
+        )
+
+
+def preflight(data: bytes, **kwargs):
+    return preflight_file(BytesReader(data), len(data), **kwargs)
+
+
+def make_zip(
+    members: Dict[str, bytes],
+    comment: bytes = b"",
+    compression: int = zipfile.ZIP_DEFLATED,
+) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=compression) as zf:
+        for name, content in members.items():
+            zf.writestr(name, content)
+        zf.comment = comment
+    return buffer.getvalue()
+
+
+def make_docx(app_xml: Optional[bytes] = APP_XML, **kwargs) -> bytes:
+    members = {
+        "[Content_Types].xml": CONTENT_TYPES,
+        "word/document.xml": DOCUMENT_XML,
+    }
+    if app_xml is not None:
+        members["docProps/app.xml"] = app_xml
+    return make_zip(members, **kwargs)
+
+
+def as_zip64(data: bytes) -> bytes:
+    """
+    The same ZIP file (without comment) with a ZIP64 end of central directory,
+    its locator, and the directory offset of the end record set to 0xFFFFFFFF
+    """
+    end = data[-22:]
+    assert end.startswith(b"PK\x05\x06")
+    num_entries, directory_size, directory_offset = struct.unpack(
+        "<HII", end[10:20]
+    )
+    body = data[:-22]
+    zip64_end = b"PK\x06\x06" + struct.pack(
+        "<QHHIIQQQQ",
+        44,
+        45,
+        45,
+        0,
+        0,
+        num_entries,
+        num_entries,
+        directory_size,
+        directory_offset,
+    )
+    locator = b"PK\x06\x07" + struct.pack("<IQI", 0, len(body), 1)
+    end = end[:16] + struct.pack("<I", 0xFFFFFFFF) + end[20:]
+    return body + zip64_end + locator + end
+
+
+@pytest.mark.parametrize(
+    "file_name, num_pages",
+    [("breaking_text.pdf", 5), ("empty.pdf", 1), ("text_only.pdf", 3)],
+)
+def test_pdf_pages_from_page_tree(file_name, num_pages):
+    data = (TEST_FILES / file_name).read_bytes()
+
+    preflight_result = preflight(data)
+
+    assert preflight_result.file_type == "pdf"
+    assert preflight_result.size == len(data)
+    assert preflight_result.num_pages == num_pages
+
+
+def test_pdf_pages_from_linearization_dictionary():
+    data = (
+        b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n"
+        b"1 0 obj\n<</Linearized 1/L 123456/H [ 700 200]/O 4/E 5000/N 42/T 9000>>\n"
+        b"endobj\n" + b"0" * (2 * HEAD_BYTES)
+    )
+
+    assert preflight(data).num_pages == 42
+
+
+def test_pdf_over_page_limit_is_rejected():
+    data = (TEST_FILES / "breaking_text.pdf").read_bytes()
+
+    assert preflight(data, max_pages=5).num_pages == 5
+    with pytest.raises(PreflightError):
+        preflight(data, max_pages=4)
+
+
+def test_docx_pages_from_app_properties():
+    preflight_result = preflight(make_docx())
+
+    assert preflight_result.file_type == "docx"
+    assert preflight_result.num_pages == 7
+
+
+def test_docx_pages_from_stored_app_properties():
+    data = make_docx(compression=zipfile.ZIP_STORED)
+
+    assert preflight(data).num_pages == 7
+
+
+def test_docx_without_app_properties():
+    preflight_result = preflight(make_docx(app_xml=None))
+
+    assert preflight_result.file_type == "docx"
+    assert preflight_result.num_pages is None
+
+
+def test_docx_is_sniffed_without_reading_its_members():
+    # Incompressible media between the local headers and the directory
+    media = bytes(range(256)) * 4096
+    members = {
+        "[Content_Types].xml": CONTENT_TYPES,
+        "word/document.xml": DOCUMENT_XML,
+        "word/media/image1.png": media,
+        "docProps/app.xml": APP_XML,
+    }
+    data = make_zip(members, compression=zipfile.ZIP_STORED)
+    reader = BytesReader(data)
+
+    preflight_result = preflight_file(reader, len(data))
+
+    assert preflight_result.num_pages == 7
+    assert reader.bytes_read < len(media)
+
+
+def test_zip_with_trailing_comment():
+    data = make_docx(comment=b"Created by a test " * 100)
+
+    preflight_result = preflight(data)
+
+    assert preflight_result.file_type == "docx"
+    assert preflight_result.num_pages == 7
+
+
+def test_zip_directory_before_the_tail():
+    # A comment of almost the maximum size leaves the directory of the many
+    # members out of the tail read: it is read with one more request
+    members = {
+        "[Content_Types].xml": CONTENT_TYPES,
+        "word/document.xml": DOCUMENT_XML,
+        "docProps/app.xml": APP_XML,
+    }
+    members.update({f"word/media/image{i}.png": b"" for i in range(50)})
+    data = make_zip(members, comment=b"c" * 65000)
+    reader = BytesReader(data)
+
+    preflight_result = preflight_file(reader, len(data))
+
+    assert preflight_result.file_type == "docx"
+    assert preflight_result.num_pages == 7
+    directory_size, directory_offset = struct.unpack(
+        "<II", data[-65000 - 10 : -65000 - 2]
+    )
+    assert directory_offset < len(data) - ZIP_TAIL_BYTES
+    assert (directory_offset, directory_size) in reader.reads
+
+
+def test_zip64_end_of_central_directory():
+    data = as_zip64(make_docx())
+    # The rewritten file is still a valid ZIP file
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert "word/document.xml" in zf.namelist()
+
+    preflight_result = preflight(data)
+
+    assert preflight_result.file_type == "docx"
+    assert preflight_result.num_pages == 7
+
+
+def test_xlsx_is_rejected():
+    data = make_zip(
+        {"[Content_Types].xml": CONTENT_TYPES, "xl/workbook.xml": b"<workbook/>"}
+    )
+
+    with pytest.raises(PreflightError, match="xlsx"):
+        preflight(data)
+
+
+def test_zip_without_directory_is_rejected():
+    data = make_docx()[:-22]
+
+    with pytest.raises(PreflightError):
+        preflight(data)
+
+
+def test_empty_file_is_rejected():
+    reader = BytesReader(b"")
+
+    with pytest.raises(PreflightError):
+        preflight_file(reader, 0)
+    assert reader.reads == []
+
+
+def test_oversized_file_is_rejected_before_any_read():
+    data = (TEST_FILES / "text_only.pdf").read_bytes()
+    reader = BytesReader(data)
+
+    assert preflight(data, max_bytes=len(data)).file_type == "pdf"
+    with pytest.raises(PreflightError):
+        preflight_file(reader, len(data), max_bytes=len(data) - 1)
+    assert reader.reads == []
+
+
+def test_image_is_one_page():
+    data = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+
+    preflight_result = preflight(data)
+
+    assert preflight_result.file_type == "png"
+    assert preflight_result.num_pages == 1
@@ -0,0 +1,86 @@
+"""
+IngestionQueue on a temporary SQLite file, with a fake clock to expire leases.
+"""
+
+import pytest
+
+import src.ingestion_queue as ingestion_queue
+from src.ingestion_queue import FAILED, PENDING, PROCESSING, IngestionQueue
+
+LEASE_SECONDS = 60
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ingestion_queue.time, "time", clock.time)
+    return clock
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = IngestionQueue(
+        str(tmp_path / "queue.sqlite3"), lease_seconds=LEASE_SECONDS, max_attempts=3
+    )
+    yield queue
+    queue.close()
+
+
+def test_orphan_fails_after_max_attempts(queue, clock):
+    queue.enqueue("batch", "container", ["crashing.pdf"])
+
+    for attempt in range(1, 4):
+        job = queue.claim()
+        assert job.attempts == attempt
+        assert queue.batch_status("batch")[PROCESSING] == 1
+
+        # The worker dies: no heartbeat until the lease expires
+        clock.now += LEASE_SECONDS + 1
+        queue.requeue_orphans()
+
+    assert queue.claim() is None
+    assert queue.batch_status("batch")[FAILED] == 1
+    assert "died" in queue.batch_failures("batch")["crashing.pdf"]
+
+
+def test_orphan_is_requeued_before_max_attempts(queue, clock):
+    queue.enqueue("batch", "container", ["slow.pdf"])
+    queue.claim()
+
+    clock.now += LEASE_SECONDS + 1
+    assert queue.requeue_orphans() == 1
+
+    assert queue.batch_status("batch")[PENDING] == 1
+    assert queue.claim().attempts == 2
+
+
+def test_heartbeat_keeps_the_lease(queue, clock):
+    queue.enqueue("batch", "container", ["large.pdf"])
+    job = queue.claim()
+
+    clock.now += LEASE_SECONDS - 1
+    queue.heartbeat([job.job_id])
+    clock.now += LEASE_SECONDS - 1
+
+    assert queue.requeue_orphans() == 0
+    assert queue.batch_status("batch")[PROCESSING] == 1
+
+
+def test_released_job_keeps_its_attempts(queue, clock):
+    queue.enqueue("batch", "container", ["interrupted.pdf"])
+
+    for _ in range(5):
+        job = queue.claim()
+        assert job.attempts == 1
+        # The process stops while the job runs
+        queue.release([job.job_id])
+
+    assert queue.batch_status("batch")[PENDING] == 1
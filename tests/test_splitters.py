@@ -0,0 +1,137 @@
+"""
+SimplePageTextSplitter on fixed multi-page inputs. The expected chunks are
+those of the baseline splitter, which the offset-based engine must reproduce
+chunk for chunk.
+"""
+
+from typing import List, Tuple
+
+import pytest
+
+from src.splitters import SimplePageTextSplitter
+
+PAGES = [
+    {
+        "page_no": 0,
+        "text": "Alpha beta gamma.\n\nDelta epsilon zeta. Eta theta iota kappa.",
+    },
+    {
+        "page_no": 1,
+        "text": "Lambda mu nu, xi omicron pi.\nRho sigma tau upsilon phi chi psi omega.",
+    },
+    {"page_no": 2, "text": "Short tail."},
+]
+SHORT_PAGES = [
+    {"page_no": 0, "text": "One two three. Four five six."},
+    {"page_no": 1, "text": "Seven eight."},
+]
+SPANNING_PAGES = [
+    {"page_no": 1, "text": "Page one."},
+    {"page_no": 2, "text": "Page two."},
+    {"page_no": 3, "text": "Page three."},
+]
+UNBROKEN_PAGES = [{"page_no": 0, "text": "x" * 25}]
+
+# (pages, chunk_size, chunk_overlap)
+CASES = [
+    (PAGES, 30, 10),
+    (PAGES, 30, 0),
+    (PAGES, 12, 4),
+    (PAGES, 1000, 0),
+    (SHORT_PAGES, 20, 0),
+    (SPANNING_PAGES, 25, 5),
+    (UNBROKEN_PAGES, 10, 3),
+]
+
+
+def as_tuples(chunks) -> List[Tuple[str, Tuple[int, int], str]]:
+    return [
+        (
+            chunk.chunk_no,
+            (chunk.page_range.start_page, chunk.page_range.end_page),
+            chunk.chunk,
+        )
+        for chunk in chunks
+    ]
+
+
+def test_split_text_at_separators_with_overlap():
+    splitter = SimplePageTextSplitter(chunk_size=30, chunk_overlap=10)
+
+    assert as_tuples(splitter.split_text(PAGES)) == [
+        ("0", (0, 0), "Alpha beta gamma.\n\nDelta epsilon zeta. "),
+        ("1", (0, 0), "Delta epsilon zeta. Eta theta iota kappa."),
+        ("2", (1, 1), "Eta theta iota kappa.Lambda mu nu, xi omicron pi.\n"),
+        ("3", (1, 1), "omicron pi.\nRho sigma tau upsilon phi chi "),
+        ("4", (1, 1), "Rho sigma tau upsilon phi chi psi omega."),
+        ("5", (2, 2), "psi omega.Short tail."),
+    ]
+
+
+def test_split_text_without_overlap():
+    # As in the baseline splitter, chunk_overlap=0 carries the whole previous
+    # chunk into the next one
+    splitter = SimplePageTextSplitter(chunk_size=20, chunk_overlap=0)
+
+    assert as_tuples(splitter.split_text(SHORT_PAGES)) == [
+        ("0", (0, 0), "One two three. Four five "),
+        ("1", (0, 0), "One two three. Four five six."),
+        ("2", (1, 1), "One two three. Four five six.Seven eight."),
+    ]
+
+
+def test_split_text_page_ranges():
+    splitter = SimplePageTextSplitter(chunk_size=1000)
+
+    assert as_tuples(splitter.split_text(PAGES)) == [
+        ("0", (0, 2), "".join(page["text"] for page in PAGES)),
+    ]
+    # As in the baseline splitter, the start page steps back one page for
+    # each page the pending chunk continues on
+    assert as_tuples(splitter.split_text(SPANNING_PAGES)) == [
+        ("0", (0, 3), "Page one.Page two.Page three."),
+    ]
+
+
+def test_split_text_without_separator_cuts_at_chunk_size():
+    splitter = SimplePageTextSplitter(
+        chunk_size=10, chunk_overlap=3, separators=["\n\n", " "]
+    )
+
+    assert as_tuples(splitter.split_text(UNBROKEN_PAGES)) == [
+        ("0", (0, 0), "x" * 10),
+        ("1", (0, 0), "x" * 13),
+        ("2", (0, 0), "x" * 8),
+    ]
+
+
+def test_split_text_rejects_empty_pages():
+    with pytest.raises(ValueError):
+        SimplePageTextSplitter().split_text([])
+
+
+@pytest.mark.parametrize("pages, chunk_size, chunk_overlap", CASES)
+def test_stream_matches_split_text(pages, chunk_size, chunk_overlap):
+    splitter = SimplePageTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+    stream = splitter.stream()
+    chunks = [chunk for page in pages for chunk in stream.feed([page])]
+    chunks.extend(stream.close())
+
+    assert as_tuples(chunks) == as_tuples(splitter.split_text(pages))
+
+
+@pytest.mark.parametrize("pages, chunk_size, chunk_overlap", CASES)
+def test_custom_length_function_matches_len(pages, chunk_size, chunk_overlap):
+    # Any length function other than len goes through the string-based path
+    splitter = SimplePageTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=lambda text: len(text),
+    )
+    expected = SimplePageTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    ).split_text(pages)
+
+    assert as_tuples(splitter.split_text(pages)) == as_tuples(expected)